@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Pages corpus for parsers benchmark, in benchmark/fixtures/<kind>/*.html:
+galaxy_uni4 - galaxy pages with packed script, galaxy_uni5 - with unpacked one,
+log_uni4, log_uni5 - battle log pages, existing and nonexistent logs.
+Generated pages (gen_*) are synthetic: they have the layout the game sends,
+but are made from a fixed random seed, so that the corpus is the same between
+runs and results are comparable, not measured on real pages. Real galaxy
+pages are recorded (rec_*) from pages cache with --record-from-cache.
+Packed uni4 scripts are encoded here, not with the decoder under test.
+"""
+import json
+import os
+import random
+import re
+import shutil
+
+FIXTURE_KINDS = ['galaxy_uni4', 'galaxy_uni5', 'log_uni4', 'log_uni5']
+
+_NAMES = ['minlexx', 'ОЛЕГ КАРПЕНКО', 'ScumWir', 'Сергей Такачёв', 'GART1610', 'xXxHari6aTop3000xXx',
+          'Artik', 'Злой фермер', "O'Neil", 'q"uote']
+_PLANET_NAMES = ['Главная планета', 'Колония', 'Arnon', 'Base \\ 1', 'Шахтерская лопятка']
+_ALLIANCES = [(389, 'Fury', 'Fury', 8), (12, 'Звездный Легион', 'SL', 41), (77, 'Tor & Co', 'T&C', 3)]
+
+_PAGE_HEAD = '<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{0}</title>' \
+             '<link rel="stylesheet" href="/css/style.css">' \
+             '<script type="text/javascript" src="/js/jquery.min.js"></script></head>\n<body>' \
+             '<div id="header"><ul class="menu">{1}</ul></div><div id="content">'
+_PAGE_TAIL = '</div><div id="footer">{0}</div></body></html>'
+
+
+def _menu_html(rnd: random.Random) -> str:
+    return ''.join(['<li><a href="/?set={0}">Пункт меню {0}</a></li>'.format(rnd.randint(1, 99))
+                    for i in range(30)])
+
+
+def _footer_html(rnd: random.Random) -> str:
+    return ''.join(['<p class="footer">Игроков онлайн: {0}</p>'.format(rnd.randint(1, 999)) for i in range(100)])
+
+
+def _galaxy_row(rnd: random.Random, pos: int, uni5: bool) -> dict:
+    row = {'planet': pos, 'ally_planet': 0, 'metal': rnd.choice([0, 0, rnd.randint(1, 10 ** 6)]),
+           'crystal': rnd.choice([0, rnd.randint(1, 10 ** 6)]), 'name': rnd.choice(_PLANET_NAMES),
+           'planet_type': rnd.choice([1, 1, 1, 5]), 'destruyed': 0,
+           'image': 'normaltempplanet{0:02}'.format(rnd.randint(1, 10)),
+           'last_active': rnd.choice([0, 15, 60]), 'parent_planet': 0,
+           'luna_id': None, 'luna_name': None, 'luna_destruyed': None, 'luna_diameter': None, 'luna_temp': None,
+           'user_id': rnd.randint(1, 99999), 'username': rnd.choice(_NAMES), 'race': rnd.randint(1, 4),
+           'ally_id': 0, 'authlevel': 0, 'onlinetime': rnd.choice([0, 0, 1, 2]), 'sex': 1,
+           'avatar': rnd.randint(1, 9), 'user_image': '', 'ally_name': None, 'ally_members': None,
+           'ally_web': None, 'ally_tag': None, 'type': None,
+           'total_rank': rnd.randint(1, 9000), 'total_points': rnd.randint(0, 10 ** 7)}
+    if rnd.random() < 0.3:
+        row['luna_id'] = rnd.randint(1, 99999)
+        row['luna_name'] = 'Луна'
+        row['luna_destruyed'] = 0
+        row['luna_diameter'] = rnd.randint(1000, 9000)
+        row['luna_temp'] = rnd.randint(-100, 50)
+    if rnd.random() < 0.4:
+        row['ally_id'], row['ally_name'], row['ally_tag'], row['ally_members'] = rnd.choice(_ALLIANCES)
+        row['ally_web'] = ''
+    planet_id = rnd.randint(1, 999999)
+    if uni5:
+        row['planet_id'] = planet_id
+        row['banned'] = rnd.choice([0, 0, 0, 1])
+        row['vacation'] = rnd.choice([0, 0, 0, 1])
+    else:
+        row['id_planet'] = planet_id
+        row['banaday'] = rnd.choice([0, 0, 0, 1])
+        row['urlaubs_modus_time'] = rnd.choice([0, 0, 0, 1])
+    return row
+
+
+# packer's word index encoder, as in packed script itself:
+# e=function(c){return(c<a?'':e(parseInt(c/a)))+((c=c%a)>35?String.fromCharCode(c+29):c.toString(36))}
+def _packer_e(c: int, a: int) -> str:
+    prefix = '' if c < a else _packer_e(c // a, a)
+    c = c % a
+    if c > 35:
+        return prefix + chr(c + 29)
+    if c > 9:
+        return prefix + chr(ord('a') + c - 10)
+    return prefix + chr(ord('0') + c)
+
+
+# Dean Edwards' packer, the way galaxy scripts are packed on uni4
+def pack_js(src: str, a: int=62) -> str:
+    freq = {}
+    for word in re.findall(r'\b\w+\b', src, re.ASCII):
+        freq[word] = freq.get(word, 0) + 1
+    words = sorted(freq, key=lambda w: -freq[w])
+    mapping = {word: _packer_e(i, a) for i, word in enumerate(words)}
+    # words that are equal to their encoding are not listed
+    k = [('' if word == mapping[word] else word) for word in words]
+    p = re.sub(r'\b\w+\b', lambda m: mapping[m.group(0)], src, flags=re.ASCII)
+    p = p.replace('\\', '\\\\').replace("'", "\\'")
+    func = "function(p,a,c,k,e,d){e=function(c){return(c<a?'':e(parseInt(c/a)))+((c=c%a)>35?" \
+           "String.fromCharCode(c+29):c.toString(36))};if(!''.replace(/^/,String)){while(c--){d[e(c)]=k[c]||e(c)}" \
+           "k=[function(e){return d[e]}];e=function(){return'\\\\w+'};c=1};while(c--){if(k[c]){p=p.replace(" \
+           "new RegExp('\\\\b'+e(c)+'\\\\b','g'),k[c])}}return p}"
+    return "eval({0}('{1}',{2},{3},'{4}'.split('|'),0,{{}}))".format(func, p, a, len(words), '|'.join(k))
+
+
+def make_galaxy_page(rnd: random.Random, uni5: bool) -> str:
+    positions = sorted(rnd.sample(range(1, 16), rnd.randint(0, 15)))
+    rows_js = ''.join(['row[{0}]={1};'.format(pos, json.dumps(_galaxy_row(rnd, pos, uni5), separators=(',', ':')))
+                       for pos in positions])
+    if uni5:
+        body = "$('#galaxy').append(PrintSelector(fleet_shortcut));\n" + rows_js
+    else:
+        body = pack_js(rows_js)
+    script = "var Deuterium = '{0}';\nvar fleet_shortcut = [];\nvar row = [];\n{1}\n" \
+             "$('#galaxy').append(PrintRow());".format(rnd.randint(0, 10 ** 6), body)
+    return _PAGE_HEAD.format('Галактика :: Звездная Империя {0}'.format(5 if uni5 else 4), _menu_html(rnd)) + \
+        '<table class="table"><tr><td>Галактика</td><td><input name="galaxy" value="1"></td></tr></table>' \
+        "<div id='galaxy' class='container'><script type='text/javascript'>" + script + '</script></div>' + \
+        _PAGE_TAIL.format(_footer_html(rnd))
+
+
+def _log_time_str(rnd: random.Random) -> str:
+    return '{0:02}-{1:02}-2016 {2:02}:{3:02}:{4:02}'.format(rnd.randint(1, 28), rnd.randint(1, 12),
+                                                            rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+
+
+def _coords(rnd: random.Random) -> str:
+    return '[{0}:{1}:{2}]'.format(rnd.randint(1, 5), rnd.randint(1, 499), rnd.randint(1, 15))
+
+
+def _fleet_table(rnd: random.Random) -> str:
+    cells = ''.join(['<th>Тип {0}</th>'.format(i) for i in range(8)])
+    values = ''.join(['<td>{0}</td>'.format(rnd.randint(0, 999)) for i in range(8)])
+    return '<table class="report_fleet_table"><tr>{0}</tr><tr>{1}</tr><tr>{1}</tr></table>'.format(cells, values)
+
+
+def make_log_uni5_page(rnd: random.Random, exists: bool) -> str:
+    if not exists:
+        return _PAGE_HEAD.format('Сообщение :: Звездная Империя 5', _menu_html(rnd)) + \
+            '<table><tr><th class="errormessage">Запрашиваемого лога не существует в базе данных</th></tr></table>' + \
+            _PAGE_TAIL.format(_footer_html(rnd))
+    attackers = rnd.sample(_NAMES, rnd.randint(1, 3))
+    defenders = rnd.sample([name for name in _NAMES if name not in attackers], rnd.randint(1, 2))
+    parts = ['<div id="report" class="table-responsive"><div class="report">'
+             'В {0} произошёл бой между следующими флотами:</div>'.format(_log_time_str(rnd))]
+    for battle_round in range(rnd.randint(1, 6)):
+        for name in attackers:
+            parts.append("<table class='report_user'><tr><td><span class='negative'>{0}</span></td></tr></table>"
+                         "<div class='report_fleet'><span class='negative'>Атакующий {0} {1}</span></div>{2}".format(
+                             name, _coords(rnd), _fleet_table(rnd)))
+        for name in defenders:
+            parts.append("<table class='report_user'><tr><td><span class='positive'>{0}</span></td></tr></table>"
+                         "<div class='report_fleet'><span class='positive'>Защитник {0} {1}</span></div>{2}".format(
+                             name, _coords(rnd), _fleet_table(rnd)))
+    parts.append("<table class='report_result'><tr><td>Атакующий выиграл битву!<br>"
+                 'Он получает {0} металла, {1} кристалла и {2} дейтерия<br>'
+                 'Атакующий потерял {3} единиц.<br>Обороняющийся потерял {4} единиц.<br>'
+                 'Поле обломков: {5} металла и {6} кристалла.<br>'
+                 'Шанс появления луны составляет {7}%</td></tr></table></div>'.format(
+                     *(['{0:,}'.format(rnd.randint(0, 10 ** 7)).replace(',', '.') for i in range(7)] +
+                       [rnd.randint(0, 20)])))
+    return _PAGE_HEAD.format('Боевой доклад :: Звездная Империя 5', _menu_html(rnd)) + ''.join(parts) + \
+        _PAGE_TAIL.format(_footer_html(rnd))
+
+
+def make_log_uni4_page(rnd: random.Random, exists: bool) -> str:
+    if not exists:
+        return _PAGE_HEAD.format('Сообщение :: Звездная Империя 4', _menu_html(rnd)) + \
+            '<center>Запрашиваемого лога не существует в базе данных</center>' + \
+            _PAGE_TAIL.format(_footer_html(rnd))
+    attacker = ','.join(rnd.sample(_NAMES, rnd.randint(1, 3)))
+    defender = rnd.choice([name for name in _NAMES if name not in attacker])
+    title = '{0} vs {1} (П: {2})'.format(attacker, defender, '{0:,}'.format(rnd.randint(0, 10 ** 7)).replace(',', '.'))
+    parts = ['<table width="100%"><tr><td><center>В {0} произошёл бой между следующими флотами:</center>'.format(
+        _log_time_str(rnd))]
+    for battle_round in range(rnd.randint(1, 6)):
+        for name in attacker.split(','):
+            parts.append('<span>Атакующий {0} {1}</span>{2}'.format(name, _coords(rnd), _fleet_table(rnd)))
+        parts.append('<span>Защитник {0} {1}</span>{2}'.format(defender, _coords(rnd), _fleet_table(rnd)))
+    parts.append('<p>Атакующий выиграл битву!<br>Он получает {0} металла, {1} кристалла и {2} дейтерия</p>'
+                 '<table><tr><td>Поле обломков: {3} металла и {4} кристалла.</td></tr></table></td></tr></table>'.format(
+                     *['{0:,}'.format(rnd.randint(0, 10 ** 7)).replace(',', '.') for i in range(5)]))
+    return _PAGE_HEAD.format(title, _menu_html(rnd)) + ''.join(parts) + _PAGE_TAIL.format(_footer_html(rnd))
+
+
+def generate_fixtures(fixtures_dir: str, num_pages: int=50, seed: int=1) -> int:
+    """
+    Generates pages corpus, replacing previously generated pages (recorded ones are kept)
+    :param fixtures_dir: corpus directory
+    :param num_pages: number of pages of each kind
+    :param seed: random seed, the same seed gives the same pages
+    :return: number of pages written
+    """
+    rnd = random.Random(seed)
+    num_written = 0
+    for kind in FIXTURE_KINDS:
+        kind_dir = os.path.join(fixtures_dir, kind)
+        os.makedirs(kind_dir, exist_ok=True)
+        for fn in os.listdir(kind_dir):
+            if fn.startswith('gen_'):
+                os.remove(os.path.join(kind_dir, fn))
+        for i in range(num_pages):
+            # every 5th log is nonexistent
+            exists = (i % 5) != 4
+            if kind == 'galaxy_uni4':
+                page = make_galaxy_page(rnd, uni5=False)
+            elif kind == 'galaxy_uni5':
+                page = make_galaxy_page(rnd, uni5=True)
+            elif kind == 'log_uni4':
+                page = make_log_uni4_page(rnd, exists)
+            else:
+                page = make_log_uni5_page(rnd, exists)
+            name = 'gen_{0:04}{1}.html'.format(i, '' if exists else '_nonexistent')
+            with open(os.path.join(kind_dir, name), mode='wt', encoding='UTF-8') as f:
+                f.write(page)
+            num_written += 1
+    return num_written
+
+
+def record_fixtures(fixtures_dir: str, cache_dir: str, kind: str, max_pages: int=50) -> int:
+    """
+    Copies real galaxy pages from pages cache (files storage) into corpus
+    :param fixtures_dir: corpus directory
+    :param cache_dir: pages cache directory, like ./cache/page
+    :param kind: corpus kind to put pages to, galaxy_uni4 or galaxy_uni5
+    :param max_pages: max number of pages to copy
+    :return: number of pages copied
+    """
+    kind_dir = os.path.join(fixtures_dir, kind)
+    os.makedirs(kind_dir, exist_ok=True)
+    names = sorted([fn for fn in os.listdir(cache_dir) if fn.startswith('galaxy_') and not fn.endswith('.meta')])
+    for fn in names[:max_pages]:
+        shutil.copyfile(os.path.join(cache_dir, fn), os.path.join(kind_dir, 'rec_{0}.html'.format(fn)))
+    return min(len(names), max_pages)
+
+
+# returns list of (name, page text) of corpus kind
+def load_fixtures(fixtures_dir: str, kind: str) -> list:
+    kind_dir = os.path.join(fixtures_dir, kind)
+    if not os.path.isdir(kind_dir):
+        return []
+    ret = []
+    for fn in sorted(os.listdir(kind_dir)):
+        if fn.endswith('.html'):
+            with open(os.path.join(kind_dir, fn), mode='rt', encoding='UTF-8') as f:
+                ret.append((fn, f.read()))
+    return ret
@@ -0,0 +1,343 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'site_uni5'))
+
+from bench_fixtures import generate_fixtures, record_fixtures, load_fixtures
+from xnova import xn_logger
+from xnova.galaxy_db_schema import upgrade_galaxy_db
+from xnova.galaxy_search import GalaxyNamesIndex
+from xnova.lastlogs_utils import LLDb
+from xnova.xn_parser_galaxy import GalaxyParser, GalaxyScriptExtractor, parse_galaxy_page
+
+import galaxy_auto_parser
+import lastlogs
+import lastlogs5
+from classes.xnova_utils import XNGalaxyParser
+
+logger = xn_logger.get('BENCH', debug=False)
+
+
+# runs func(item) for all items repeat times, returns tuple
+# (best time of one pass over all items, in seconds; results of the last pass)
+def timed(func, items: list, repeat: int) -> tuple:
+    best = None
+    results = None
+    for i in range(repeat):
+        gc.collect()
+        ts = time.perf_counter()
+        results = [func(item) for item in items]
+        secs = time.perf_counter() - ts
+        if (best is None) or (secs < best):
+            best = secs
+    return best, results
+
+
+# peak memory allocated by Python objects during one pass, in KiB
+def peak_memory_kb(func, items: list) -> float:
+    gc.collect()
+    tracemalloc.start()
+    for item in items:
+        func(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024.0
+
+
+def new_galaxy_db() -> sqlite3.Connection:
+    db = sqlite3.connect(':memory:')
+    upgrade_galaxy_db(db)
+    return db
+
+
+# galaxy pages: GalaxyParser (HTML scan), GalaxyScriptExtractor (fast path),
+# native unscramble, rows to DB tuples conversion and GalaxyDBWriter
+def bench_galaxy_parser(pages: list, repeat: int) -> dict:
+    parser = GalaxyParser()
+
+    def html_scan(page):
+        parser.reset()
+        parser.clear()
+        parser.parse_page_content(page)
+        return parser.script_body
+
+    def script_extraction(page):
+        extractor = GalaxyScriptExtractor()
+        extractor.feed(page)
+        return extractor.script_body
+
+    def unscramble(script_body):
+        parser.script_body = script_body
+        parser.galaxy_rows = []
+        return parser.unscramble_galaxy_script()
+
+    def row_conversion(rows):
+        return galaxy_auto_parser.galaxy_rows_to_db_tuples(1, 1, rows)
+
+    db = new_galaxy_db()
+    db_writer = galaxy_auto_parser.GalaxyDBWriter(db, 10)
+    db_writer.names_index = GalaxyNamesIndex(db)
+    unit_counter = [0]
+
+    def db_write(rows):
+        # every page is a new system, so all planets are written
+        unit_counter[0] += 1
+        db_writer.add_system(unit_counter[0] // 500 + 1, unit_counter[0] % 500, rows, 0)
+        return None
+
+    def total(page):
+        rows = parse_galaxy_page(page, parser=parser)
+        db_write(rows)
+        return rows
+
+    phases = {}
+    phases['html_scan'], bodies = timed(html_scan, pages, repeat)
+    phases['script_extraction'], fast_bodies = timed(script_extraction, pages, repeat)
+    if bodies != fast_bodies:
+        logger.warn('GalaxyScriptExtractor and GalaxyParser found different scripts')
+    phases['unscramble'], rows_lists = timed(unscramble, bodies, repeat)
+    rows_lists = [rows for rows in rows_lists if rows is not None]
+    phases['row_conversion'], unused = timed(row_conversion, rows_lists, repeat)
+    phases['db_write'], unused = timed(db_write, rows_lists, repeat)
+    db_writer.flush()
+    total_secs, unused = timed(total, pages, repeat)
+    db_writer.flush()
+    return make_result(pages, phases, total_secs, peak_memory_kb(total, pages))
+
+
+# site copy of galaxy parser (uni5 site): HTML scan and unscramble
+def bench_site_galaxy_parser(pages: list, repeat: int) -> dict:
+    parser = XNGalaxyParser()
+
+    def html_scan(page):
+        parser.reset()
+        parser.clear()
+        parser.parse_page_content(page)
+        return parser.script_body
+
+    def unscramble(script_body):
+        parser.script_body = script_body
+        parser.galaxy_rows = []
+        return parser.unscramble_galaxy_script()
+
+    def total(page):
+        return unscramble(html_scan(page))
+
+    phases = {}
+    phases['html_scan'], bodies = timed(html_scan, pages, repeat)
+    phases['unscramble'], unused = timed(unscramble, bodies, repeat)
+    total_secs, unused = timed(total, pages, repeat)
+    return make_result(pages, phases, total_secs, peak_memory_kb(total, pages))
+
+
+# battle log pages: parser of lastlogs5.py (uni5) or lastlogs.py (uni4), and LLDb
+def bench_log_parser(pages: list, repeat: int, uni5: bool) -> dict:
+    if uni5:
+        parser = lastlogs5.PageParser()
+    else:
+        parser = lastlogs.PageParser()
+    log_id_counter = [0]
+
+    # returns parsed log values, or None for nonexistent log
+    def html_scan(page):
+        log_id_counter[0] += 1
+        if uni5:
+            parser.reset()
+            parser.parse_page_content(page)
+            parser.log_id = log_id_counter[0]
+            exists = not parser.is_nonexistent_log
+        else:
+            parser.parse(log_id_counter[0], page)
+            exists = parser.log_has_title and not parser.is_nonexistent_log
+        if not exists:
+            return None
+        return LogValues(parser)
+
+    # small batches, so that batch writes are within timed calls even for a small corpus
+    lldb = LLDb(':memory:', batch_size=10)
+
+    def db_write(log):
+        log_id_counter[0] += 1
+        log.log_id = log_id_counter[0]  # always a new log
+        lldb.store_log(log)
+
+    def total(page):
+        log = html_scan(page)
+        if log is not None:
+            db_write(log)
+
+    phases = {}
+    phases['html_scan'], logs = timed(html_scan, pages, repeat)
+    logs = [log for log in logs if log is not None]
+    phases['db_write'], unused = timed(db_write, logs, repeat)
+    total_secs, unused = timed(total, pages, repeat)
+    lldb.flush()
+    return make_result(pages, phases, total_secs, peak_memory_kb(total, pages))
+
+
+# copy of parsed log fields, as parser object is reused for the next page
+class LogValues:
+    FIELDS = ['log_id', 'log_time', 'attacker', 'defender', 'attacker_coords', 'defender_coords',
+              'total_loss', 'po_me', 'po_cry', 'win_me', 'win_cry', 'win_deit']
+
+    def __init__(self, parser):
+        for name in self.FIELDS:
+            setattr(self, name, getattr(parser, name))
+
+
+def make_result(pages: list, phases: dict, total_secs: float, peak_kb: float) -> dict:
+    num_pages = len(pages)
+    return {
+        'pages': num_pages,
+        'bytes': sum([len(page.encode('UTF-8')) for page in pages]),
+        'pages_per_sec': (num_pages / total_secs) if total_secs > 0 else 0,
+        'total_ms_per_page': 1000.0 * total_secs / num_pages,
+        'phases_ms_per_page': {name: 1000.0 * secs / num_pages for name, secs in phases.items()},
+        'peak_memory_kb': peak_kb
+    }
+
+
+# (benchmark name, pages corpus kind, function(pages, repeat))
+BENCHMARKS = [
+    ('GalaxyParser/uni4', 'galaxy_uni4', bench_galaxy_parser),
+    ('GalaxyParser/uni5', 'galaxy_uni5', bench_galaxy_parser),
+    ('XNGalaxyParser/uni5', 'galaxy_uni5', bench_site_galaxy_parser),
+    ('lastlogs.PageParser/uni4', 'log_uni4', lambda pages, repeat: bench_log_parser(pages, repeat, False)),
+    ('lastlogs5.PageParser/uni5', 'log_uni5', lambda pages, repeat: bench_log_parser(pages, repeat, True))
+]
+
+
+def get_code_version() -> str:
+    try:
+        out = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=BENCH_DIR,
+                                      stderr=subprocess.DEVNULL)
+        return out.decode('UTF-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def find_latest_results(results_dir: str, exclude: str=None):
+    if not os.path.isdir(results_dir):
+        return None
+    names = sorted([fn for fn in os.listdir(results_dir) if fn.endswith('.json')])
+    names = [fn for fn in names if os.path.join(results_dir, fn) != exclude]
+    if len(names) == 0:
+        return None
+    return os.path.join(results_dir, names[-1])
+
+
+def print_results(results: dict, old_results: dict=None):
+    for name, res in results['benchmarks'].items():
+        old_res = None
+        if old_results is not None:
+            old_res = old_results['benchmarks'].get(name)
+
+        def change_str(key, sub_key=None):
+            if old_res is None:
+                return ''
+            old_val = old_res.get(key)
+            new_val = res[key]
+            if sub_key is not None:
+                old_val = (old_val or {}).get(sub_key)
+                new_val = new_val[sub_key]
+            if not old_val:
+                return ''
+            return ' ({0:+.1f}%)'.format(100.0 * (new_val - old_val) / old_val)
+
+        print('{0}: {1} pages ({2} recorded), {3:.1f} pages/sec{4}, {5:.3f} ms/page, peak memory {6:.0f} KiB{7}'.format(
+            name, res['pages'], res.get('recorded_pages', 0), res['pages_per_sec'], change_str('pages_per_sec'),
+            res['total_ms_per_page'], res['peak_memory_kb'], change_str('peak_memory_kb')))
+        for phase, ms in res['phases_ms_per_page'].items():
+            print('    {0:<18} {1:8.3f} ms/page{2}'.format(phase, ms, change_str('phases_ms_per_page', phase)))
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark of XNova pages parsers on pages corpus. Results are \
+saved as JSON, and compared with the previous results.')
+    ap.add_argument('--fixtures-dir', nargs='?', default=os.path.join(BENCH_DIR, 'fixtures'),
+                    help='Pages corpus directory. Default: benchmark/fixtures')
+    ap.add_argument('--results-dir', nargs='?', default=os.path.join(BENCH_DIR, 'results'),
+                    help='Directory to save results JSON to. Default: benchmark/results')
+    ap.add_argument('--generate', nargs='?', default=None, const='50', type=int, metavar='NUM_PAGES',
+                    help='(Re)generate NUM_PAGES pages of every kind into corpus, with fixed random seed. \
+Done automatically if corpus is empty. Default: 50')
+    ap.add_argument('--record-from-cache', nargs='?', default=None, metavar='CACHE_DIR',
+                    help='Copy galaxy pages from pages cache (files storage, like ./cache/page) into corpus')
+    ap.add_argument('--record-kind', nargs='?', default='galaxy_uni4', choices=['galaxy_uni4', 'galaxy_uni5'],
+                    help='Corpus kind recorded pages are put to. Default: galaxy_uni4')
+    ap.add_argument('--repeat', nargs='?', default='5', type=int, metavar='NUM',
+                    help='Repeat every measurement NUM times, best time is taken. Default: 5')
+    ap.add_argument('--only', nargs='?', default=None, metavar='SUBSTR',
+                    help='Run only benchmarks whose name contains SUBSTR')
+    ap.add_argument('--compare', nargs='?', default=None, metavar='RESULTS_JSON',
+                    help='Results file to compare with. Default: the latest in results dir')
+    ap.add_argument('--no-save', action='store_true', help='Do not save results')
+    ns = ap.parse_args()
+
+    # parsers log every page, only measure parsing
+    for name in ('xnova.xn_parser_galaxy', 'xnova.lastlogs_utils', 'lastlogs', 'lastlogs5'):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+    if ns.record_from_cache is not None:
+        num = record_fixtures(ns.fixtures_dir, ns.record_from_cache, ns.record_kind)
+        logger.info('Recorded {0} pages from {1}'.format(num, ns.record_from_cache))
+    if ns.generate is not None:
+        num = generate_fixtures(ns.fixtures_dir, ns.generate)
+        logger.info('Generated {0} pages'.format(num))
+
+    results = {
+        'version': get_code_version(),
+        'time': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': ns.repeat,
+        'benchmarks': {}
+    }
+    for name, kind, bench_func in BENCHMARKS:
+        if (ns.only is not None) and (ns.only not in name):
+            continue
+        fixtures = load_fixtures(ns.fixtures_dir, kind)
+        if len(fixtures) == 0:
+            generate_fixtures(ns.fixtures_dir)
+            fixtures = load_fixtures(ns.fixtures_dir, kind)
+        pages = [page for fn, page in fixtures]
+        # real pages from cache, the rest are generated
+        num_recorded = len([fn for fn, page in fixtures if fn.startswith('rec_')])
+        logger.info('Running {0} on {1} pages ({2} recorded)...'.format(name, len(pages), num_recorded))
+        results['benchmarks'][name] = bench_func(pages, max(ns.repeat, 1))
+        results['benchmarks'][name]['recorded_pages'] = num_recorded
+
+    old_results = None
+    compare_fn = ns.compare
+    if compare_fn is None:
+        compare_fn = find_latest_results(ns.results_dir)
+    if compare_fn is not None:
+        with open(compare_fn, mode='rt', encoding='UTF-8') as f:
+            old_results = json.load(f)
+        print('Compared with {0} (version {1}):'.format(compare_fn, old_results.get('version')))
+    print_results(results, old_results)
+
+    if not ns.no_save:
+        os.makedirs(ns.results_dir, exist_ok=True)
+        fn = os.path.join(ns.results_dir, '{0}_{1}.json'.format(
+            time.strftime('%Y%m%d_%H%M%S', time.localtime(results['time'])), results['version']))
+        with open(fn, mode='wt', encoding='UTF-8') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+        logger.info('Results saved to {0}'.format(fn))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,13 @@
 #!/usr/bin/python3
+import os
 import sys
 import time
 import sqlite3
 import json
 import argparse
+import concurrent.futures
+import hashlib
+import operator
 import re
 # 3rd party, not used right here, but used by sub-modules anyway
 try:
@@ -12,30 +16,46 @@ except ImportError:
     print('python-requests is not installed? try "pip install requests" or something')
     print('  or apt-get install python3-requests :)')
     sys.exit(1)
+# optional, only needed for --js-fallback without Node.js: galaxy scripts are decoded natively
 try:
     import execjs
 except ImportError:
-    print('PyExecJS is not installed? try "pip install PyExecJS" or something')
-    print('   before that you need pip, apt-get install python3-pip')
-    print('   then pip-3 install pyexecjs')
-    sys.exit(1)
+    execjs = None
 
 from xnova import xn_logger
-from xnova.xn_auth import xnova_authorize
+from xnova.galaxy_db_schema import upgrade_galaxy_db, GALAXY_DB_SCHEMA_VERSION
+from xnova.galaxy_history import PlanetHistory
+from xnova.galaxy_search import GalaxyNamesIndex
+from xnova.galaxy_scan_planner import GalaxyScanPlanner
+from xnova.galaxy_scan_journal import ScanJournal
+from xnova.xn_identity_pool import IdentityPool
+from xnova.xn_js_worker import find_js_runtime, set_pool_size as set_js_pool_size
 from xnova.xn_page_cache import XNovaPageCache
 from xnova.xn_page_dnl import XNovaPageDownload
-from xnova.xn_parser_galaxy import GalaxyParser
+from xnova.xn_parser_galaxy import GalaxyParser, GalaxyScriptExtractor, parse_galaxy_page, is_galaxy_page
+from xnova.xn_retry import RetryPolicy
+from xnova.xn_scan_scheduler import ScanScheduler, TokenBucket
+from xnova.xn_session import XNovaSession
 
 ###############################################
 # configure some parameters
 user_agent = 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) \
 Chrome/45.0.2454.85 Safari/537.36'
 delay_between_requests_secs = 5
+num_scan_workers = 1  # parallel download/parse workers
+num_parse_processes = 0  # parse pages in a pool of processes, 0 - parse in scan workers threads
 # galaxy_range = (5, 5)  # debug, originally (1, 5)
 # system_range = (75, 75)  # debug, originally (1, 499)
 galaxy_range = (1, 5)
 system_range = (1, 499)
 max_cache_secs = 10 * 3600  # cache galaxy pages for 10 hours
+db_window_systems = 10  # write planets of this many systems in one DB transaction
+incremental_scan = False  # only fetch systems that are worth it, see GalaxyScanPlanner
+requests_budget = 0  # max network requests in incremental scan, 0 - unlimited
+stable_days = 7  # incremental scan skips systems that are empty and unchanged for this many days
+resume_scan = False  # continue last interrupted scan, from scan journal in DB
+history_days = 365  # keep planets change history for this many days, 0 - forever, -1 - do not record
+history_downsample_days = 30  # history older than this is merged to one event per planet field per day
 status_filename = 'galaxy_auto_parser.json'
 g_xnova_host = 'uni4.xnova.su'
 
@@ -46,8 +66,18 @@ logger = xn_logger.get('GAP', debug=True)
 g_page_cache = XNovaPageCache()
 g_page_dnl = XNovaPageDownload()
 g_parser = GalaxyParser()
-g_db = sqlite3.connect('galaxy.db')
+g_db = None  # sqlite3 connection to galaxy DB, opened in main()
+g_db_writer = None  # GalaxyDBWriter, created in main()
 g_got_from_cache = False
+g_js_fallback = False  # allow to use execjs for galaxy scripts native decoder cannot handle
+g_rate_limiter = TokenBucket.from_delay(delay_between_requests_secs)
+g_parse_pool = None  # ProcessPoolExecutor for pages parsing, if enabled
+g_page_hashes = {}  # (g, s) => hash of the page stored planets were parsed from
+g_session = None  # XNovaSession, if login and password are given
+g_identity_pool = None  # IdentityPool, if scanning with several accounts
+
+# fetch_galaxy_system() outcome: page is the same as last time, it was not parsed
+PAGE_UNCHANGED = 'unchanged'
 
 
 def int_(val):
@@ -78,233 +108,322 @@ def parse_range(val: str) -> tuple:
     return ret
 
 
-class GalaxyRow:
-    def __init__(self):
-        self.galaxy = 0
-        self.system = 0
-        self.position = 0  # position of planet in solar system
-        # planet info
-        self.planet_id = 0
-        self.planet_name = ''
-        self.planet_type = 0  # 1-planet, 5-base
-        self.planet_metal = 0
-        self.planet_crystal = 0
-        self.planet_destroyed = 0
-        self.planet_image = ''  # unused
-        # luna info
-        self.luna_id = 0
-        self.luna_name = ''
-        self.luna_diameter = 0
-        self.luna_destroyed = 0
-        self.luna_temp = 0  # unused
-        self.luna_parent_planet = 0  # unused
-        # user info
-        self.user_id = 0
-        self.user_name = ''
-        self.user_rank = 0
-        self.user_totalpoints = 0
-        self.user_authlevel = 0  # 0-normal, 3-admin
-        self.user_onlinetime = 0  # 0-active, 1-i, 2-Ii
-        self.user_banned = 0
-        self.user_ro = 0  # user vacation mode
-        self.user_race = 0  # 1 - confederation, 2 - bionic, 3 - cylon, 4 - ancients
-        self.user_image = ''  # unused
-        # ally info
-        self.ally_id = 0
-        self.ally_name = ''
-        self.ally_tag = ''
-        self.ally_members = 0  # member count
-        self.ally_web = ''  # unused, WTF is this? website URL?
-        # activity
-        self.last_active = 0  # unused
-
-    def from_row(self, gal, sys_, row):
+# planets table columns after (g, s, p), in table order: (column, key of decoded
+# galaxy script row, conversion function). For keys that uni5 names differently
+# there is a tuple (uni4 key, uni5 key)
+PLANETS_COLUMNS = [
+    ('planet_id', ('id_planet', 'planet_id'), int_),
+    ('planet_name', 'name', str_),
+    ('planet_type', 'planet_type', int_),  # 1-planet, 5-base
+    ('planet_metal', 'metal', int_),
+    ('planet_crystal', 'crystal', int_),
+    ('planet_destroyed', 'destruyed', int_),
+    ('luna_id', 'luna_id', int_),
+    ('luna_name', 'luna_name', str_),
+    ('luna_diameter', 'luna_diameter', int_),
+    ('luna_destroyed', 'luna_destruyed', int_),
+    ('user_id', 'user_id', int_),
+    ('user_name', 'username', str_),
+    ('user_rank', 'total_rank', int_),
+    ('user_totalpoints', 'total_points', int_),
+    ('user_authlevel', 'authlevel', int_),  # 0-normal, 3-admin
+    ('user_onlinetime', 'onlinetime', int_),  # 0-active, 1-i, 2-Ii
+    ('user_banned', ('banaday', 'banned'), int_),
+    ('user_ro', ('urlaubs_modus_time', 'vacation'), int_),  # user vacation mode
+    ('user_race', 'race', int_),  # 1 - confederation, 2 - bionic, 3 - cylon, 4 - ancients
+    ('ally_id', 'ally_id', int_),
+    ('ally_name', 'ally_name', str_),
+    ('ally_tag', 'ally_tag', str_),
+    ('ally_members', 'ally_members', int_)  # member count
+]
+
+# positions of planets table columns in db tuples
+PLANETS_COLUMN_INDEX = {column[0]: i + 3 for i, column in enumerate(PLANETS_COLUMNS)}
+# getter of (user_id, user_name, ally_id, ally_name, ally_tag) from db tuple, for GalaxyNamesIndex
+_names_getter = operator.itemgetter(*[PLANETS_COLUMN_INDEX[col] for col in
+                                      ('user_id', 'user_name', 'ally_id', 'ally_name', 'ally_tag')])
+
+# row variant (which of uni4 keys row has) => (getter of row values for PLANETS_COLUMNS,
+# list of (column type, conversion) for them)
+_row_mappings = {}
+
+
+def _get_row_mapping(row: dict) -> tuple:
+    variant = ('id_planet' in row, 'banaday' in row, 'urlaubs_modus_time' in row)
+    mapping = _row_mappings.get(variant)
+    if mapping is None:
+        uni4_keys = iter(variant)
+        keys = []
+        convs = []
+        for column, key, conv in PLANETS_COLUMNS:
+            if type(key) == tuple:
+                key = key[0] if next(uni4_keys) else key[1]
+            keys.append(key)
+            convs.append((int if conv is int_ else str, conv))
+        mapping = (operator.itemgetter(*keys), convs)
+        _row_mappings[variant] = mapping
+    return mapping
+
+
+def galaxy_rows_to_db_tuples(gal, sys_, rows: list) -> list:
+    """
+    Converts decoded galaxy script rows straight to planets table rows
+    :param gal: galaxy
+    :param sys_: solar system
+    :param rows: rows of galaxy script, None for empty positions
+    :return: list of tuples (g, s, p, ...) in planets table columns order, as
+             many as there are not None rows
+    """
+    gal = int_(gal)
+    sys_ = int_(sys_)
+    ret = []
+    for row in rows:
         if row is None:
-            return
-        self.galaxy = int_(gal)
-        self.system = int_(sys_)
-        self.position = int_(row['planet'])
-        # planet info
-        try:
-            self.planet_id = int_(row['id_planet'])  # uni4 mode
-        except KeyError:
-            self.planet_id = int_(row['planet_id'])  # uni5 has other key name
-        self.planet_name = str_(row['name'])
-        self.planet_type = int_(row['planet_type'])
-        self.planet_metal = int_(row['metal'])
-        self.planet_crystal = int_(row['crystal'])
-        self.planet_destroyed = int_(row['destruyed'])
-        self.planet_image = str_(row['image'])
-        # luna info
-        self.luna_id = int_(row['luna_id'])
-        self.luna_name = str_(row['luna_name'])
-        self.luna_diameter = int_(row['luna_diameter'])
-        self.luna_destroyed = int_(row['luna_destruyed'])
-        self.luna_temp = int_(row['luna_temp'])
-        self.luna_parent_planet = int_(row['parent_planet'])
-        # user info
-        self.user_id = int_(row['user_id'])
-        self.user_name = str_(row['username'])
-        self.user_rank = int_(row['total_rank'])
-        self.user_totalpoints = int_(row['total_points'])
-        self.user_authlevel = int_(row['authlevel'])
-        self.user_onlinetime = int_(row['onlinetime'])
-        try:
-            self.user_banned = int_(row['banaday'])
-        except KeyError:
-            self.user_banned = int_(row['banned'])  # again, uni5 mode
-        try:
-            self.user_ro = int_(row['urlaubs_modus_time'])
-        except KeyError:
-            self.user_ro = int_(row['vacation'])
-        self.user_race = int_(row['race'])
-        self.user_image = str_(row['user_image'])
-        # ally info
-        self.ally_id = int_(row['ally_id'])
-        self.ally_name = str_(row['ally_name'])
-        self.ally_tag = str_(row['ally_tag'])
-        self.ally_members = int_(row['ally_members'])
-        self.ally_web = str_(row['ally_web'])
-        # activity
-        self.last_active = int_(row['last_active'])
+            continue
+        getter, convs = _get_row_mapping(row)
+        values = getter(row)
+        # decoded JSON values mostly have column types already, then they are used as is
+        for val, (col_type, conv) in zip(values, convs):
+            if (val is not None) and (type(val) is not col_type):
+                values = tuple([val if (val is None) or (type(val) is col_type) else conv(val)
+                                for val, (col_type, conv) in zip(values, convs)])
+                break
+        ret.append((gal, sys_, int_(row['planet'])) + values)
+    return ret
 
 
 def check_database_tables():
-    cur = g_db.cursor()
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    rows = cur.fetchall()
-    existing_tables = list()
-    for row in rows:
-        existing_tables.append(row[0])
-    if 'planets' not in existing_tables:
-        logger.info('DB: Creating planets table...')
-        q = "CREATE TABLE planets( \
-            g INT, \
-            s INT, \
-            p INT, \
-            planet_id INT PRIMARY KEY, \
-            planet_name TEXT, \
-            planet_type INT, \
-            planet_metal INT, \
-            planet_crystal INT, \
-            planet_destroyed INT, \
-            luna_id INT, \
-            luna_name TEXT, \
-            luna_diameter INT, \
-            luna_destroyed INT, \
-            user_id INT, \
-            user_name TEXT, \
-            user_rank INT, \
-            user_totalpoints INT, \
-            user_authlevel INT, \
-            user_onlinetime INT, \
-            user_banned INT, \
-            user_ro INT, \
-            user_race INT, \
-            ally_id INT, \
-            ally_name TEXT, \
-            ally_tag TEXT, \
-            ally_members INT \
-            )"
-        cur.execute(q)
-        g_db.commit()
-        cur.close()
+    old_version = upgrade_galaxy_db(g_db)
+    if old_version < GALAXY_DB_SCHEMA_VERSION:
+        logger.info('DB: upgraded schema from version {0} to {1}'.format(old_version, GALAXY_DB_SCHEMA_VERSION))
     logger.info('DB init complete')
 
 
-def db_set_galaxy_row(r: GalaxyRow):
-    # gal, sys_, position,
-    # planet
-    # planet_id, planet_name, planet_type,
-    # planet_metal, planet_crystal, planet_destroyed,
-    # luna
-    # luna_id, luna_name, luna_diameter, luna_destroyed,
-    # user
-    # user_id, user_name, user_rank, user_totalpoints,
-    # user_authlevel, user_onlinetime, user_banned, user_ro, user_race,
-    # ally
-    # ally_id, ally_name, ally_tag, ally_members
-    # check if planet is already in DB
-    exists = True
-    cur = g_db.cursor()
-    cur.execute('SELECT planet_id FROM planets WHERE g=? AND s=? and p=?', (r.galaxy, r.system, r.position))
-    rows = cur.fetchall()
-    if len(rows) == 0:
-        exists = False
-    if exists:
-        q = 'UPDATE planets SET \
-            planet_id=?, planet_name=?, planet_type=?, planet_metal=?, planet_crystal=?, planet_destroyed=?, \
-            luna_id=?,  luna_name=?,  luna_diameter=?, luna_destroyed=?, \
-            user_id=?,  user_name=?,  user_rank=?, user_totalpoints=?, user_authlevel=?, user_onlinetime=?, \
-                        user_banned=?, user_ro=?, user_race=?, \
-            ally_id=?,  ally_name=?, ally_tag=?, ally_members=? \
-            WHERE (g=? AND s=? AND p=?)'
-        cur.execute(q, (
-            r.planet_id, r.planet_name, r.planet_type, r.planet_metal, r.planet_crystal, r.planet_destroyed,
-            r.luna_id, r.luna_name, r.luna_diameter, r.luna_destroyed,
-            r.user_id, r.user_name, r.user_rank, r.user_totalpoints, r.user_authlevel, r.user_onlinetime,
-            r.user_banned, r.user_ro, r.user_race,
-            r.ally_id, r.ally_name, r.ally_tag, r.ally_members,
-            r.galaxy, r.system, r.position))
-    else:
-        q = 'INSERT INTO planets VALUES (?,?,?, ?,?,?,?,?,?, ?,?,?,?, ?,?,?,?,?,?,?,?,?, ?,?,?,?)'
-        cur.execute(q, (
-            r.galaxy, r.system, r.position,
-            r.planet_id, r.planet_name, r.planet_type, r.planet_metal, r.planet_crystal, r.planet_destroyed,
-            r.luna_id, r.luna_name, r.luna_diameter, r.luna_destroyed,
-            r.user_id, r.user_name, r.user_rank, r.user_totalpoints, r.user_authlevel, r.user_onlinetime,
-            r.user_banned, r.user_ro, r.user_race,
-            r.ally_id, r.ally_name, r.ally_tag, r.ally_members))
-    g_db.commit()
-    cur.close()
+def log_overflow_row(gal, sys_, position, row):
+    logger.error('Got overflow error while processing a row at [{0}:{1}:{2}]:'.format(gal, sys_, position))
+    logger.error(str(row))
+    logger.error('Saving to overflow_error.json')
+    try:
+        row['coords'] = '[{0}:{1}:{2}]'.format(gal, sys_, position)
+        with open('overflow_error.json', mode='at', encoding='UTF-8') as f:
+            json.dump(row, f, indent=4, sort_keys=True)
+    except IOError:
+        pass
 
 
-def go_galaxy_system(gal, sys_):
+# hash of solar system contents as stored in DB, to detect changes
+def rows_hash(db_tuples: list) -> str:
+    return hashlib.sha1(json.dumps(db_tuples, ensure_ascii=False).encode('UTF-8')).hexdigest()
+
+
+# Collects parsed solar systems and writes them to planets table in batches:
+# all planets of a window of systems are written in one transaction, replacing
+# everything that was stored for these systems before (so planets that
+# disappeared from a system are deleted in the same transaction).
+# Also keeps systems_meta table: if system contents did not change since last
+# scan, only its metadata is updated, planets are not rewritten.
+# If journal (ScanJournal) is set, outcomes of systems are recorded in it,
+# in the same transaction. If history (PlanetHistory) is set, changes of
+# re-scanned systems are recorded in it, also in the same transaction.
+# If names_index (GalaxyNamesIndex) is set, names of written planets' players
+# and alliances are updated in it, too.
+class GalaxyDBWriter:
+    def __init__(self, db: sqlite3.Connection, window_systems=1):
+        self._db = db
+        self.window_systems = max(int(window_systems), 1)
+        self.journal = None
+        self.history = None
+        self.names_index = None
+        self._systems = []  # list of tuples (gal, sys_, db_tuples, rows, fetch_time, was_scanned)
+        self._meta = []  # list of tuples (gal, sys_, fetch_time, hash, num_planets, changed, page_hash)
+        self._outcomes = []  # list of tuples (gal, sys_, outcome, ts) for journal
+
+    def add_system(self, gal, sys_, rows: list, fetch_time: int=None, page_hash: str=None):
+        if fetch_time is None:
+            fetch_time = int(time.time())
+        db_tuples = galaxy_rows_to_db_tuples(gal, sys_, rows)
+        new_hash = rows_hash(db_tuples)
+        cur = self._db.cursor()
+        cur.execute('SELECT rows_hash FROM systems_meta WHERE g=? AND s=?', (gal, sys_))
+        meta_row = cur.fetchone()
+        cur.close()
+        changed = (meta_row is None) or (meta_row[0] != new_hash)
+        if changed:
+            # first scan of system is not a change of its planets
+            self._systems.append((gal, sys_, db_tuples, rows, fetch_time, meta_row is not None))
+        self._meta.append((gal, sys_, fetch_time, new_hash, len(db_tuples), changed, page_hash))
+        outcome = ScanJournal.OK if len(db_tuples) > 0 else ScanJournal.EMPTY
+        self._add_outcome(gal, sys_, outcome)
+
+    # system page is the same as the one its stored planets were parsed from:
+    # only mark system as scanned, planets are not touched
+    def add_unchanged(self, gal, sys_, fetch_time: int, page_hash: str):
+        if fetch_time is None:
+            fetch_time = int(time.time())
+        cur = self._db.cursor()
+        cur.execute('SELECT rows_hash, num_planets FROM systems_meta WHERE g=? AND s=?', (gal, sys_))
+        meta_row = cur.fetchone()
+        cur.close()
+        self._meta.append((gal, sys_, fetch_time, meta_row[0], meta_row[1], False, page_hash))
+        outcome = ScanJournal.OK if meta_row[1] > 0 else ScanJournal.EMPTY
+        self._add_outcome(gal, sys_, outcome)
+
+    # system was not processed: download or parse error
+    def add_failure(self, gal, sys_, outcome: str):
+        self._add_outcome(gal, sys_, outcome)
+
+    def _add_outcome(self, gal, sys_, outcome: str):
+        self._outcomes.append((gal, sys_, outcome, int(time.time())))
+        if len(self._outcomes) >= self.window_systems:
+            self.flush()
+
+    def flush(self):
+        if len(self._outcomes) == 0:
+            return
+        try:
+            with self._db:  # commits, or rolls back on exception
+                self._write(skip_bad_rows=False)
+        except OverflowError:
+            # some value does not fit into sqlite integer, find and skip bad rows
+            with self._db:
+                self._write(skip_bad_rows=True)
+        self._systems = []
+        self._meta = []
+        self._outcomes = []
+
+    def _write(self, skip_bad_rows: bool):
+        q_insert = 'INSERT OR REPLACE INTO planets VALUES (?,?,?, ?,?,?,?,?,?, ?,?,?,?, ?,?,?,?,?,?,?,?,?, ?,?,?,?)'
+        cur = self._db.cursor()
+        if self.history is not None:
+            for system in self._systems:
+                if system[5]:
+                    self.history.record_system(cur, system[0], system[1], system[2], system[4], skip_bad_rows)
+        cur.executemany('DELETE FROM planets WHERE g=? AND s=?',
+                        [(system[0], system[1]) for system in self._systems])
+        if not skip_bad_rows:
+            cur.executemany(q_insert, (db_tuple for system in self._systems for db_tuple in system[2]))
+        else:
+            for gal, sys_, db_tuples, rows, fetch_time, was_scanned in self._systems:
+                # db_tuples are made from not None rows, in the same order
+                for db_tuple, row in zip(db_tuples, [row for row in rows if row is not None]):
+                    try:
+                        cur.execute(q_insert, db_tuple)
+                    except OverflowError:
+                        log_overflow_row(gal, sys_, db_tuple[2], row)
+        cur.executemany('INSERT INTO systems_meta '
+                        ' (g, s, last_fetch, rows_hash, num_planets, num_scans, num_changes, last_change, page_hash) '
+                        ' VALUES (?1, ?2, ?3, ?4, ?5, 1, 1, ?3, ?7) '
+                        ' ON CONFLICT (g, s) DO UPDATE SET '
+                        '  last_fetch = MAX(last_fetch, ?3), rows_hash = ?4, num_planets = ?5, '
+                        '  num_scans = num_scans + (?3 > last_fetch), '
+                        '  num_changes = num_changes + ?6, '
+                        '  last_change = CASE WHEN ?6 THEN ?3 ELSE last_change END, '
+                        '  page_hash = ?7',
+                        [(meta[0], meta[1], meta[2], meta[3], meta[4], int(meta[5]), meta[6]) for meta in self._meta])
+        if self.names_index is not None:
+            self.names_index.update(cur, [_names_getter(db_tuple)
+                                          for system in self._systems for db_tuple in system[2]])
+        if self.journal is not None:
+            self.journal.record(cur, self._outcomes)
+        cur.close()
+
+
+def galaxy_page_url_path(gal, sys_):
+    if g_page_dnl.xnova_url.startswith('uni5'):
+        return 'galaxy/{0}/{1}/'.format(gal, sys_)
+    return '?set=galaxy&r=3&galaxy={0}&system={1}'.format(gal, sys_)  # uni4 path
+
+
+# work unit of galaxy scan: get one solar system page (from cache or from network)
+# and parse it. Can be run from scan worker threads, so it uses only passed
+# downloader and parser objects, and does not touch DB.
+# returns tuple (outcome, rows, got_from_cache, page_hash), outcome is one of
+# ScanJournal outcomes or PAGE_UNCHANGED, rows is None on download or parse
+# failure, and for unchanged pages, which are not parsed at all
+def fetch_galaxy_system(gal, sys_, page_dnl: XNovaPageDownload, parser: GalaxyParser):
     # try lo get page from cache
-    global g_got_from_cache
+    got_from_cache = True
     page_name = 'galaxy_{0}_{1}'.format(gal, sys_)
     content = g_page_cache.get_page(page_name, max_cache_secs)
     if content is None:
-        # not in cache, or invalid, try to download
-        if g_page_dnl.xnova_url.startswith('uni5'):
-            url_path = 'galaxy/{0}/{1}/'.format(gal, sys_)
-        else:  # uni4 path
-            url_path = '?set=galaxy&r=3&galaxy={0}&system={1}'.format(gal, sys_)
-        content = g_page_dnl.download_url_path(url_path)
+        # not in cache, or invalid, try to download; if we have an old copy,
+        # ask server to send page only if it was modified since.
+        # downloader obeys requests rate limit and retries transient errors
+        # page is read only up to the end of galaxy script, the rest is not needed
+        dnl_kwargs = {'validators': g_page_cache.get_page_meta(page_name),
+                      'stream_consumer_factory': GalaxyScriptExtractor}
+        if g_identity_pool is not None:
+            # one of accounts, with its own session, proxy and rate limit
+            content, page_dnl = g_identity_pool.download(galaxy_page_url_path(gal, sys_), is_galaxy_page,
+                                                         **dnl_kwargs)
+            if page_dnl is None:
+                return ScanJournal.HTTP_ERROR, None, False, None
+        elif g_session is not None:
+            # logs in again if session has ended
+            content = g_session.download(page_dnl, galaxy_page_url_path(gal, sys_), is_galaxy_page,
+                                         **dnl_kwargs)
+        else:
+            content = page_dnl.download_url_path(galaxy_page_url_path(gal, sys_), **dnl_kwargs)
+        if page_dnl.not_modified:
+            g_page_cache.touch_page(page_name)
+            content = g_page_cache.get_page(page_name)
+        elif content is not None:
+            g_page_cache.set_page(page_name, content, page_dnl.validators)
         if content is None:
-            return False
-        g_page_cache.set_page(page_name, content)
-        g_got_from_cache = False
+            return ScanJournal.HTTP_ERROR, None, False, None
+        got_from_cache = False
+    # servers without ETag/Last-Modified support: same page body, no need to parse it again
+    page_hash = hashlib.sha1(content.encode('UTF-8')).hexdigest()
+    if g_page_hashes.get((gal, sys_)) == page_hash:
+        return PAGE_UNCHANGED, None, got_from_cache, page_hash
+    if g_parse_pool is not None:
+        # parse in another process; this thread just waits, other threads go on downloading
+        rows = g_parse_pool.submit(parse_galaxy_page, content, parser.js_fallback).result()
     else:
-        g_got_from_cache = True
-    g_parser.clear()
-    g_parser.parse_page_content(content)
-    if g_parser.script_body != '':
-        g_parser.unscramble_galaxy_script()
-    rows = g_parser.galaxy_rows
-    if len(rows) > 0:
-        # logger.info('{0} planets in [{1}:{2}:]'.format(len(rows), gal, sys_))
-        for row in rows:
-            if row is None:
-                continue
-            galaxy_row = GalaxyRow()
-            galaxy_row.from_row(gal, sys_, row)
-            try:
-                db_set_galaxy_row(galaxy_row)
-            except OverflowError:
-                logger.error('Got overflow error while processing a row at [{0}:{1}:{2}]:'.format(
-                    gal, sys_, galaxy_row.position))
-                logger.error(str(row))
-                logger.error('Saving to overflow_error.json')
-                try:
-                    row['coords'] = '[{0}:{1}:{2}]'.format(gal, sys_, galaxy_row.position)
-                    with open('overflow_error.json', mode='at', encoding='UTF-8') as f:
-                        json.dump(row, f, indent=4, sort_keys=True)
-                except IOError:
-                    pass
-    else:
-        logger.warn('no planets in [{0}:{1}:]'.format(gal, sys_))
+        rows = parse_galaxy_page(content, parser.js_fallback, parser)
+    if rows is None:
+        logger.error('cannot get galaxy rows from page for [{0}:{1}:]'.format(gal, sys_))
+        return ScanJournal.PARSE_ERROR, None, got_from_cache, page_hash
+    outcome = ScanJournal.OK
+    if len([row for row in rows if row is not None]) == 0:
+        outcome = ScanJournal.EMPTY
+    return outcome, rows, got_from_cache, page_hash
+
+
+# save fetch_galaxy_system() result to DB, must be called from main thread;
+# returns False if system could not be fetched
+def store_galaxy_result(gal, sys_, outcome, rows, page_hash):
+    # page was fetched from server when it was put into cache
+    fetch_time = g_page_cache.get_page_mtime('galaxy_{0}_{1}'.format(gal, sys_))
+    if outcome == PAGE_UNCHANGED:
+        g_db_writer.add_unchanged(gal, sys_, fetch_time, page_hash)
         return True
+    if rows is None:
+        g_db_writer.add_failure(gal, sys_, outcome)
+        return False
+    if len(rows) == 0:
+        logger.warn('no planets in [{0}:{1}:]'.format(gal, sys_))
+    g_db_writer.add_system(gal, sys_, rows, fetch_time, page_hash)
+    g_page_hashes[(gal, sys_)] = page_hash  # stored planets are parsed from this page now
+    return True
+
+
+# hashes of pages that planets stored in DB were parsed from, (g, s) => hash
+def load_page_hashes() -> dict:
+    cur = g_db.cursor()
+    cur.execute('SELECT g, s, page_hash FROM systems_meta WHERE page_hash IS NOT NULL')
+    ret = {(row[0], row[1]): row[2] for row in cur.fetchall()}
+    cur.close()
+    return ret
+
+
+# g_page_hashes must be loaded once before scan, see go()
+def go_galaxy_system(gal, sys_):
+    global g_got_from_cache
+    outcome, rows, g_got_from_cache, page_hash = fetch_galaxy_system(gal, sys_, g_page_dnl, g_parser)
+    ret = store_galaxy_result(gal, sys_, outcome, rows, page_hash)
+    g_db_writer.flush()
+    return ret
 
 
 def output_progress(ts_start, num, total, gal, sys_):
@@ -339,29 +458,201 @@ def output_progress(ts_start, num, total, gal, sys_):
         pass
 
 
+# systems are parsed and loaded to rebuilt DB in chunks of this size
+REBUILD_CHUNK_SYSTEMS = 256
+
+
+# parses cached pages of a chunk of systems, returns list of rows lists (None for failed)
+def parse_cached_systems(units: list) -> list:
+    contents = [g_page_cache.get_page('galaxy_{0}_{1}'.format(unit[0], unit[1])) for unit in units]
+    to_parse = [content for content in contents if content is not None]
+    if g_parse_pool is not None:
+        parsed = g_parse_pool.map(parse_galaxy_page, to_parse, [g_js_fallback] * len(to_parse), chunksize=16)
+    else:
+        parsed = (parse_galaxy_page(content, g_js_fallback, g_parser) for content in to_parse)
+    parsed = iter(parsed)
+    return [(next(parsed) if content is not None else None) for content in contents]
+
+
+# Offline rebuild of galaxy DB from all cached galaxy pages, no network requests:
+# pages are parsed (in parse processes, if enabled) and bulk-loaded into a new
+# DB file, which then atomically replaces the old one. Cache lifetime is ignored.
+# Systems that have no usable cached page keep their planets from the old DB,
+# as do systems metadata counters and scans journal.
+# Old DB is only read, and it is replaced by rename, so its readers are never
+# blocked: already open connections keep reading old file, new ones see new file.
+def rebuild_db_from_cache(db_filename: str):
+    page_re = re.compile(r'^galaxy_(\d+)_(\d+)$')
+    units = []
+    for page_name in g_page_cache.list_page_names('galaxy_'):
+        m = page_re.match(page_name)
+        if m is not None:
+            units.append((int(m.group(1)), int(m.group(2))))
+    units.sort()
+    logger.info('Rebuilding {0} from {1} cached galaxy pages'.format(db_filename, len(units)))
+    ts_start = time.time()
+    tmp_filename = db_filename + '.rebuild'
+    for fn in (tmp_filename, tmp_filename + '-journal'):
+        if os.path.exists(fn):
+            os.remove(fn)
+    new_db = sqlite3.connect(tmp_filename)
+    # new file is not used by anyone until it is renamed, if we crash
+    # it is just rebuilt again, so no need in journal file and fsyncs;
+    # in-memory journal is still needed to roll back failed writer chunk
+    # (OverflowError), before it is written again without bad rows
+    new_db.execute('PRAGMA journal_mode=MEMORY')
+    new_db.execute('PRAGMA synchronous=OFF')
+    upgrade_galaxy_db(new_db)
+    writer = GalaxyDBWriter(new_db, REBUILD_CHUNK_SYSTEMS)
+    writer.names_index = GalaxyNamesIndex(new_db)
+    num_failed = 0
+    for i in range(0, len(units), REBUILD_CHUNK_SYSTEMS):
+        chunk = units[i:i + REBUILD_CHUNK_SYSTEMS]
+        for unit, rows in zip(chunk, parse_cached_systems(chunk)):
+            if rows is None:
+                logger.warn('cannot get galaxy rows from cached page for [{0}:{1}:], skipped'.format(
+                    unit[0], unit[1]))
+                num_failed += 1
+                continue
+            fetch_time = g_page_cache.get_page_mtime('galaxy_{0}_{1}'.format(unit[0], unit[1]))
+            writer.add_system(unit[0], unit[1], rows, fetch_time)
+        writer.flush()
+        logger.info('[{0}/{1}] systems loaded'.format(min(i + REBUILD_CHUNK_SYSTEMS, len(units)), len(units)))
+    # merge what cannot be rebuilt from cache from the old DB
+    if os.path.exists(db_filename):
+        new_db.execute('ATTACH DATABASE ? AS old_db', (db_filename, ))
+        with new_db:
+            # systems not found in cache: keep old planets and metadata
+            new_db.execute('INSERT OR IGNORE INTO planets SELECT * FROM old_db.planets '
+                           ' WHERE (g, s) NOT IN (SELECT g, s FROM systems_meta)')
+            # rebuilt systems: keep scans statistics, used by incremental scan planner
+            new_db.execute('UPDATE systems_meta SET '
+                           '  last_fetch = MAX(systems_meta.last_fetch, o.last_fetch), '
+                           '  num_scans = MAX(o.num_scans, 1), '
+                           '  num_changes = o.num_changes + (o.rows_hash IS NOT systems_meta.rows_hash), '
+                           '  last_change = CASE WHEN o.rows_hash IS systems_meta.rows_hash '
+                           '   THEN o.last_change ELSE systems_meta.last_fetch END '
+                           ' FROM old_db.systems_meta AS o WHERE o.g = systems_meta.g AND o.s = systems_meta.s')
+            new_db.execute('INSERT OR IGNORE INTO systems_meta SELECT * FROM old_db.systems_meta')
+            new_db.execute('INSERT INTO scans SELECT * FROM old_db.scans')
+            new_db.execute('INSERT INTO scan_units SELECT * FROM old_db.scan_units')
+            new_db.execute('INSERT INTO planet_history SELECT * FROM old_db.planet_history')
+        new_db.execute('DETACH DATABASE old_db')
+    # planets copied from old DB did not pass through writer
+    writer.names_index.rebuild()
+    new_db.execute('ANALYZE')
+    new_db.commit()
+    num_planets = new_db.execute('SELECT COUNT(*) FROM planets').fetchone()[0]
+    new_db.close()
+    os.replace(tmp_filename, db_filename)
+    logger.info('Rebuilt {0}: {1} systems from cache ({2} failed), {3} planets total, in {4:0.1f}s'.format(
+        db_filename, len(units) - num_failed, num_failed, num_planets, time.time() - ts_start))
+
+
+# scan worker thread context: each worker has its own downloader session and parser
+def scan_worker_init():
+    parser = GalaxyParser()
+    parser.js_fallback = g_js_fallback
+    page_dnl = g_page_dnl.clone()
+    page_dnl.rate_limiter = g_rate_limiter
+    return page_dnl, parser
+
+
 def go():
     num_galaxies = int(galaxy_range[1]) - int(galaxy_range[0]) + 1
     num_systems = int(system_range[1]) - int(system_range[0]) + 1
     total_requests = num_galaxies * num_systems
     num_requests = 0
 
-    global g_got_from_cache, g_xnova_host
+    global g_got_from_cache, g_xnova_host, g_page_hashes
 
     logger.info('Using XNova host: {0}'.format(g_xnova_host))
+
+    journal = ScanJournal(g_db)
+    units = None
+    if resume_scan:
+        scan_id = journal.find_unfinished_scan()
+        if scan_id is not None:
+            units = journal.resume_scan(scan_id)
+            total_requests = len(units)
+        else:
+            logger.info('No unfinished scan to resume, starting new scan')
+    if units is None:
+        units = []
+        for gal in range(int(galaxy_range[0]), int(galaxy_range[1]) + 1):
+            for sys_ in range(int(system_range[0]), int(system_range[1]) + 1):
+                units.append((gal, sys_))
+        if incremental_scan:
+            planner = GalaxyScanPlanner(g_db, g_page_cache, max_cache_secs)
+            planner.stable_secs = stable_days * 24 * 3600
+            units = planner.plan(units, requests_budget)
+            total_requests = len(units)
+        journal.start_scan(units)
+    g_db_writer.journal = journal
+    g_db_writer.names_index = GalaxyNamesIndex(g_db)
+    history = None
+    if history_days >= 0:
+        history = PlanetHistory(g_db)
+        history.retention_secs = history_days * 24 * 3600
+        history.downsample_secs = history_downsample_days * 24 * 3600
+        g_db_writer.history = history
+    g_page_hashes = load_page_hashes()
     logger.info('Start scanning galaxies {0}, systems {1}, total {2} requests'.format(
         galaxy_range, system_range, total_requests))
+    logger.info('Using {0} scan workers, requests rate limit: {1:0.2f}/sec'.format(
+        num_scan_workers, g_rate_limiter.rate))
+    if g_identity_pool is not None:
+        identities = [identity for identity in g_identity_pool.identities if not identity.disabled]
+        logger.info('Using {0} identities, requests rate limit: {1:0.2f}/sec total'.format(
+            len(identities), sum([identity.rate_limiter.rate for identity in identities])))
+
+    def work_func(ctx, unit):
+        page_dnl, parser = ctx
+        return fetch_galaxy_system(unit[0], unit[1], page_dnl, parser)
+
+    def result_func(unit, result):
+        global g_got_from_cache
+        nonlocal num_requests
+        outcome = ScanJournal.PARSE_ERROR  # worker crashed, most likely on page parsing
+        rows = None
+        page_hash = None
+        g_got_from_cache = False
+        if result is not None:
+            outcome, rows, g_got_from_cache, page_hash = result
+        store_galaxy_result(unit[0], unit[1], outcome, rows, page_hash)
+        num_requests += 1
+        output_progress(ts_start, num_requests, total_requests, unit[0], unit[1])
 
     ts_start = time.time()
-    for gal in range(int(galaxy_range[0]), int(galaxy_range[1]) + 1):
-        for sys_ in range(int(system_range[0]), int(system_range[1]) + 1):
-            go_galaxy_system(gal, sys_)
-            num_requests += 1
-            output_progress(ts_start, num_requests, total_requests, gal, sys_)
-            if not g_got_from_cache:
-                time.sleep(delay_between_requests_secs)
+    num_threads = num_scan_workers
+    if g_parse_pool is not None:
+        # keep all parser processes busy; downloads are limited by rate limiter anyway
+        num_threads = max(num_scan_workers, 2 * num_parse_processes)
+    if g_identity_pool is not None:
+        # at least one request in progress for each account
+        num_threads = max(num_threads, len(g_identity_pool))
+    scheduler = ScanScheduler(work_func, num_threads, scan_worker_init)
+    try:
+        scheduler.run(units, result_func)
+    finally:
+        g_db_writer.flush()  # write the last, incomplete window
+    journal.finish_scan()
+    if history is not None:
+        logger.info('Planets history: {0} change events recorded'.format(history.num_events))
+        history.maintain()
+    g_db_writer.names_index.prune()
+    logger.info('Network: {0}'.format(g_page_dnl.stats))
+    if g_identity_pool is not None:
+        for identity in g_identity_pool.identities:
+            logger.info('Identity {0}'.format(str(identity)))
 
 
 def list_js_runtimes():
+    if execjs is None:
+        print('PyExecJS is not installed? try "pip install PyExecJS" or something')
+        print('   before that you need pip, apt-get install python3-pip')
+        print('   then pip-3 install pyexecjs')
+        sys.exit(1)
     # AttributeError: module 'execjs' has no attribute 'available_runtimes'
     try:
         ajsr = execjs.available_runtimes()
@@ -385,6 +676,14 @@ def list_js_runtimes():
     sys.exit(0)
 
 
+def init_page_cache(xnova_uni: str, storage_type: str):
+    # for uni5 use different cache directory not to overlap with uni4's dir
+    if xnova_uni == 'uni5':
+        g_page_cache.set_cache_basedir('./cache5')
+    g_page_cache.set_storage_type(storage_type)
+    g_page_cache.load_from_disk_cache(clean=True)
+
+
 def main():
     # parse command line
     ap = argparse.ArgumentParser(description='XNova galaxy scanner/parser. All arguments '
@@ -394,6 +693,17 @@ def main():
                     help='XNova universe, for example: uni5. Default: uni4')
     ap.add_argument('--delay', nargs='?', default='5', type=int, metavar='DELAY_SEC',
                     help='delay between requests, in seconds. Default: 5 sec.')
+    ap.add_argument('--rate', nargs='?', default=None, type=float, metavar='REQ_PER_SEC',
+                    help='global limit of network requests per second, shared by all workers. \
+Overrides --delay. Default: 1/DELAY_SEC.')
+    ap.add_argument('--retries', nargs='?', default='4', type=int, metavar='NUM',
+                    help='max number of attempts for each request on transient errors (timeouts, \
+connection errors, HTTP 5xx/429), with exponential backoff. Default: 4')
+    ap.add_argument('--workers', nargs='?', default='1', type=int, metavar='NUM',
+                    help='number of parallel scan workers. Default: 1')
+    ap.add_argument('--parse-processes', nargs='?', default='0', type=int, metavar='NUM',
+                    help='parse pages in a pool of NUM processes, to use several CPU cores. \
+Default: 0 (parse in scan workers)')
     ap.add_argument('--galaxy-range', nargs='?', default='1,5', type=parse_range, metavar='FROM,TO',
                     help='range of galaxies to scan, in form: "From,To". Default: 1,5')
     ap.add_argument('--system-range', nargs='?', default='1,499', type=parse_range, metavar='FROM,TO',
@@ -403,16 +713,63 @@ def main():
 --galaxy-range and --system-range options.')
     ap.add_argument('--cache-lifetime', nargs='?', default='36000', type=int, metavar='CACHE_LIFETIME_SEC',
                     help='cache expiration timeout, in seconds. Default is 10 hours (36000)')
+    ap.add_argument('--cache-storage', nargs='?', default='files', choices=['files', 'sqlite'],
+                    help='How to store cached pages: "files" - plain file per page in cache/page/, \
+"sqlite" - all pages compressed in one file cache/pages.db. Default: files')
+    ap.add_argument('--compact-cache', action='store_true',
+                    help='Compact pages cache storage (free unused space) and exit.')
+    ap.add_argument('--upgrade-db', action='store_true',
+                    help='Upgrade galaxy DB schema (tables, indexes, search index) to the current version \
+and exit. Scan does it too, site and other readers do not.')
+    ap.add_argument('--rebuild-from-cache', action='store_true',
+                    help='Rebuild galaxy DB from all cached galaxy pages without any network requests, \
+then replace DB file atomically, and exit. Cache lifetime is ignored.')
+    ap.add_argument('--incremental', action='store_true',
+                    help='Incremental rescan: download only systems that are likely changed, most \
+valuable (often changing, with active players) first. Systems empty and unchanged for --stable-days \
+are skipped.')
+    ap.add_argument('--budget', nargs='?', default='0', type=int, metavar='NUM_REQUESTS',
+                    help='Max number of network requests in incremental scan. Default: 0 (no limit)')
+    ap.add_argument('--stable-days', nargs='?', default='7', type=int, metavar='DAYS',
+                    help='Incremental scan skips systems that are empty and unchanged for this \
+many days. Default: 7')
+    ap.add_argument('--resume', action='store_true',
+                    help='Continue the last interrupted scan: skip systems that are already done, \
+retry failed ones. Range and incremental options are ignored when there is a scan to resume.')
+    ap.add_argument('--history-days', nargs='?', default='365', type=int, metavar='DAYS',
+                    help='Keep planets change history (table planet_history: owner, moon, name, \
+activity, vacation changes...) for this many days, 0 - forever, -1 - do not record history. Default: 365')
+    ap.add_argument('--history-downsample-days', nargs='?', default='30', type=int, metavar='DAYS',
+                    help='Planets history older than this many days is merged to at most one event \
+per planet field per day, 0 - do not merge. Default: 30')
     ap.add_argument('--db-filename', nargs='?', default='galaxy.db',
                     help='Name of sqlite3 db file to store galaxy data. Default is "galaxy.db"')
+    ap.add_argument('--db-window', nargs='?', default='10', type=int, metavar='NUM_SYSTEMS',
+                    help='Number of solar systems to write to DB in one transaction. Default: 10')
     ap.add_argument('--status-filename', nargs='?', default='galaxy_auto_parser.json',
                     help='File name where scan progress will be written in JSON format. Default \
 is "galaxy_auto_parser.json". JSON output example is: {"done": 1, "total": 10}.')
     ap.add_argument('--cookies-filename', nargs='?', default='./cache/cookies.json',
                     help='Name of JSON file with cookies used to access site. \
 Default is "./cache/cookies.json". Ignored if --login and --password are given and auth was OK')
+    ap.add_argument('--session-filename', nargs='?', default='./cache/session.json',
+                    help='File where login session (cookies with expiry time) is kept when --login and \
+--password are given, shared with other scripts. Login is done only when it has no valid cookies, \
+and again if session ends during scan. Default is "./cache/session.json"')
+    ap.add_argument('--identities', nargs='?', default=None, metavar='CONFIG',
+                    help='Scan with several accounts at once, each with its own session, proxy and \
+rate limit, described in CONFIG file (net.ini-style, section per account with login, password and \
+optional proxy, delay or rate, user_agent). Requests are shared fairly between healthy accounts. \
+Overrides --login and --password. Default: none')
     ap.add_argument('--list-js-runtimes', action='store_true',
                     help='List available detected JavaScript runtimes and exit.')
+    ap.add_argument('--js-fallback', action='store_true',
+                    help='Use JavaScript runtime for galaxy scripts that built-in decoder cannot handle: \
+long-lived Node.js worker processes if Node.js is installed, else PyExecJS (slow, spawns a JS process \
+for each page).')
+    ap.add_argument('--js-workers', nargs='?', default='1', type=int, metavar='NUM',
+                    help='Number of Node.js worker processes for --js-fallback, in each parse process. \
+Default: 1')
     # NEW: explicitly set login/password via command-line arguments
     ap.add_argument('--login', nargs='?', default='your@email.com',
                     help='Login to use to authorize in XNova game')
@@ -422,13 +779,34 @@ Default is "./cache/cookies.json". Ignored if --login and --password are given a
     ns = ap.parse_args()
 
     global g_db, status_filename, galaxy_range, system_range, max_cache_secs, \
-        delay_between_requests_secs, g_xnova_host
+        delay_between_requests_secs, g_xnova_host, num_scan_workers, g_rate_limiter, g_js_fallback, \
+        g_db_writer, db_window_systems, incremental_scan, requests_budget, stable_days, resume_scan, \
+        num_parse_processes, g_parse_pool, g_session, g_identity_pool, history_days, history_downsample_days
 
     # apply parsed arguments
     xnova_uni = ns.uni
     g_xnova_host = xnova_uni + '.xnova.su'
     g_db = sqlite3.connect(ns.db_filename)
+    db_window_systems = max(ns.db_window, 1)
+    g_db_writer = GalaxyDBWriter(g_db, db_window_systems)
+    incremental_scan = ns.incremental
+    requests_budget = max(ns.budget, 0)
+    stable_days = ns.stable_days
+    resume_scan = ns.resume
+    history_days = ns.history_days
+    history_downsample_days = ns.history_downsample_days
+    num_parse_processes = max(ns.parse_processes, 0)
     delay_between_requests_secs = ns.delay
+    if ns.rate is not None:
+        g_rate_limiter = TokenBucket(ns.rate)
+    else:
+        g_rate_limiter = TokenBucket.from_delay(delay_between_requests_secs)
+    num_scan_workers = max(ns.workers, 1)
+    # long scan: do not hang on a request, retry transient errors, pause while server is down
+    g_page_dnl.timeout = 60
+    g_page_dnl.retry_policy = RetryPolicy(max_attempts=ns.retries)
+    g_page_dnl.use_circuit_breaker = True
+    g_page_dnl.rate_limiter = g_rate_limiter
     max_cache_secs = ns.cache_lifetime
     status_filename = ns.status_filename
     galaxy_range = ns.galaxy_range
@@ -439,10 +817,63 @@ Default is "./cache/cookies.json". Ignored if --login and --password are given a
     cookies_filename = ns.cookies_filename
     if ns.list_js_runtimes:
         list_js_runtimes()
+    g_js_fallback = ns.js_fallback
+    g_parser.js_fallback = g_js_fallback
+    set_js_pool_size(ns.js_workers)
+    if g_js_fallback and (find_js_runtime() is None) and (execjs is None):
+        logger.warn('Neither Node.js nor PyExecJS is installed, --js-fallback will not work')
+
+    if ns.compact_cache:
+        init_page_cache(xnova_uni, ns.cache_storage)
+        g_page_cache.compact()
+        g_page_cache.close()
+        logger.info('Pages cache compacted')
+        sys.exit(0)
+
+    if ns.upgrade_db:
+        check_database_tables()
+        g_db.close()
+        sys.exit(0)
+
+    if ns.rebuild_from_cache:
+        init_page_cache(xnova_uni, ns.cache_storage)
+        check_database_tables()  # old DB is merged into rebuilt one, it must have current schema
+        g_db.close()
+        if num_parse_processes > 0:
+            g_parse_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_parse_processes, initializer=set_js_pool_size, initargs=(ns.js_workers, ))
+        try:
+            rebuild_db_from_cache(ns.db_filename)
+        finally:
+            if g_parse_pool is not None:
+                g_parse_pool.shutdown()
+        g_page_cache.close()
+        sys.exit(0)
 
     have_login = False
-    if (ns.login != 'your@email.com') and (ns.password != 'your_secret_password'):
-        cookies_dict = xnova_authorize(g_xnova_host, ns.login, ns.password)
+    if ns.identities is not None:
+        g_page_dnl.set_useragent(user_agent)
+        g_page_dnl.xnova_url = g_xnova_host
+        g_identity_pool = IdentityPool()
+        try:
+            g_identity_pool.load_from_config(ns.identities, g_rate_limiter.rate)
+        except IOError as ioe:
+            logger.error(str(ioe))
+            sys.exit(1)
+        num_ready = g_identity_pool.login_all(g_page_dnl, ns.session_filename)
+        if num_ready == 0:
+            logger.error('Failed to authorize in XNova with any of {0} identities!\n'.format(
+                len(g_identity_pool)))
+            sys.exit(1)
+        have_login = True
+        logger.info('Login to XNova OK with {0} of {1} identities'.format(num_ready, len(g_identity_pool)))
+        # global limit is not used, every identity obeys its own
+        g_rate_limiter = TokenBucket(0)
+        g_page_dnl.rate_limiter = None
+    elif (ns.login != 'your@email.com') and (ns.password != 'your_secret_password'):
+        # saved session is reused while its cookies are valid, login only if needed
+        g_session = XNovaSession(g_xnova_host, ns.login, ns.password, ns.session_filename)
+        cookies_dict = g_session.get_cookies()
         if cookies_dict is None:
             logger.error('Failed to authorize in XNova!\n')
             sys.exit(1)
@@ -454,10 +885,7 @@ Default is "./cache/cookies.json". Ignored if --login and --password are given a
                                          json_filename=cookies_filename)
 
     # init globals
-    # for uni5 use different cache directory not to overlap with uni4's dir
-    if xnova_uni == 'uni5':
-        g_page_cache.set_cache_basedir('./cache5')
-    g_page_cache.load_from_disk_cache(clean=True)
+    init_page_cache(xnova_uni, ns.cache_storage)
     g_page_dnl.set_useragent(user_agent)
     g_page_dnl.xnova_url = g_xnova_host  # set host to use
     if not have_login:
@@ -469,8 +897,17 @@ Default is "./cache/cookies.json". Ignored if --login and --password are given a
             sys.exit(1)
     logger.debug('Helpers init complete')
     check_database_tables()
-    go()
+    if num_parse_processes > 0:
+        g_parse_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_parse_processes, initializer=set_js_pool_size, initargs=(ns.js_workers, ))
+        logger.info('Parsing pages in {0} processes'.format(num_parse_processes))
+    try:
+        go()
+    finally:
+        if g_parse_pool is not None:
+            g_parse_pool.shutdown()
     g_db.close()
+    g_page_cache.close()
     logger.info('All job done, exiting')
 
 
@@ -240,20 +240,22 @@ def main():
     # go into the loop
     pd = PageDownloader()
     pp = PageParser()
-    while True:
-        html_text = pd.download_log_html(llid)
-        pp.parse(llid, html_text)
-        if not pp.log_has_title:
-            num_failures += 1
-            if num_failures >= max_failures:
-                logger.warn('{0} of {1} max failures, ending loop'.format(num_failures, max_failures))
-                exitcode = 1
-                break
-        if (pp.log_has_title) and (not pp.is_nonexistent_log):
-            db.store_log(pp)
-            new_logs_added += 1
-        llid += 1  # move and try next log ID
-
+    try:
+        while True:
+            html_text = pd.download_log_html(llid)
+            pp.parse(llid, html_text)
+            if not pp.log_has_title:
+                num_failures += 1
+                if num_failures >= max_failures:
+                    logger.warn('{0} of {1} max failures, ending loop'.format(num_failures, max_failures))
+                    exitcode = 1
+                    break
+            if (pp.log_has_title) and (not pp.is_nonexistent_log):
+                db.store_log(pp)
+                new_logs_added += 1
+            llid += 1  # move and try next log ID
+    finally:
+        db.close()  # write the last batch, also on Ctrl+C or error
     logger.info('{0} total new logs were added to database.'.format(new_logs_added))
     logger.info('{0}/{1} failures happened.'.format(num_failures, max_failures))
     sys.exit(exitcode)
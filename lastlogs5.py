@@ -7,10 +7,15 @@ import logging
 import time
 
 from xnova import xn_logger
-from xnova.xn_auth import xnova_authorize
 from xnova.xn_page_dnl import XNovaPageDownload
+from xnova.xn_retry import RetryPolicy
+from xnova.xn_scan_scheduler import TokenBucket
+from xnova.xn_session import XNovaSession
 from xnova.xn_parser import XNParserBase, get_tag_classes
 
+from xnova.lastlogs_crawler import LogsCrawler
+from xnova.lastlogs_db_schema import SIDE_ATTACKER, SIDE_DEFENDER
+from xnova.lastlogs_stats import GalaxyAlliances
 from xnova.lastlogs_utils import safe_int, LLDb
 
 
@@ -42,6 +47,7 @@ class PageParser(XNParserBase):  # parent of XNParserBase is html.parser.HTMLPar
         super(PageParser, self).__init__()
         # reset code
         self.is_nonexistent_log = True
+        self.is_unavailable_log = False  # log exists, but is not available for viewing yet
         self.log_time = 0
         self.log_time_str = ''
         self.attacker = ''
@@ -57,6 +63,7 @@ class PageParser(XNParserBase):  # parent of XNParserBase is html.parser.HTMLPar
         self.win_cry = 0
         self.win_deit = 0
         self.moon_chance = 0
+        self.participants = []  # list of (side, player_name, coords), see lastlogs_db_schema
         #
         self._in_report_user = False
         self._in_report_fleet = False
@@ -69,6 +76,7 @@ class PageParser(XNParserBase):  # parent of XNParserBase is html.parser.HTMLPar
     def reset(self):
         super(PageParser, self).reset()
         self.is_nonexistent_log = True
+        self.is_unavailable_log = False  # log exists, but is not available for viewing yet
         self.log_time = 0
         self.log_time_str = ''
         self.attacker = ''
@@ -84,6 +92,7 @@ class PageParser(XNParserBase):  # parent of XNParserBase is html.parser.HTMLPar
         self.win_cry = 0
         self.win_deit = 0
         self.moon_chance = 0
+        self.participants = []  # list of (side, player_name, coords), see lastlogs_db_schema
         #
         self._in_report_user = False
         self._in_report_fleet = False
@@ -113,12 +122,14 @@ class PageParser(XNParserBase):  # parent of XNParserBase is html.parser.HTMLPar
         # post-processing
         if tag == 'html':
             for att in self._attackers_list:
+                self.participants.append((SIDE_ATTACKER, att, self._attackers_coords_dict.get(att, '')))
                 try:
                     self.attacker_coords += self._attackers_coords_dict[att] + ','
                 except KeyError:
                     logger.error('Cannot find [{0}] in attacker coords dict, attackers list:'.format(att))
                     logger.error('{0}'.format(str(self._attackers_list)))
             for defender in self._defenders_list:
+                self.participants.append((SIDE_DEFENDER, defender, self._defender_coords_dict.get(defender, '')))
                 try:
                     self.defender_coords += self._defender_coords_dict[defender] + ','
                 except KeyError:
@@ -134,6 +145,7 @@ class PageParser(XNParserBase):  # parent of XNParserBase is html.parser.HTMLPar
             # <center>Данный лог боя пока недоступен для просмотра!</center></div>
             if data == 'Данный лог боя пока недоступен для просмотра!':
                 self.is_nonexistent_log = True
+                self.is_unavailable_log = True
         if tag == 'title':
             logger.debug('Found title: [{0}]'.format(data))
             # <title>Боевой доклад :: Звездная Империя 5</title> - success, we have log
@@ -222,10 +234,48 @@ class PageParser(XNParserBase):  # parent of XNParserBase is html.parser.HTMLPar
             return
 
 
+# crawler worker context: its own downloader, sharing rate limit with others
+def crawl_worker_init(page_dnl: XNovaPageDownload):
+    worker_dnl = page_dnl.clone()
+    worker_dnl.set_referer('https://uni5.xnova.su/log/')
+    return worker_dnl
+
+
+# LogsCrawler fetch function, runs in worker threads
+def fetch_log(session: XNovaSession, page_dnl: XNovaPageDownload, log_id: int) -> tuple:
+    url = 'log/{0}/'.format(log_id)
+    logger.debug('Downloading {0}...'.format(url))
+    page_content = session.download(page_dnl, url, return_binary=False)  # logs in again if needed
+    if page_content is None:
+        logger.error('Failed to download log page {0}!'.format(log_id))
+        return LogsCrawler.FAILED, None
+    parser = PageParser()
+    try:
+        parser.parse_page_content(page_content)
+    except ParseError as ve:
+        logger.error('Failed to parse log id {0} !'.format(log_id))
+        logger.error('Error message: {0}'.format(ve.message))
+        return LogsCrawler.FAILED, None
+    if parser.is_unavailable_log:
+        return LogsCrawler.UNAVAILABLE, None
+    if parser.is_nonexistent_log:
+        return LogsCrawler.NONEXISTENT, None
+    # success, this is battle log
+    logger.debug('Battle at {0}: {1} vs {2}'.format(
+        parser.log_time_str, parser.attacker, parser.defender))
+    logger.debug(' Coords: {0} vs {1}'.format(parser.attacker_coords, parser.defender_coords))
+    logger.debug(' Losses: att: {0}, def: {1}, total: {2}'.format(
+        parser.att_loss, parser.def_loss, parser.total_loss))
+    logger.debug(' Field: {0} me, {1} cry'.format(parser.po_me, parser.po_cry))
+    logger.debug(' Win res: {0} me, {1} cry, {2} deit'.format(
+        parser.win_me, parser.win_cry, parser.win_deit))
+    return LogsCrawler.FOUND, parser
+
+
 def main():
     # parse command line
     ap = argparse.ArgumentParser(description='XNova Uni5 combat logs parser.')
-    ap.add_argument('--version', action='version', version='%(prog)s 0.2')
+    ap.add_argument('--version', action='version', version='%(prog)s 0.4')
     ap.add_argument('--debug', action='store_true', help='Enable debug logging.')
     ap.add_argument('--login', nargs='?', default='', type=str, metavar='LOGIN',
                     help='Login to use to authorize in XNova game')
@@ -233,108 +283,79 @@ def main():
                     help='Password to use to authorize in XNova game')
     ap.add_argument('--dbfile', nargs='?', default='lastlogs5.db', type=str, metavar='DBFILE',
                     help='Name of sqlite3 db file to store logs data. Default is "lastlogs5.db"')
+    ap.add_argument('--session-file', nargs='?', default='./cache/session5.json', type=str, metavar='FILE',
+                    help='File to keep login session in, reused between runs while cookies are valid \
+(default: ./cache/session5.json)')
     ap.add_argument('--delay', nargs='?', default=5.0, type=float, metavar='SECONDS',
-                    help='Delay in seconds between requests (default: 5 secs)')
+                    help='Delay in seconds between requests, of all workers together (default: 5 secs)')
+    ap.add_argument('--rate', nargs='?', default=None, type=float, metavar='REQ_PER_SEC',
+                    help='Requests rate limit, requests per second, of all workers together. \
+Overrides --delay')
+    ap.add_argument('--retries', nargs='?', default=4, type=int, metavar='NUM',
+                    help='Max number of attempts for each request on transient errors (timeouts, \
+connection errors, HTTP 5xx/429), with exponential backoff (default: 4)')
+    ap.add_argument('--workers', nargs='?', default=1, type=int, metavar='NUM',
+                    help='Number of logs downloaded at once (default: 1)')
+    ap.add_argument('--follow', action='store_true',
+                    help='Do not exit when all existing logs are crawled, wait for new ones')
+    ap.add_argument('--poll-interval', nargs='?', default=60.0, type=float, metavar='SECONDS',
+                    help='With --follow, wait this long for new logs when crawl is caught up (default: 60 secs)')
+    ap.add_argument('--galaxy-db', nargs='?', default=None, type=str, metavar='DBFILE',
+                    help='Galaxy DB file of the same universe, to count combat stats of players\' alliances')
+    ap.add_argument('--rebuild-stats', action='store_true',
+                    help='Count combat stats again from all stored logs (e.g. to count alliances \
+for older logs) and exit')
     ap_result = ap.parse_args()
 
     if ap_result.debug:
         logger.setLevel(logging.DEBUG)
         logger.debug('DEBUG enabled')
 
+    alliances = None
+    if ap_result.galaxy_db is not None:
+        alliances = GalaxyAlliances(ap_result.galaxy_db)
+
+    if ap_result.rebuild_stats:
+        lldb = LLDb(ap_result.dbfile, alliances=alliances)
+        lldb.rebuild_stats()
+        lldb.close()
+        exit(0)
+
     if (ap_result.login == '') or (ap_result.password == ''):
         logger.critical('You MUST provide login and password!')
         exit(1)
 
-    lldb = LLDb(ap_result.dbfile)
+    lldb = LLDb(ap_result.dbfile, alliances=alliances)
     page_dnl = XNovaPageDownload()
     page_dnl.xnova_url = 'uni5.xnova.su'
+    # long crawl: do not hang on a request, retry transient errors, pause while server is down
+    page_dnl.timeout = 60
+    page_dnl.retry_policy = RetryPolicy(max_attempts=ap_result.retries)
+    page_dnl.use_circuit_breaker = True
+    if ap_result.rate is not None:
+        page_dnl.rate_limiter = TokenBucket(ap_result.rate)
+    else:
+        page_dnl.rate_limiter = TokenBucket.from_delay(ap_result.delay)
 
-    cookies_dict = xnova_authorize(page_dnl.xnova_url, ap_result.login, ap_result.password)
+    session = XNovaSession(page_dnl.xnova_url, ap_result.login, ap_result.password, ap_result.session_file)
+    cookies_dict = session.get_cookies()
     if cookies_dict is None:
         logger.error('XNova authorization failed!')
         exit(1)
 
     page_dnl.set_cookies_from_dict(cookies_dict, do_save=False)
 
-    lastlog_id = lldb.get_lastlog_id()
-    logger.info('Got lastlog ID from DB: {0}'.format(lastlog_id))
-    lastlog_id += 1  # move on to next log id
-
-    parser = PageParser()
-
-    num_errors = 0
-    max_errors = 20
-    look_back_logs = 10
-    num_logs_parsed = 0
-    failed_logids = []
-    nonexistent_logids = []
-    log_id = lastlog_id
-    # look also several logs backwards
-    if log_id > look_back_logs:
-        log_id -= look_back_logs
-        max_errors += look_back_logs
-    while True:
-        page_dnl.set_referer('https://uni5.xnova.su/log/')
-        url = 'log/{0}/'.format(log_id)
-        logger.debug('Downloading {0}...'.format(url))
-        page_content = page_dnl.download_url_path(url, return_binary=False)
-        if page_content is None:
-            num_errors += 1
-            failed_logids.append(log_id)
-            logger.error('Failed to download log page!')
-        else:
-            # parse page content
-            try:
-                parser.reset()  # reset manually before next parse, clean prev. data
-                parser.parse_page_content(page_content)
-                if parser.is_nonexistent_log:
-                    num_errors += 1
-                    nonexistent_logids.append(log_id)
-                else:
-                    # success, this is battle log
-                    parser.log_id = log_id
-                    lldb.store_log(parser)
-                    num_logs_parsed += 1
-                    num_errors = 0  # reset number of errors on successful parse
-                    #
-                    logger.debug('Battle at {0}: {1} vs {2}'.format(
-                        parser.log_time_str, parser.attacker, parser.defender))
-                    logger.debug(' Coords: {0} vs {1}'.format(parser.attacker_coords, parser.defender_coords))
-                    logger.debug(' Losses: att: {0}, def: {1}, total: {2}'.format(
-                        parser.att_loss, parser.def_loss, parser.total_loss))
-                    logger.debug(' Field: {0} me, {1} cry'.format(parser.po_me, parser.po_cry))
-                    logger.debug(' Win res: {0} me, {1} cry, {2} deit'.format(
-                        parser.win_me, parser.win_cry, parser.win_deit))
-            except ParseError as ve:
-                num_errors += 1
-                failed_logids.append(log_id)
-                logger.error('Failed to parse log id {0} !'.format(log_id))
-                logger.error('Error message: {0}'.format(ve.message))
-
-        log_id += 1
-
-        if num_errors >= max_errors:
-            logger.info('Max errors ({0}) exceeded, exiting'.format(num_errors))
-            break
-
-        time.sleep(ap_result.delay)
-
-    # Output statistics
-    # always output failed logs
-    logstr = ''
-    for flid in failed_logids:
-        logstr += '{0},'.format(flid)
-    if logstr != '':
-        logstr = logstr[:-1]
-        logger.info('STATS: Failed logs: {0}'.format(logstr))
-    # output nonexistent logs
-    logstr = ''
-    for flid in nonexistent_logids:
-        logstr += '{0},'.format(flid)
-    if logstr != '':
-        logstr = logstr[:-1]
-        logger.info('STATS: Non-existent logs: {0}'.format(logstr))
-    logger.info('STATS: Succesfully parsed: {0} logs'.format(num_logs_parsed))
+    crawler = LogsCrawler(lldb,
+                          lambda ctx, log_id: fetch_log(session, ctx, log_id),
+                          ap_result.workers,
+                          lambda: crawl_worker_init(page_dnl))
+    crawler.follow = ap_result.follow
+    crawler.poll_interval = ap_result.poll_interval
+    try:
+        crawler.run()
+    finally:
+        lldb.close()  # write the last batch, also on Ctrl+C or error
+    logger.info('STATS: Succesfully parsed: {0} logs'.format(crawler.num_stored))
 
     exit(0)
 
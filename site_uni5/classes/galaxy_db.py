@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
+import logging
 import sqlite3
 
+from .galaxy_db_schema import GALAXY_DB_SCHEMA_VERSION, NAME_PLAYER, NAME_ALLY, NAME_ALLY_TAG, \
+    get_schema_version, fts_substring_query, has_names_index
+
+logger = logging.getLogger(__name__)
+
 
 class GalaxyDB:
 
@@ -10,10 +16,21 @@ class GalaxyDB:
     def __init__(self):
         self._conn = sqlite3.connect('galaxy5.db')
         self._conn.row_factory = sqlite3.Row
+        # schema is upgraded by scanner (or galaxy_auto_parser.py --upgrade-db), not in site requests
+        try:
+            version = get_schema_version(self._conn)
+            if version < GALAXY_DB_SCHEMA_VERSION:
+                logger.warn('Galaxy DB schema version is {0}, expected {1}: run galaxy_auto_parser.py '
+                            '--upgrade-db, until then search is slower'.format(version, GALAXY_DB_SCHEMA_VERSION))
+        except sqlite3.Error as e:
+            logger.error('Cannot check galaxy DB schema version: {0}'.format(str(e)))
         self._cur = self._conn.cursor()
         self._log_queries = False
+        # substring search of short names, sqlite lower() folds only ASCII
+        self._conn.create_function('xn_casefold', 1, lambda s: s.casefold() if s is not None else None)
+        self._have_names_index = has_names_index(self._conn)
 
-    def create_query(self, where_clause=None, sort_col=None, sort_order=None):
+    def create_query(self, where_clause=None, sort_col=None, sort_order=None, rank_col=None):
         q = 'SELECT g,s,p, \n' \
             '  planet_id, planet_name, planet_type, planet_metal, planet_crystal, planet_destroyed, \n' \
             '  luna_id, luna_name, luna_diameter, luna_destroyed, \n' \
@@ -39,6 +56,8 @@ class GalaxyDB:
                 q += ' '
                 q += sort_order
             q += ', '
+        elif rank_col is not None:
+            q += rank_col + ' ASC, '  # best matches first
         q += 'g ASC, s ASC, p ASC'  # by default, always sort by coords
         # log query
         if self._log_queries:
@@ -141,6 +160,39 @@ class GalaxyDB:
         self._cur.execute(q, params)
         return self._rows_to_res_list()
 
+    def query_search(self, category: str, text: str, sort_col=None, sort_order=None):
+        """
+        Planets of players or alliances, which name (or alliance tag) contains text,
+        case-insensitive; best matching names first, unless other sorting is given
+        :param category: 'player' or 'alliance'
+        :param text: part of name
+        """
+        if not self._have_names_index:
+            # no full-text index (sqlite without FTS5): prefix search
+            if category == 'player':
+                return self.query_like('user_name', text + '%', sort_col, sort_order)
+            return self.query_like(['ally_name', 'ally_tag'], text + '%', sort_col, sort_order)
+        if category == 'player':
+            id_col = 'user_id'
+            kinds = '({0})'.format(NAME_PLAYER)
+        else:
+            id_col = 'ally_id'
+            kinds = '({0}, {1})'.format(NAME_ALLY, NAME_ALLY_TAG)
+        if len(text) >= 3:
+            # trigram index lookup, bm25 ranking
+            matches = 'SELECT rowid >> 2 AS id, MIN(rank) AS name_rank FROM names_fts ' \
+                      ' WHERE names_fts MATCH ? AND (rowid & 3) IN ' + kinds + ' GROUP BY id'
+            params = (fts_substring_query(text), )
+        else:
+            # too short for trigrams: scan of names, which is still much smaller than planets
+            matches = 'SELECT rowid >> 2 AS id, MIN(length(name)) AS name_rank FROM names_fts ' \
+                      ' WHERE instr(xn_casefold(name), ?) > 0 AND (rowid & 3) IN ' + kinds + ' GROUP BY id'
+            params = (text.casefold(), )
+        join = 'JOIN (' + matches + ') AS m ON m.id = ' + id_col
+        q = self.create_query(join, sort_col, sort_order, rank_col='m.name_rank')
+        self._cur.execute(q, params)
+        return self._rows_to_res_list()
+
     def query_inactives(self, user_flags, gal_ints, s_min, s_max, min_rank=0, sort_col=None, sort_order=None):
         user_where = ''
         gals_where = ''
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""Copy of xnova/galaxy_db_schema.py for the site, which is deployed separately.
+Versioned schema of galaxy DB (planets table), shared by
+galaxy_auto_parser (writer) and GalaxyDB classes (readers).
+Current schema version is stored in sqlite "PRAGMA user_version",
+every migration function upgrades DB from version N to N+1.
+Existing galaxy.db/galaxy5.db files are upgraded in place.
+"""
+import sqlite3
+
+
+# kinds of names in names_fts, rowid of name is id * 4 + kind
+NAME_PLAYER = 1  # user_name, by user_id
+NAME_ALLY = 2  # ally_name, by ally_id
+NAME_ALLY_TAG = 3  # ally_tag, by ally_id
+
+NAMES_MAX_ID = (1 << 61) - 1  # so that rowid fits into sqlite integer
+
+
+def name_rowid(kind: int, id_: int) -> int:
+    return id_ * 4 + kind
+
+
+# FTS5 query, that matches text anywhere in name: trigram tokenizer makes
+# phrase match a substring match, case-insensitive, also for cyrillic
+def fts_substring_query(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def has_names_index(conn: sqlite3.Connection) -> bool:
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='names_fts'")
+    ret = cur.fetchone()[0] == 1
+    cur.close()
+    return ret
+
+
+# adds names of players and alliances of all planets to names_fts, in the
+# caller's transaction; ids out of 1..NAMES_MAX_ID and empty names are skipped
+def fill_names_index(cur: sqlite3.Cursor):
+    for kind, id_col, name_col in ((NAME_PLAYER, 'user_id', 'user_name'),
+                                   (NAME_ALLY, 'ally_id', 'ally_name'),
+                                   (NAME_ALLY_TAG, 'ally_id', 'ally_tag')):
+        cur.execute('INSERT OR REPLACE INTO names_fts (rowid, name) '
+                    ' SELECT {0} * 4 + ?, MAX({1}) FROM planets '
+                    ' WHERE {0} BETWEEN 1 AND ? AND {1} != \'\' GROUP BY {0}'.format(id_col, name_col),
+                    (kind, NAMES_MAX_ID))
+
+
+def _migration_1_create_planets(cur: sqlite3.Cursor):
+    # original table, as created by old galaxy_auto_parser versions
+    cur.execute('CREATE TABLE IF NOT EXISTS planets( '
+                ' g INT, '
+                ' s INT, '
+                ' p INT, '
+                ' planet_id INT PRIMARY KEY, '
+                ' planet_name TEXT, '
+                ' planet_type INT, '
+                ' planet_metal INT, '
+                ' planet_crystal INT, '
+                ' planet_destroyed INT, '
+                ' luna_id INT, '
+                ' luna_name TEXT, '
+                ' luna_diameter INT, '
+                ' luna_destroyed INT, '
+                ' user_id INT, '
+                ' user_name TEXT, '
+                ' user_rank INT, '
+                ' user_totalpoints INT, '
+                ' user_authlevel INT, '
+                ' user_onlinetime INT, '
+                ' user_banned INT, '
+                ' user_ro INT, '
+                ' user_race INT, '
+                ' ally_id INT, '
+                ' ally_name TEXT, '
+                ' ally_tag TEXT, '
+                ' ally_members INT )')
+
+
+def _migration_2_planets_indexes(cur: sqlite3.Cursor):
+    # only one planet can be at given coordinates; old DBs should not
+    # have duplicates, but make sure unique index can be created
+    cur.execute('DELETE FROM planets WHERE rowid NOT IN '
+                ' (SELECT MAX(rowid) FROM planets GROUP BY g, s, p)')
+    # planet by coords, planets count in system, systems ranges
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS planets_gsp ON planets (g, s, p)')
+    # player/alliance search with prefix LIKE: 'name%'. LIKE is case-insensitive,
+    # so sqlite can use index for it only if index has NOCASE collation
+    cur.execute('CREATE INDEX IF NOT EXISTS planets_user_name_nc ON planets (user_name COLLATE NOCASE)')
+    cur.execute('CREATE INDEX IF NOT EXISTS planets_ally_name_nc ON planets (ally_name COLLATE NOCASE)')
+    cur.execute('CREATE INDEX IF NOT EXISTS planets_ally_tag_nc ON planets (ally_tag COLLATE NOCASE)')
+    # exact player name lookups: "WHERE user_name=?"
+    cur.execute('CREATE INDEX IF NOT EXISTS planets_user_name ON planets (user_name)')
+    # inactives search: user flags first, then coords ranges and rank
+    cur.execute('CREATE INDEX IF NOT EXISTS planets_inactives ON planets '
+                ' (user_banned, user_ro, user_onlinetime, g, s, user_rank)')
+    # moons map: "WHERE luna_id > 0", covering partial index
+    cur.execute('CREATE INDEX IF NOT EXISTS planets_moons ON planets (g, s, p) WHERE luna_id > 0')
+    cur.execute('ANALYZE planets')
+
+
+def _migration_3_systems_meta(cur: sqlite3.Cursor):
+    # per solar system scan metadata, used by incremental scan planner:
+    # when system was last fetched, hash of its stored planets rows,
+    # how many times it was scanned and how many times it changed
+    cur.execute('CREATE TABLE IF NOT EXISTS systems_meta ( '
+                ' g INT, '
+                ' s INT, '
+                ' last_fetch INT, '
+                ' rows_hash TEXT, '
+                ' num_planets INT, '
+                ' num_scans INT, '
+                ' num_changes INT, '
+                ' last_change INT, '
+                ' PRIMARY KEY (g, s) )')
+
+
+def _migration_4_scan_journal(cur: sqlite3.Cursor):
+    # checkpoint journal of galaxy scans: planned systems list of every scan,
+    # and outcome of every processed system, so interrupted scan can be resumed
+    cur.execute('CREATE TABLE IF NOT EXISTS scans ( '
+                ' scan_id INTEGER PRIMARY KEY, '
+                ' started INT, '
+                ' finished INT, '
+                ' units TEXT )')
+    cur.execute('CREATE TABLE IF NOT EXISTS scan_units ( '
+                ' scan_id INT, '
+                ' g INT, '
+                ' s INT, '
+                ' outcome TEXT, '
+                ' attempts INT, '
+                ' ts INT, '
+                ' PRIMARY KEY (scan_id, g, s) )')
+
+
+def _migration_5_systems_page_hash(cur: sqlite3.Cursor):
+    # hash of the page which stored planets of the system were parsed from:
+    # if the same page is received again, parsing it can be skipped
+    cur.execute('ALTER TABLE systems_meta ADD COLUMN page_hash TEXT')
+
+
+def _migration_6_planet_history(cur: sqlite3.Cursor):
+    # change events of planets, one per changed field, appended by scan writer;
+    # old_value, new_value have no type affinity, they keep type of the field
+    cur.execute('CREATE TABLE IF NOT EXISTS planet_history ( '
+                ' planet_id INT, '
+                ' user_id INT, '
+                ' g INT, '
+                ' s INT, '
+                ' p INT, '
+                ' field TEXT, '
+                ' old_value, '
+                ' new_value, '
+                ' ts INT )')
+    # history of a planet, and of a player: "when did X go inactive"
+    cur.execute('CREATE INDEX IF NOT EXISTS planet_history_planet ON planet_history (planet_id, field, ts)')
+    cur.execute('CREATE INDEX IF NOT EXISTS planet_history_user ON planet_history (user_id, field, ts)')
+    # recent changes, retention
+    cur.execute('CREATE INDEX IF NOT EXISTS planet_history_ts ON planet_history (ts)')
+
+
+def _migration_7_names_search(cur: sqlite3.Cursor):
+    # full-text index of player names, alliance names and tags, for substring
+    # search; rowid is id * 4 + kind, see NAME_PLAYER, NAME_ALLY, NAME_ALLY_TAG.
+    # Trigram tokenizer needs sqlite 3.34+, without it search uses LIKE.
+    # Planets of matched names are joined by id
+    cur.execute('CREATE INDEX IF NOT EXISTS planets_user_id ON planets (user_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS planets_ally_id ON planets (ally_id)')
+    try:
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS names_fts USING fts5(name, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        return
+    fill_names_index(cur)
+
+
+GALAXY_DB_MIGRATIONS = [
+    _migration_1_create_planets,
+    _migration_2_planets_indexes,
+    _migration_3_systems_meta,
+    _migration_4_scan_journal,
+    _migration_5_systems_page_hash,
+    _migration_6_planet_history,
+    _migration_7_names_search
+]
+
+GALAXY_DB_SCHEMA_VERSION = len(GALAXY_DB_MIGRATIONS)
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    cur = conn.cursor()
+    cur.execute('PRAGMA user_version')
+    version = cur.fetchone()[0]
+    cur.close()
+    return version
+
+
+def upgrade_galaxy_db(conn: sqlite3.Connection) -> int:
+    """
+    Brings galaxy DB schema to the latest version, applying every missing
+    migration in its own transaction. Safe to call from several processes
+    at once: version is re-checked after DB write lock is taken.
+    :param conn: sqlite3 connection to galaxy DB
+    :return: schema version before upgrade
+    """
+    old_version = get_schema_version(conn)
+    if old_version >= GALAXY_DB_SCHEMA_VERSION:
+        return old_version
+    if conn.in_transaction:
+        conn.commit()
+    cur = conn.cursor()
+    try:
+        while True:
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute('PRAGMA user_version')
+            version = cur.fetchone()[0]
+            if version >= GALAXY_DB_SCHEMA_VERSION:
+                conn.commit()
+                break
+            GALAXY_DB_MIGRATIONS[version](cur)
+            cur.execute('PRAGMA user_version = {0}'.format(version + 1))
+            conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return old_version
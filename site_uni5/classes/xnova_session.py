@@ -0,0 +1,175 @@
+"""Copy of xnova/xn_session.py for the site, which is deployed separately."""
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+from .xnova_utils import xnova_authorize
+
+logger = logging.getLogger(__name__)
+
+
+# Exclusive lock on a file, between processes (and threads): flock() on POSIX,
+# byte range lock on Windows
+class _FileLock:
+    _thread_lock = threading.Lock()
+
+    def __init__(self, filename: str):
+        self._filename = filename
+        self._f = None
+
+    def __enter__(self):
+        _FileLock._thread_lock.acquire()
+        try:
+            self._f = open(self._filename, mode='a+b')
+            if fcntl is not None:
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+            elif msvcrt is not None:
+                self._f.seek(0)
+                msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1)
+        except BaseException:
+            if self._f is not None:
+                self._f.close()
+            _FileLock._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                self._f.seek(0)
+                msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._f.close()
+            _FileLock._thread_lock.release()
+
+
+# Login session shared by all processes that use the same session file
+# (galaxy_auto_parser, lastlogs5, site scripts): cookies are saved together
+# with their expiry time, and reused until they expire, so login is done
+# only when there are no valid cookies. File is locked while it is read or
+# written, so if several processes need to login at once, only one does,
+# and others pick up its cookies.
+# download() detects responses of logged out session (redirect to login page,
+# or page check by caller fails) and logs in again, once per request.
+class XNovaSession:
+    def __init__(self, xn_host: str, xn_login: str, xn_password: str,
+                 session_filename: str='./cache/session.json'):
+        self.xn_host = xn_host
+        self.xn_login = xn_login
+        self.xn_password = xn_password
+        self.session_filename = session_filename
+        self.lock_filename = session_filename + '.lock'
+        # for cookies without expiry time (browser session cookies)
+        self.default_lifetime = 24 * 3600
+        # consider cookies expired a bit earlier, not to start scan with about-to-expire ones
+        self.expiry_margin = 60
+        self.cookies = None
+        self.expires = 0
+        self.num_logins = 0
+
+    def _load(self):
+        try:
+            with open(self.session_filename, mode='rt', encoding='UTF-8') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if (type(data) != dict) or (data.get('host') != self.xn_host) \
+                or (data.get('login') != self.xn_login):
+            return None  # session of another account
+        if (not data.get('cookies')) or (data.get('expires', 0) - self.expiry_margin < time.time()):
+            return None
+        return data
+
+    def _save(self, data: dict):
+        fn_tmp = self.session_filename + '.tmp'
+        with open(fn_tmp, mode='wt', encoding='UTF-8') as f:
+            json.dump(data, f, sort_keys=True, indent=4)
+        os.replace(fn_tmp, self.session_filename)
+
+    def _login(self):
+        cookies_expires = {}
+        cookies = xnova_authorize(self.xn_host, self.xn_login, self.xn_password, cookies_expires)
+        if cookies is None:
+            return None
+        self.num_logins += 1
+        now = int(time.time())
+        # session is valid while all its cookies are
+        expires = [ts for ts in cookies_expires.values() if ts is not None]
+        if len(expires) > 0:
+            expires = min(expires)
+        else:
+            expires = now + self.default_lifetime
+        return {'host': self.xn_host, 'login': self.xn_login, 'cookies': cookies,
+                'created': now, 'expires': expires}
+
+    def get_cookies(self, stale_cookies: dict=None):
+        """
+        Get valid session cookies, from session file or by logging in
+        :param stale_cookies: cookies that server does not accept anymore; if session
+                              file still has them, login is done
+        :return: cookies dict, or None if login failed
+        """
+        dirname = os.path.dirname(self.session_filename)
+        if (dirname != '') and not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        with _FileLock(self.lock_filename):
+            data = self._load()
+            if (data is not None) and (data['cookies'] != stale_cookies):
+                logger.debug('Using saved session, expires in {0}s'.format(int(data['expires'] - time.time())))
+            else:
+                data = self._login()
+                if data is None:
+                    return None
+                try:
+                    self._save(data)
+                except IOError as ioe:
+                    logger.error('Cannot save session to {0}: {1}'.format(self.session_filename, str(ioe)))
+        self.cookies = data['cookies']
+        self.expires = data['expires']
+        return self.cookies
+
+    @staticmethod
+    def _is_login_url(url: str) -> bool:
+        return (url is not None) and (('/login' in url) or ('set=login' in url))
+
+    def download(self, page_dnl, url_path: str, is_logged_in_page=None, **kwargs):
+        """
+        Downloads page with page_dnl, logging in again if session has ended
+        :param page_dnl: page downloader, with this session's cookies
+        :param url_path: url path to download
+        :param is_logged_in_page: optional function(content) -> bool, returns False
+                                  for pages that logged out user gets
+        :param kwargs: passed to page_dnl.download_url_path()
+        :return: page contents, or None on error
+        """
+        used_cookies = {cookie.name: cookie.value for cookie in page_dnl.sess.cookies}
+        content = page_dnl.download_url_path(url_path, **kwargs)
+        logged_out = self._is_login_url(getattr(page_dnl, 'response_url', None))
+        if (content is not None) and (is_logged_in_page is not None) and not is_logged_in_page(content):
+            logged_out = True
+        if not logged_out:
+            return content
+        logger.warn('Session has ended, logging in again')
+        if self.get_cookies(stale_cookies=used_cookies) is None:
+            logger.error('Failed to login again')
+            return None
+        page_dnl.set_cookies_from_dict(self.cookies)
+        content = page_dnl.download_url_path(url_path, **kwargs)
+        if self._is_login_url(getattr(page_dnl, 'response_url', None)):
+            return None
+        if (content is not None) and (is_logged_in_page is not None) and not is_logged_in_page(content):
+            return None
+        return content
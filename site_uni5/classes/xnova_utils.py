@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import re
 import sys
 from html.parser import HTMLParser
 
@@ -6,11 +7,21 @@ import requests
 import requests.exceptions
 import requests.cookies
 
-import execjs
-import execjs._exceptions as execjs_exceptions
+try:
+    import execjs
+    import execjs._exceptions as execjs_exceptions
+except ImportError:
+    execjs = None  # JS runtime is only needed for opt-in fallback
 
+from .js_unpack import UnpackError, unpack_packed_js, parse_row_assignments
+from .js_worker import JSWorkerError, get_pool as get_js_worker_pool
 
-def xnova_authorize(xn_host, xn_login, xn_password) -> dict:
+_GALAXY_DIV_RE = re.compile(r'<div[^>]*\sid\s*=\s*["\']?galaxy["\'\s>]')
+
+
+def xnova_authorize(xn_host, xn_login, xn_password, cookies_expires: dict=None) -> dict:
+    # cookies_expires: optional dict, filled with cookie name => expiry unix time
+    # (None for session cookies)
     # This is only for debugging!
     # print('Content-Type: text/plain; charset=utf-8')
     # print()
@@ -53,6 +64,9 @@ def xnova_authorize(xn_host, xn_login, xn_password) -> dict:
     cookies_dict = {}
     for single_cookie in r.cookies.iteritems():
         cookies_dict[single_cookie[0]] = single_cookie[1]
+    if cookies_expires is not None:
+        for cookie in r.cookies:
+            cookies_expires[cookie.name] = cookie.expires
 
     # print('cookies_dict will be:')
     # print(cookies_dict)
@@ -73,6 +87,7 @@ class PageDownloader:
         self.xnova_url = 'uni5.xnova.su'
         self.user_agent = 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:48.0) Gecko/20100101 Firefox/48.0'
         self.error_str = None
+        self.response_url = None  # final url of the last response, after redirects
         self.proxy = None
         # construct requests HTTP session
         self.sess = requests.Session()  # else normal session
@@ -102,8 +117,10 @@ class PageDownloader:
         # construct url to download
         url = 'http://{0}/{1}'.format(self.xnova_url, url_path)
         ret = None
+        self.response_url = None
         try:
             r = self.sess.get(url)
+            self.response_url = r.url
             if r.status_code == requests.codes.ok:
                 if not return_binary:
                     ret = r.text
@@ -204,6 +221,9 @@ class XNGalaxyParser(XNParserBase):
         self.script_body = ''
         self.galaxy_rows = []
         self.error_str = ''
+        # use JS runtime to eval scripts that native decoder cannot handle,
+        # index.py sets it from config.ini [galaxy] js_fallback
+        self.js_fallback = False
 
     def clear(self):
         self.script_body = ''
@@ -236,12 +256,6 @@ class XNGalaxyParser(XNParserBase):
             self.error_str = 'Invalid format of script body: cannot parse it!'
             return None
 
-        # create JavaScript interpreter runtime
-        try:
-            js_runtime = execjs.get('Node')
-        except execjs_exceptions.RuntimeUnavailableError:
-            js_runtime = execjs.get()  # default
-
         # find galaxy script part
         eval_start = self.script_body.find('eval(function(p,a,c,k,e,d)')
         if eval_start == -1:
@@ -260,10 +274,7 @@ class XNGalaxyParser(XNParserBase):
             eval_start += len(rows_end_str)
             eval_text = self.script_body[eval_start:eval_end]
             eval_text = eval_text.strip()
-            eval_text = 'var row = []; ' + eval_text + '\nreturn row;'
-            #
-            ctx = js_runtime.compile(eval_text)
-            self.galaxy_rows = ctx.exec_(eval_text)
+            is_packed = False
         else:
             # packed, as usual (uni4)
             eval_end = self.script_body.find("$('#galaxy').append(PrintRow());")
@@ -275,11 +286,60 @@ class XNGalaxyParser(XNParserBase):
             # ^^ [eval(function(p,a,c,k,e,d){e=function(c){r... ...141|7866|u0426'.split('|')))]
             eval_text = eval_text[5:-1]
             # ^^ [function(p,a,c,k,e,d){e=functi... ...0426'.split('|'))]
-            eval_res = js_runtime.eval(eval_text)
-            # Now, eval_res is a string:
-            # row[12]={"planet":12,"id_planet":54448,"ally_planet":0,"metal":0,"crystal":0, ...
-            eval_res = 'var row = []; ' + eval_res + "\nreturn row;"
-            ctx = js_runtime.compile(eval_res)
-            self.galaxy_rows = ctx.exec_(eval_res)
+            is_packed = True
+
+        try:
+            if is_packed:
+                # unpacked text is: row[12]={"planet":12,"id_planet":54448,...};row[9]={...}; ...
+                rows_text = unpack_packed_js(eval_text)
+            else:
+                rows_text = eval_text
+            self.galaxy_rows = parse_row_assignments(rows_text)
+        except UnpackError as ue:
+            if not self.js_fallback:
+                self.error_str = 'cannot decode galaxy script: {0}'.format(str(ue))
+                return None
+            self.galaxy_rows = self._eval_galaxy_script_js(eval_text, is_packed)
+            if self.galaxy_rows is None:
+                self.galaxy_rows = []
+                self.error_str = 'JS fallback is not available, cannot decode galaxy script: {0}'.format(str(ue))
+                return None
 
         return self.galaxy_rows
+
+    # execute galaxy script in JavaScript runtime: in persistent worker process
+    # if Node.js is found, or with execjs (slow, spawns a process per call)
+    @staticmethod
+    def _eval_galaxy_script_js(eval_text: str, is_packed: bool):
+        js_pool = get_js_worker_pool()
+        if js_pool is not None:
+            try:
+                if is_packed:
+                    # unpacked text is: row[12]={...};row[9]={...}; ...
+                    eval_text = js_pool.eval(eval_text)
+                return js_pool.exec_('var row = []; ' + eval_text + '\nreturn row;')
+            except JSWorkerError:
+                return None
+        if execjs is None:
+            return None
+        # create JavaScript interpreter runtime
+        try:
+            js_runtime = execjs.get('Node')
+        except execjs_exceptions.RuntimeUnavailableError:
+            js_runtime = execjs.get()  # default
+        if not is_packed:
+            eval_text = 'var row = []; ' + eval_text + '\nreturn row;'
+            ctx = js_runtime.compile(eval_text)
+            return ctx.exec_(eval_text)
+        eval_res = js_runtime.eval(eval_text)
+        # Now, eval_res is a string:
+        # row[12]={"planet":12,"id_planet":54448,"ally_planet":0,"metal":0,"crystal":0, ...
+        eval_res = 'var row = []; ' + eval_res + "\nreturn row;"
+        ctx = js_runtime.compile(eval_res)
+        return ctx.exec_(eval_res)
+
+
+# quick check that page is a galaxy page (has galaxy div), and not, for example,
+# login page that is shown when session has ended
+def is_galaxy_page(content: str) -> bool:
+    return _GALAXY_DIV_RE.search(content) is not None
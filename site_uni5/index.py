@@ -13,7 +13,8 @@ import urllib.parse
 
 from classes.template_engine import TemplateEngine
 from classes.galaxy_db import GalaxyDB
-from classes.xnova_utils import PageDownloader, XNGalaxyParser, xnova_authorize
+from classes.xnova_utils import PageDownloader, XNGalaxyParser, is_galaxy_page
+from classes.xnova_session import XNovaSession
 
 
 def debugprint(obj=None):
@@ -141,11 +142,9 @@ if AJAX_ACTION == 'grid':
     min_rank = req_param('min_rank', '0')
     if (val is not None) and (cat is not None):
         gdb = GalaxyDB()
-        val += '%'  # ... WHERE user_name LIKE 'value%'
-        if cat == 'player':
-            ret = gdb.query_like('user_name', val, s_col, s_order)
-        elif cat == 'alliance':
-            ret = gdb.query_like(['ally_name', 'ally_tag'], val, s_col, s_order)
+        # any part of name, case-insensitive
+        if cat in ['player', 'alliance']:
+            ret = gdb.query_search(cat, val, s_col, s_order)
     if cat is not None:
         if (cat == 'inactives') and (user_flags is not None):
             # - covert any char in gals to integer
@@ -219,9 +218,12 @@ if AJAX_ACTION == 'lastactive':
                 ret['error'] = 'Cannot find [lastactive] section in config.ini'
                 output_as_json(ret)
                 exit()
-            cookies_dict = xnova_authorize('uni5.xnova.su',
-                                           cfg['lastactive']['xn_login'],
-                                           cfg['lastactive']['xn_password'])
+            # 4. login once, keep session in a file, and reuse it in next requests
+            session = XNovaSession('uni5.xnova.su',
+                                   cfg['lastactive']['xn_login'],
+                                   cfg['lastactive']['xn_password'],
+                                   'cache/session.json')
+            cookies_dict = session.get_cookies()
             if cookies_dict is None:
                 ret['error'] = 'Failed to authorize to xnova site!'
                 output_as_json(ret)
@@ -229,6 +231,7 @@ if AJAX_ACTION == 'lastactive':
             #
             dnl = PageDownloader(cookies_dict=cookies_dict)
             gparser = XNGalaxyParser()
+            gparser.js_fallback = cfg.getboolean('galaxy', 'js_fallback', fallback=False)
             cached_pages = dict()  # coords -> page_content
             for pinfo in planets_info:
                 # try to lookup page in a cache, with key 'galaxy,system'
@@ -236,11 +239,11 @@ if AJAX_ACTION == 'lastactive':
                 if coords_str in cached_pages:
                     page_content = cached_pages[coords_str]
                 else:
-                    page_content = dnl.download_url_path('galaxy/{0}/{1}/'.format(
-                        pinfo['g'], pinfo['s']), return_binary=False)
+                    page_content = session.download(dnl, 'galaxy/{0}/{1}/'.format(
+                        pinfo['g'], pinfo['s']), is_galaxy_page, return_binary=False)
                 # seems to work, for now...
                 if page_content is None:
-                    ret['error'] = 'Failed to download, ' + dnl.error_str
+                    ret['error'] = 'Failed to download, ' + str(dnl.error_str or 'session has ended')
                     ret['rows'] = []
                     break
                 else:
@@ -311,7 +314,39 @@ if AJAX_ACTION == 'lastlogs':
         output_as_json(ret)
         exit()
     #
-    if nick != '':
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='log_participants' AND type='table'")
+    have_participants = (cur.fetchone()[0] == 1)
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='player_names_fts'")
+    have_names_index = (cur.fetchone()[0] == 1)
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='player_names' AND type='table'")
+    have_player_names = (cur.fetchone()[0] == 1)
+    if (nick != '') and have_player_names:
+        # nick anywhere in name of any attacker or defender, case-insensitive (also for
+        # cyrillic, which LIKE does not fold): matching names are found in index first
+        if (len(nick) >= 3) and have_names_index:
+            names_q = 'SELECT name FROM player_names_fts WHERE player_names_fts MATCH ?'
+            names_param = '"' + nick.replace('"', '""') + '"'
+        else:
+            sqconn.create_function('xn_casefold', 1, lambda s: s.casefold() if s is not None else None)
+            names_q = 'SELECT name FROM player_names WHERE instr(xn_casefold(name), ?) > 0'
+            names_param = nick.casefold()
+        q = 'SELECT log_id, log_time, attacker, defender, attacker_coords, defender_coords, ' \
+            ' total_loss, po_me, po_cry, win_me, win_cry, win_deit ' \
+            'FROM logs ' \
+            'WHERE (log_time >= ?) AND log_id IN ' \
+            ' (SELECT log_id FROM log_participants WHERE player_name IN (' + names_q + ')) ' \
+            'ORDER BY log_time DESC'
+        cur.execute(q, (min_time, names_param))
+    elif (nick != '') and have_participants:
+        # any of attackers or defenders, not only the first one
+        q = 'SELECT log_id, log_time, attacker, defender, attacker_coords, defender_coords, ' \
+            ' total_loss, po_me, po_cry, win_me, win_cry, win_deit ' \
+            'FROM logs ' \
+            'WHERE (log_time >= ?) AND log_id IN ' \
+            ' (SELECT log_id FROM log_participants WHERE player_name LIKE ?) ' \
+            'ORDER BY log_time DESC'
+        cur.execute(q, (min_time, nick+'%'))
+    elif nick != '':
         q = 'SELECT log_id, log_time, attacker, defender, attacker_coords, defender_coords, ' \
             ' total_loss, po_me, po_cry, win_me, win_cry, win_deit ' \
             'FROM logs ' \
@@ -355,6 +390,86 @@ if AJAX_ACTION == 'lastlogs':
     output_as_json(ret)
     exit()
 
+if AJAX_ACTION == 'combatstats':
+    # /xnova/index.py?ajax=combatstats&category=player&value=7&sort=loot
+    #   - top 50 players (category may be 'alliance') for last 7 days
+    # /xnova/index.py?ajax=combatstats&category=player&value=30&nick=Nickname
+    #   - daily totals of player (or alliance, by tag) for last 30 days
+    # from daily totals, counted by LLDb for every stored log
+    cat = req_param('category', 'player')  # default - players
+    val = int(req_param('value', 7))       # default - 7 days
+    sort = req_param('sort', 'loot')       # default - by loot
+    nick = req_param('nick', '')           # default - empty
+    #
+    # compare with start of UTC day, as daily totals are stored
+    min_day = int(time.time()) - val * 24 * 3600
+    min_day -= min_day % (24 * 3600)
+    ret = dict()
+    ret['rows'] = []
+    ret['total'] = 0
+    sqconn = sqlite3.connect('lastlogs5.db')
+    cur = sqconn.cursor()
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='player_stats_daily' AND type='table'")
+    if cur.fetchone()[0] != 1:
+        ret['msg'] = 'table not found: player_stats_daily'
+        output_as_json(ret)
+        exit()
+    #
+    if cat == 'alliance':
+        table = 'ally_stats_daily'
+        name_col = 'MAX(ally_tag)'
+        key_col = 'ally_id'
+        nick_where = 'ally_tag=?'
+    else:
+        table = 'player_stats_daily'
+        name_col = 'player_name'
+        key_col = 'player_name'
+        nick_where = 'player_name=?'
+    sort_exprs = {
+        'loot': 'SUM(win_me) + SUM(win_cry) + SUM(win_deit)',
+        'battles': 'SUM(battles)',
+        'losses': 'SUM(losses)',
+        'debris': 'SUM(po_me) + SUM(po_cry)',
+        'moon': 'SUM(moon_chances)'
+    }
+    if sort not in sort_exprs:
+        sort = 'loot'
+    totals = 'SUM(battles), SUM(attacks), SUM(defences), SUM(losses), ' \
+             ' SUM(win_me), SUM(win_cry), SUM(win_deit), SUM(po_me), SUM(po_cry), ' \
+             ' SUM(moon_chance_sum), SUM(moon_chances) '
+    if nick != '':
+        q = 'SELECT day, ' + name_col + ', ' + totals + \
+            'FROM ' + table + ' ' \
+            'WHERE (day >= ?) AND ' + nick_where + ' ' \
+            'GROUP BY day ORDER BY day'
+        cur.execute(q, (min_day, nick))
+    else:
+        q = 'SELECT MIN(day), ' + name_col + ', ' + totals + \
+            'FROM ' + table + ' ' \
+            'WHERE day >= ? ' \
+            'GROUP BY ' + key_col + ' ' \
+            'ORDER BY ' + sort_exprs[sort] + ' DESC LIMIT 50'
+        cur.execute(q, (min_day, ))
+    for row in cur.fetchall():
+        srow = dict()
+        if nick != '':
+            srow['day'] = time.strftime('%d-%m-%Y', time.gmtime(int(row[0])))
+        srow['name'] = str(row[1])
+        srow['battles'] = row[2]
+        srow['attacks'] = row[3]
+        srow['defences'] = row[4]
+        srow['losses'] = xn_res_str(row[5])
+        srow['win'] = xn_res_str(row[6]) + ' me, ' + xn_res_str(row[7]) + ' cry, ' + xn_res_str(row[8]) + ' deit'
+        srow['po'] = xn_res_str(row[9]) + ' me, ' + xn_res_str(row[10]) + ' cry'
+        srow['moon_chances'] = row[12]
+        srow['moon_chance_avg'] = 0
+        if row[2] > 0:
+            srow['moon_chance_avg'] = round(row[11] / row[2], 1)
+        ret['rows'].append(srow)
+    ret['total'] = len(ret['rows'])
+    output_as_json(ret)
+    exit()
+
 if AJAX_ACTION == 'gmap_population':
     gdb = GalaxyDB()
     population_data = []
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# JS workers pool tests, need Node.js: python3 -m pytest tests
+import os
+import signal
+import time
+import unittest
+
+from xnova.xn_js_worker import JSWorkerPool, JSEvalError, find_js_runtime
+
+
+class JSWorkerPoolTests(unittest.TestCase):
+    def setUp(self):
+        command = find_js_runtime()
+        if command is None:
+            self.skipTest('no JS runtime')
+        self.pool = JSWorkerPool(command, 1, timeout=2.0)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_eval(self):
+        self.assertEqual(self.pool.eval('1 + 2'), 3)
+        self.assertEqual(self.pool.exec_('var row = []; row[3] = {"a": 1}; return row;'), [None, None, None, {'a': 1}])
+        self.assertRaises(JSEvalError, self.pool.eval, 'undefined_var')
+
+    def test_killed_worker_is_restarted_by_check_health(self):
+        self.pool.eval('1')
+        worker = self.pool.workers[0]
+        os.kill(worker.pid, signal.SIGTERM)
+        deadline = time.monotonic() + 5
+        while worker.is_alive() and (time.monotonic() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(self.pool.check_health(), 1)
+        self.assertTrue(worker.is_alive())
+        self.assertEqual(worker.num_starts, 2)
+        self.assertEqual(self.pool.eval('2 * 21'), 42)
+
+    def test_hung_worker_is_restarted_before_request(self):
+        if not hasattr(signal, 'SIGSTOP'):
+            self.skipTest('no SIGSTOP')
+        self.pool.health_check_interval = 0
+        self.pool.eval('1')
+        worker = self.pool.workers[0]
+        old_pid = worker.pid
+        os.kill(old_pid, signal.SIGSTOP)  # process is alive, but does not respond
+        self.assertEqual(self.pool.eval('"ok"'), 'ok')
+        self.assertEqual(self.pool.num_restarts, 1)
+        self.assertNotEqual(worker.pid, old_pid)
+
+
+if __name__ == '__main__':
+    unittest.main()
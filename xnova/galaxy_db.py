@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 import sqlite3
 
+from . import xn_logger
+from .galaxy_db_schema import GALAXY_DB_SCHEMA_VERSION, get_schema_version
+from .galaxy_search import NAME_PLAYER, NAME_ALLY, NAME_ALLY_TAG, fts_substring_query, \
+    register_casefold, has_names_index
+
+logger = xn_logger.get(__name__, debug=False)
+
 
 class GalaxyDB:
 
@@ -10,8 +17,18 @@ class GalaxyDB:
     def __init__(self):
         self._conn = sqlite3.connect('galaxy5.db')
         self._conn.row_factory = sqlite3.Row
+        # schema is upgraded by scanner (or galaxy_auto_parser.py --upgrade-db), not by readers
+        try:
+            version = get_schema_version(self._conn)
+            if version < GALAXY_DB_SCHEMA_VERSION:
+                logger.warn('Galaxy DB schema version is {0}, expected {1}: run galaxy_auto_parser.py '
+                            '--upgrade-db, until then search is slower'.format(version, GALAXY_DB_SCHEMA_VERSION))
+        except sqlite3.Error as e:
+            logger.error('Cannot check galaxy DB schema version: {0}'.format(str(e)))
         self._cur = self._conn.cursor()
         self._log_queries = False
+        register_casefold(self._conn)
+        self._have_names_index = has_names_index(self._conn)
 
     def close(self):
         self._cur.close()
@@ -19,7 +36,7 @@ class GalaxyDB:
         del self._cur
         del self._conn
 
-    def create_query(self, where_clause=None, sort_col=None, sort_order=None):
+    def create_query(self, where_clause=None, sort_col=None, sort_order=None, rank_col=None):
         q = 'SELECT g,s,p, \n' \
             '  planet_id, planet_name, planet_type, planet_metal, planet_crystal, planet_destroyed, \n' \
             '  luna_id, luna_name, luna_diameter, luna_destroyed, \n' \
@@ -45,6 +62,8 @@ class GalaxyDB:
                 q += ' '
                 q += sort_order
             q += ', '
+        elif rank_col is not None:
+            q += rank_col + ' ASC, '  # best matches first
         q += 'g ASC, s ASC, p ASC'  # by default, always sort by coords
         # log query
         if self._log_queries:
@@ -147,6 +166,39 @@ class GalaxyDB:
         self._cur.execute(q, params)
         return self._rows_to_res_list()
 
+    def query_search(self, category: str, text: str, sort_col=None, sort_order=None):
+        """
+        Planets of players or alliances, which name (or alliance tag) contains text,
+        case-insensitive; best matching names first, unless other sorting is given
+        :param category: 'player' or 'alliance'
+        :param text: part of name
+        """
+        if not self._have_names_index:
+            # no full-text index (sqlite without FTS5): prefix search
+            if category == 'player':
+                return self.query_like('user_name', text + '%', sort_col, sort_order)
+            return self.query_like(['ally_name', 'ally_tag'], text + '%', sort_col, sort_order)
+        if category == 'player':
+            id_col = 'user_id'
+            kinds = '({0})'.format(NAME_PLAYER)
+        else:
+            id_col = 'ally_id'
+            kinds = '({0}, {1})'.format(NAME_ALLY, NAME_ALLY_TAG)
+        if len(text) >= 3:
+            # trigram index lookup, bm25 ranking
+            matches = 'SELECT rowid >> 2 AS id, MIN(rank) AS name_rank FROM names_fts ' \
+                      ' WHERE names_fts MATCH ? AND (rowid & 3) IN ' + kinds + ' GROUP BY id'
+            params = (fts_substring_query(text), )
+        else:
+            # too short for trigrams: scan of names, which is still much smaller than planets
+            matches = 'SELECT rowid >> 2 AS id, MIN(length(name)) AS name_rank FROM names_fts ' \
+                      ' WHERE instr(xn_casefold(name), ?) > 0 AND (rowid & 3) IN ' + kinds + ' GROUP BY id'
+            params = (text.casefold(), )
+        join = 'JOIN (' + matches + ') AS m ON m.id = ' + id_col
+        q = self.create_query(join, sort_col, sort_order, rank_col='m.name_rank')
+        self._cur.execute(q, params)
+        return self._rows_to_res_list()
+
     def query_inactives(self, user_flags, gal_ints, s_min, s_max, min_rank=0, sort_col=None, sort_order=None):
         user_where = ''
         gals_where = ''
@@ -228,3 +280,19 @@ class GalaxyDB:
             p['luna_diameter'] = GalaxyDB.safe_int(row['luna_diameter'])
             ret.append(p)
         return ret
+
+    def query_player_history(self, user_id: int, field: str=None) -> list:
+        """
+        Change events of player's planets, see galaxy_history.PlanetHistory
+        :param user_id: player id
+        :param field: only changes of this planets column, e.g. 'user_onlinetime', or all if None
+        :return: list of dicts, oldest first
+        """
+        q = 'SELECT ts, planet_id, g,s,p, field, old_value, new_value FROM planet_history WHERE user_id=?'
+        params = (user_id, )
+        if field is not None:
+            q += ' AND field=?'
+            params = (user_id, field)
+        q += ' ORDER BY ts'
+        self._cur.execute(q, params)
+        return [dict(row) for row in self._cur.fetchall()]
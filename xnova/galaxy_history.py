@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import itertools
+import sqlite3
+import time
+
+from . import xn_logger
+
+logger = xn_logger.get(__name__, debug=False)
+
+
+# planets table columns whose changes are recorded. Not tracked: debris field
+# (planet_metal, planet_crystal), user_rank, user_totalpoints and ally_members,
+# they change on almost every scan and would bloat history with noise
+HISTORY_COLUMNS = ('planet_name', 'planet_type', 'planet_destroyed',
+                   'luna_id', 'luna_name', 'luna_diameter', 'luna_destroyed',
+                   'user_id', 'user_name', 'user_authlevel', 'user_onlinetime',
+                   'user_banned', 'user_ro', 'user_race',
+                   'ally_id', 'ally_name', 'ally_tag')
+
+# pseudo-field of events for planet that appeared (old_value NULL, new_value
+# planet_id) or disappeared (old_value planet_id, new_value NULL) from system
+FIELD_PLANET = 'planet_id'
+
+
+# Change history of planets, kept in galaxy DB (table planet_history).
+# GalaxyDBWriter calls record_system() for every re-scanned system whose
+# contents changed, before its stored planets are replaced, in the same
+# transaction; stored rows are diffed against new ones and one compact event
+# (planet_id, field, old_value, new_value, ts) is added for every changed
+# field. Event also has planet owner (user_id, the new one for changed owner)
+# and coordinates, so "when did player X go inactive" is an index lookup:
+#   SELECT ts, old_value, new_value FROM planet_history
+#    WHERE user_id=? AND field='user_onlinetime' ORDER BY ts
+# History grows forever unless maintain() is called: events older than
+# retention are deleted, and events older than downsample age are merged so
+# that there is at most one event per planet field per downsample period.
+class PlanetHistory:
+    def __init__(self, db: sqlite3.Connection):
+        self._db = db
+        self.retention_secs = 365 * 24 * 3600  # 0 - keep forever
+        self.downsample_secs = 30 * 24 * 3600  # 0 - do not downsample
+        self.downsample_period = 24 * 3600
+        self.num_events = 0  # recorded by this object
+
+    @staticmethod
+    def diff_rows(old_rows: list, new_rows: list, columns: list, ts: int) -> list:
+        """
+        Compares stored and new planets of one system
+        :param old_rows: stored planets table rows of system
+        :param new_rows: new planets table rows of system
+        :param columns: planets table column names, in rows order
+        :param ts: time of scan
+        :return: list of events, tuples in planet_history columns order
+        """
+        col_index = {name: i for i, name in enumerate(columns)}
+        i_planet_id = col_index['planet_id']
+        i_user_id = col_index['user_id']
+        i_g, i_s, i_p = col_index['g'], col_index['s'], col_index['p']
+        tracked = [(name, col_index[name]) for name in HISTORY_COLUMNS]
+        old_planets = {row[i_planet_id]: row for row in old_rows}
+        new_planets = {row[i_planet_id]: row for row in new_rows}
+        events = []
+        for planet_id, new in new_planets.items():
+            old = old_planets.get(planet_id)
+            if old is None:
+                events.append((planet_id, new[i_user_id], new[i_g], new[i_s], new[i_p],
+                               FIELD_PLANET, None, planet_id, ts))
+                continue
+            for name, i in tracked:
+                if old[i] != new[i]:
+                    events.append((planet_id, new[i_user_id], new[i_g], new[i_s], new[i_p],
+                                   name, old[i], new[i], ts))
+        for planet_id, old in old_planets.items():
+            if planet_id not in new_planets:
+                events.append((planet_id, old[i_user_id], old[i_g], old[i_s], old[i_p],
+                               FIELD_PLANET, planet_id, None, ts))
+        return events
+
+    def record_system(self, cur: sqlite3.Cursor, gal: int, sys_: int, new_rows: list, ts: int,
+                      skip_bad_rows: bool=False) -> int:
+        """
+        Adds change events of system, must be called before its stored planets are replaced,
+        inside writer transaction
+        :param cur: cursor of writer transaction
+        :param gal: galaxy
+        :param sys_: solar system
+        :param new_rows: new planets table rows (tuples in table columns order) of system
+        :param ts: time of scan
+        :param skip_bad_rows: skip events with values that do not fit into sqlite integer
+        :return: number of events added
+        """
+        cur.execute('SELECT * FROM planets WHERE g=? AND s=?', (gal, sys_))
+        old_rows = cur.fetchall()
+        columns = [col[0] for col in cur.description]
+        events = self.diff_rows(old_rows, new_rows, columns, ts)
+        q_insert = 'INSERT INTO planet_history (planet_id, user_id, g, s, p, field, old_value, new_value, ts) ' \
+                   ' VALUES (?,?,?,?,?,?,?,?,?)'
+        if not skip_bad_rows:
+            cur.executemany(q_insert, events)
+        else:
+            for event in events:
+                try:
+                    cur.execute(q_insert, event)
+                except OverflowError:
+                    logger.warn('Skipped history event with too big value: {0}'.format(event))
+        self.num_events += len(events)
+        return len(events)
+
+    def apply_retention(self, now: int=None) -> int:
+        """
+        Deletes events older than retention time
+        :return: number of deleted events
+        """
+        if self.retention_secs <= 0:
+            return 0
+        if now is None:
+            now = int(time.time())
+        with self._db:
+            cur = self._db.execute('DELETE FROM planet_history WHERE ts < ?', (now - self.retention_secs, ))
+            num_deleted = cur.rowcount
+        return num_deleted
+
+    def downsample(self, now: int=None) -> int:
+        """
+        Merges events older than downsample age: all events of one planet field within
+        one downsample period become one, from the first old value to the last new value
+        (at the time of the last one); if the field is back to the old value, e.g. player
+        went inactive and back within a day, there is no event at all
+        :return: number of removed events
+        """
+        if (self.downsample_secs <= 0) or (self.downsample_period <= 0):
+            return 0
+        if now is None:
+            now = int(time.time())
+        period = self.downsample_period
+        cur = self._db.cursor()
+        # index planet_history_planet gives this order without sorting
+        cur.execute('SELECT rowid, planet_id, field, old_value, new_value, ts FROM planet_history '
+                    ' WHERE ts < ? ORDER BY planet_id, field, ts, rowid', (now - self.downsample_secs, ))
+        to_delete = []
+        to_update = []
+        for key, events in itertools.groupby(cur, key=lambda ev: (ev[1], ev[2], ev[5] // period)):
+            events = list(events)
+            if len(events) == 1:
+                continue
+            first = events[0]
+            last = events[-1]
+            to_delete.extend([(ev[0], ) for ev in events[:-1]])
+            if first[3] == last[4]:
+                to_delete.append((last[0], ))
+            else:
+                to_update.append((first[3], last[0]))
+        cur.close()
+        with self._db:
+            self._db.executemany('DELETE FROM planet_history WHERE rowid=?', to_delete)
+            self._db.executemany('UPDATE planet_history SET old_value=? WHERE rowid=?', to_update)
+        return len(to_delete)
+
+    # retention and downsampling, run after scan
+    def maintain(self, now: int=None):
+        if now is None:
+            now = int(time.time())
+        num_expired = self.apply_retention(now)
+        num_merged = self.downsample(now)
+        if (num_expired > 0) or (num_merged > 0):
+            logger.info('Planets history: {0} old events deleted, {1} merged'.format(num_expired, num_merged))
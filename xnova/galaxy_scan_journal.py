@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import time
+
+from . import xn_logger
+
+logger = xn_logger.get(__name__, debug=False)
+
+
+# Durable checkpoint journal of galaxy scan, kept in galaxy DB (tables scans,
+# scan_units). Outcomes of processed systems are recorded by GalaxyDBWriter in
+# the same transaction as their planets, so journal never says a system is
+# done while its data is lost. Interrupted scan can be resumed: systems that
+# are done are skipped, failed ones are retried.
+class ScanJournal:
+    OK = 'ok'
+    EMPTY = 'empty'
+    HTTP_ERROR = 'http_error'
+    PARSE_ERROR = 'parse_error'
+    DONE_OUTCOMES = (OK, EMPTY)
+
+    def __init__(self, db: sqlite3.Connection):
+        self._db = db
+        self.scan_id = None
+
+    # start new scan of given systems list, returns scan id
+    def start_scan(self, units: list) -> int:
+        with self._db:
+            cur = self._db.cursor()
+            cur.execute('INSERT INTO scans (started, finished, units) VALUES (?, NULL, ?)',
+                        (int(time.time()), json.dumps([list(unit) for unit in units])))
+            self.scan_id = cur.lastrowid
+            cur.close()
+        logger.info('Started scan #{0} of {1} systems'.format(self.scan_id, len(units)))
+        return self.scan_id
+
+    def find_unfinished_scan(self):
+        cur = self._db.cursor()
+        cur.execute('SELECT scan_id FROM scans WHERE finished IS NULL ORDER BY scan_id DESC LIMIT 1')
+        row = cur.fetchone()
+        cur.close()
+        if row is None:
+            return None
+        return row[0]
+
+    def resume_scan(self, scan_id: int) -> list:
+        """
+        Continues interrupted scan
+        :param scan_id: scan to continue
+        :return: list of (g, s) that are not done yet, in originally planned order
+        """
+        cur = self._db.cursor()
+        cur.execute('SELECT units FROM scans WHERE scan_id=?', (scan_id, ))
+        row = cur.fetchone()
+        if row is None:
+            cur.close()
+            raise ValueError('No such scan: {0}'.format(scan_id))
+        units = [tuple(unit) for unit in json.loads(row[0])]
+        cur.execute('SELECT g, s, outcome FROM scan_units WHERE scan_id=?', (scan_id, ))
+        done = set()
+        num_failed = 0
+        for g, s, outcome in cur.fetchall():
+            if outcome in self.DONE_OUTCOMES:
+                done.add((g, s))
+            else:
+                num_failed += 1
+        cur.close()
+        self.scan_id = scan_id
+        units_left = [unit for unit in units if unit not in done]
+        logger.info('Resuming scan #{0}: {1} of {2} systems done, {3} failed will be retried, {4} left total'.format(
+            scan_id, len(done), len(units), num_failed, len(units_left)))
+        return units_left
+
+    # save systems outcomes, entries are tuples (g, s, outcome, ts);
+    # called by DB writer, inside its transaction
+    def record(self, cur: sqlite3.Cursor, entries: list):
+        if (self.scan_id is None) or (len(entries) == 0):
+            return
+        cur.executemany('INSERT INTO scan_units (scan_id, g, s, outcome, attempts, ts) '
+                        ' VALUES (?, ?, ?, ?, 1, ?) '
+                        ' ON CONFLICT (scan_id, g, s) DO UPDATE SET '
+                        '  outcome = excluded.outcome, attempts = attempts + 1, ts = excluded.ts',
+                        [(self.scan_id, entry[0], entry[1], entry[2], entry[3]) for entry in entries])
+
+    # returns dict outcome => number of systems
+    def get_outcome_counts(self) -> dict:
+        cur = self._db.cursor()
+        cur.execute('SELECT outcome, COUNT(*) FROM scan_units WHERE scan_id=? GROUP BY outcome', (self.scan_id, ))
+        ret = dict(cur.fetchall())
+        cur.close()
+        return ret
+
+    # mark scan finished if all its systems are done; returns True if finished
+    def finish_scan(self) -> bool:
+        if self.scan_id is None:
+            return False
+        cur = self._db.cursor()
+        cur.execute('SELECT units FROM scans WHERE scan_id=?', (self.scan_id, ))
+        num_units = len(json.loads(cur.fetchone()[0]))
+        cur.execute('SELECT COUNT(*) FROM scan_units WHERE scan_id=? AND outcome IN (?, ?)',
+                    (self.scan_id, ) + self.DONE_OUTCOMES)
+        num_done = cur.fetchone()[0]
+        cur.close()
+        counts = self.get_outcome_counts()
+        logger.info('Scan #{0} outcomes: {1}'.format(self.scan_id, counts))
+        if num_done < num_units:
+            logger.warn('Scan #{0} is not complete: {1} of {2} systems done, use --resume to retry failed'.format(
+                self.scan_id, num_done, num_units))
+            return False
+        with self._db:
+            self._db.execute('UPDATE scans SET finished=? WHERE scan_id=?', (int(time.time()), self.scan_id))
+        return True
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import time
+
+from . import xn_logger
+
+logger = xn_logger.get(__name__, debug=False)
+
+
+# What is known about one solar system before the scan
+class SystemInfo:
+    def __init__(self, g: int, s: int):
+        self.g = g
+        self.s = s
+        # from systems_meta table
+        self.last_fetch = 0  # 0 - never fetched
+        self.num_scans = 0
+        self.num_changes = 0
+        self.last_change = 0
+        # from planets table
+        self.num_planets = 0
+        self.num_active_players = 0  # planets of players that are not inactive/banned/on vacation
+        # from page cache
+        self.cache_mtime = 0
+
+    # probability that system changes between two scans, with a prior of 1/2
+    # for systems we know nothing about
+    def change_rate(self) -> float:
+        return (self.num_changes + 1) / (self.num_scans + 2)
+
+
+# Incremental scan planner: decides which solar systems are worth a network
+# request, and in which order. Systems that have a fresh page in cache are
+# free and always go first. Other systems are ordered by expected value of
+# refetching them: how often they change, how many active players live there,
+# and how long ago they were fetched. Systems that are empty and did not
+# change for stable_secs are skipped. Only `budget` network requests are
+# planned (0 - unlimited).
+class GalaxyScanPlanner:
+    def __init__(self, db: sqlite3.Connection, page_cache, max_cache_secs: int):
+        self._db = db
+        self._page_cache = page_cache
+        self.max_cache_secs = max_cache_secs
+        self.stable_secs = 7 * 24 * 3600
+        self.active_player_weight = 0.25
+        self.planet_weight = 0.02
+
+    def load_systems_info(self, units: list) -> dict:
+        infos = {}
+        for unit in units:
+            info = SystemInfo(unit[0], unit[1])
+            mtime = self._page_cache.get_page_mtime('galaxy_{0}_{1}'.format(unit[0], unit[1]))
+            if mtime is not None:
+                info.cache_mtime = mtime
+            infos[unit] = info
+        cur = self._db.cursor()
+        cur.execute('SELECT g, s, last_fetch, num_scans, num_changes, last_change FROM systems_meta')
+        for row in cur.fetchall():
+            info = infos.get((row[0], row[1]))
+            if info is not None:
+                info.last_fetch = row[2] or 0
+                info.num_scans = row[3] or 0
+                info.num_changes = row[4] or 0
+                info.last_change = row[5] or 0
+        cur.execute('SELECT g, s, COUNT(*), '
+                    ' SUM(user_id > 0 AND user_onlinetime = 0 AND user_banned = 0 AND user_ro = 0) '
+                    ' FROM planets GROUP BY g, s')
+        for row in cur.fetchall():
+            info = infos.get((row[0], row[1]))
+            if info is not None:
+                info.num_planets = row[2] or 0
+                info.num_active_players = row[3] or 0
+        cur.close()
+        return infos
+
+    def system_value(self, info: SystemInfo, now: int) -> float:
+        last_fetch = max(info.last_fetch, info.cache_mtime)
+        if last_fetch == 0:
+            return float('inf')  # never seen, must fetch
+        age_periods = (now - last_fetch) / max(self.max_cache_secs, 1)
+        weight = info.change_rate() \
+            + self.active_player_weight * info.num_active_players \
+            + self.planet_weight * info.num_planets
+        return age_periods * weight
+
+    def is_stable_empty(self, info: SystemInfo, now: int) -> bool:
+        if (info.num_planets > 0) or (info.num_scans < 2):
+            return False
+        last_fetch = max(info.last_fetch, info.cache_mtime)
+        if now - last_fetch > self.stable_secs:
+            return False  # check it from time to time anyway
+        return now - max(info.last_change, 0) > self.stable_secs
+
+    def plan(self, units: list, budget: int=0) -> list:
+        """
+        Orders solar systems to scan
+        :param units: list of (g, s) tuples
+        :param budget: max number of network requests, 0 - no limit
+        :return: list of (g, s): first systems with fresh cached pages, then
+                 systems to download, most valuable first
+        """
+        now = int(time.time())
+        infos = self.load_systems_info(units)
+        cached = []
+        to_fetch = []
+        num_skipped = 0
+        for unit in units:
+            info = infos[unit]
+            if (info.cache_mtime > 0) and (now - info.cache_mtime <= self.max_cache_secs):
+                cached.append(unit)
+            elif self.is_stable_empty(info, now):
+                num_skipped += 1
+            else:
+                to_fetch.append((self.system_value(info, now), unit))
+        to_fetch.sort(key=lambda item: item[0], reverse=True)
+        if (budget > 0) and (len(to_fetch) > budget):
+            num_skipped += len(to_fetch) - budget
+            to_fetch = to_fetch[:budget]
+        logger.info('Scan plan: {0} systems from cache, {1} to download, {2} skipped'.format(
+            len(cached), len(to_fetch), num_skipped))
+        return cached + [item[1] for item in to_fetch]
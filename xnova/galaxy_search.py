@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+from . import xn_logger
+from .galaxy_db_schema import NAME_PLAYER, NAME_ALLY, NAME_ALLY_TAG, NAMES_MAX_ID, name_rowid, \
+    fts_substring_query, has_names_index, fill_names_index
+
+logger = xn_logger.get(__name__, debug=False)
+
+
+# sqlite LIKE and lower() fold only ASCII letters; casefold() is registered
+# as SQL function for substring search in names shorter than trigram
+def register_casefold(conn: sqlite3.Connection):
+    conn.create_function('xn_casefold', 1, lambda s: s.casefold() if s is not None else None)
+
+
+# Full-text (trigram) index of player names and alliance names and tags of
+# galaxy DB (table names_fts), for substring search, which prefix LIKE on
+# planets table cannot do. GalaxyDBWriter calls update() for planets it
+# writes, in the same transaction, so renamed players and alliances are
+# found by their new names right away; prune() removes names of players and
+# alliances that have no planets anymore; rebuild() indexes all planets again.
+# If sqlite has no FTS5, there is no names_fts table, and index is disabled.
+class GalaxyNamesIndex:
+    def __init__(self, db: sqlite3.Connection):
+        self._db = db
+        self.enabled = has_names_index(db)
+        if not self.enabled:
+            logger.warn('No names_fts table (sqlite without FTS5?), names search index is not updated')
+
+    def update(self, cur: sqlite3.Cursor, names: list):
+        """
+        Sets current names of players and alliances
+        :param cur: cursor of writer transaction
+        :param names: list of tuples (user_id, user_name, ally_id, ally_name, ally_tag) of planets
+        """
+        if not self.enabled:
+            return
+        rows = {}
+        for user_id, user_name, ally_id, ally_name, ally_tag in names:
+            if user_id and (0 < user_id <= NAMES_MAX_ID) and user_name:
+                rows[name_rowid(NAME_PLAYER, user_id)] = user_name
+            if ally_id and (0 < ally_id <= NAMES_MAX_ID):
+                if ally_name:
+                    rows[name_rowid(NAME_ALLY, ally_id)] = ally_name
+                if ally_tag:
+                    rows[name_rowid(NAME_ALLY_TAG, ally_id)] = ally_tag
+        # FTS5 has no unique index on content, so replace by rowid
+        cur.executemany('INSERT OR REPLACE INTO names_fts (rowid, name) VALUES (?, ?)', rows.items())
+
+    # removes names that no planets refer to anymore, returns number of removed
+    def prune(self) -> int:
+        if not self.enabled:
+            return 0
+        with self._db:
+            cur = self._db.execute(
+                'DELETE FROM names_fts WHERE rowid IN ( '
+                ' SELECT rowid FROM names_fts WHERE (rowid & 3) = ? AND (rowid >> 2) NOT IN '
+                '  (SELECT user_id FROM planets) '
+                ' UNION ALL '
+                ' SELECT rowid FROM names_fts WHERE (rowid & 3) IN (?, ?) AND (rowid >> 2) NOT IN '
+                '  (SELECT ally_id FROM planets) )',
+                (NAME_PLAYER, NAME_ALLY, NAME_ALLY_TAG))
+            num_removed = cur.rowcount
+        return num_removed
+
+    # fills index again from all planets, for planets written not by update():
+    # copied by SQL from other DB, or with names_fts created after them
+    def rebuild(self):
+        if not self.enabled:
+            return
+        with self._db:
+            cur = self._db.cursor()
+            cur.execute('DELETE FROM names_fts')
+            fill_names_index(cur)
+            cur.close()
@@ -0,0 +1,151 @@
+import time
+
+from . import xn_logger
+from .lastlogs_utils import LLDb
+from .xn_scan_scheduler import ScanScheduler
+
+logger = xn_logger.get(__name__, debug=False)
+
+
+# Crawls combat logs, which have sequential ids, with several concurrent
+# workers (request rate is limited by their downloaders' shared TokenBucket).
+# Works in rounds: every round retries due gaps and probes a window of ids
+# just above the frontier - the highest id known to exist. Window grows while
+# it is full of logs (catching up after downtime) and shrinks to what server
+# has produced since the last round, so crawl rate follows log production
+# rate instead of a fixed delay. When a window has no new logs, crawl is
+# caught up: it stops, or in follow mode waits poll_interval and goes on.
+# Round ends early when max_probe_misses ids above the frontier have no log,
+# so a big window does not waste requests past the end of logs.
+# Ids without log are not simply counted as errors:
+#  - above the frontier: log is not created yet, probed again next round;
+#  - below the frontier: gap, recorded in LLDb log_gaps and retried later,
+#    until it is retried max_attempts times and becomes permanent.
+# fetch_func(ctx, log_id) runs in worker threads, with context object made by
+# worker_init(), and returns tuple (outcome, log): outcome is one of
+# FOUND, UNAVAILABLE, NONEXISTENT, FAILED; log is parsed log for FOUND.
+# Logs are stored in the thread that called run(), LLDb is used only there;
+# logs and gaps changes of every round are committed together.
+class LogsCrawler:
+    FOUND = 'found'
+    UNAVAILABLE = 'unavailable'  # "log is not available for viewing yet"
+    NONEXISTENT = 'nonexistent'
+    FAILED = 'failed'  # download or parse error
+
+    def __init__(self, lldb: LLDb, fetch_func, num_workers: int=1, worker_init=None):
+        self._lldb = lldb
+        self._fetch_func = fetch_func
+        self._worker_init = worker_init
+        self.num_workers = max(int(num_workers), 1)
+        self.min_window = self.num_workers
+        self.max_window = 50 * self.num_workers
+        self.follow = False
+        self.poll_interval = 60.0  # seconds between rounds when caught up, in follow mode
+        self.retry_interval = 600  # seconds before gap is retried
+        self.max_attempts = {LLDb.GAP_UNAVAILABLE: 20, LLDb.GAP_MISSING: 3, LLDb.GAP_FAILED: 10}
+        self.max_failed_rounds = 3  # stop after this many rounds in a row with only failures
+        self.max_probe_misses = 2 * self.num_workers
+        self.frontier = 0
+        self.num_stored = 0
+        self.num_rounds = 0
+        self._round_outcomes = {}  # log_id => outcome, of current round
+        self._scheduler = None
+
+    def _init_frontier(self):
+        # logs that are not available yet exist too
+        self.frontier = max(self._lldb.get_lastlog_id(), self._lldb.get_max_gap_id(LLDb.GAP_UNAVAILABLE))
+
+    def _on_result(self, log_id: int, result):
+        outcome = self.FAILED  # worker crashed
+        log = None
+        if result is not None:
+            outcome, log = result
+        self._round_outcomes[log_id] = outcome
+        if outcome == self.FOUND:
+            log.log_id = log_id
+            self._lldb.store_log(log)
+            self._lldb.remove_gap(log_id)
+            self.num_stored += 1
+        if outcome in (self.FOUND, self.UNAVAILABLE):
+            self.frontier = max(self.frontier, log_id)
+        elif (outcome == self.NONEXISTENT) and (log_id > self.frontier):
+            misses = [i for i, o in self._round_outcomes.items() if (i > self.frontier) and (o == self.NONEXISTENT)]
+            if len(misses) >= self.max_probe_misses:
+                self._scheduler.stop()  # past the end of logs
+
+    def _add_gap(self, log_id: int, kind: str):
+        if self._lldb.add_gap(log_id, kind, self.max_attempts[kind]):
+            logger.warn('Log id {0}: no log after {1} attempts, gap is permanent'.format(
+                log_id, self.max_attempts[kind]))
+
+    # record gaps after round, when frontier is known
+    def _record_gaps(self):
+        for log_id, outcome in self._round_outcomes.items():
+            if outcome == self.UNAVAILABLE:
+                self._add_gap(log_id, LLDb.GAP_UNAVAILABLE)
+            elif log_id > self.frontier:
+                # not created yet, or failed and will be probed again anyway
+                self._lldb.remove_gap(log_id)
+            elif outcome == self.NONEXISTENT:
+                self._add_gap(log_id, LLDb.GAP_MISSING)
+            elif outcome == self.FAILED:
+                self._add_gap(log_id, LLDb.GAP_FAILED)
+
+    def run_round(self, window: int) -> int:
+        """
+        Retries due gaps and probes window of ids above frontier
+        :param window: number of ids to probe
+        :return: number of new logs (or not yet available ones) above old frontier
+        """
+        old_frontier = self.frontier
+        retry_ids = self._lldb.get_gaps_to_retry(int(time.time()) - self.retry_interval)
+        probe_ids = [log_id for log_id in range(old_frontier + 1, old_frontier + 1 + window)
+                     if log_id not in retry_ids]
+        self._round_outcomes = {}
+        self._scheduler = ScanScheduler(self._fetch_func, self.num_workers, self._worker_init)
+        self._scheduler.run(retry_ids + probe_ids, self._on_result)
+        self._record_gaps()
+        self._lldb.flush()  # logs and gaps of round in one transaction
+        self.num_rounds += 1
+        num_new = len([log_id for log_id, outcome in self._round_outcomes.items()
+                       if (log_id > old_frontier) and (outcome in (self.FOUND, self.UNAVAILABLE))])
+        num_probed = len([log_id for log_id in probe_ids if log_id in self._round_outcomes])
+        logger.info('Round {0}: {1} retried gaps, {2} ids probed, {3} new logs, frontier {4}'.format(
+            self.num_rounds, len(retry_ids), num_probed, num_new, self.frontier))
+        return num_new
+
+    def run(self):
+        """
+        Crawls until caught up, or forever in follow mode
+        :return: number of stored logs
+        """
+        self._init_frontier()
+        logger.info('Crawling logs from id {0}, {1} workers'.format(self.frontier + 1, self.num_workers))
+        window = self.min_window
+        num_failed_rounds = 0
+        while True:
+            num_new = self.run_round(window)
+            if (len(self._round_outcomes) > 0) and \
+                    all([outcome == self.FAILED for outcome in self._round_outcomes.values()]):
+                num_failed_rounds += 1
+                if num_failed_rounds >= self.max_failed_rounds:
+                    logger.error('{0} rounds in a row failed completely, server is down?'.format(num_failed_rounds))
+                    if not self.follow:
+                        break
+                    time.sleep(self.poll_interval)
+                continue
+            num_failed_rounds = 0
+            if num_new >= window:
+                # window is full of logs, we are behind: probe further
+                window = min(window * 2, self.max_window)
+            elif num_new > 0:
+                # about as many as server makes between rounds, with some reserve
+                window = min(max(num_new * 2, self.min_window), self.max_window)
+            else:
+                window = self.min_window
+                if not self.follow:
+                    break
+                time.sleep(self.poll_interval)
+        logger.info('Crawl done: {0} logs stored in {1} rounds, frontier {2}, gaps: {3}'.format(
+            self.num_stored, self.num_rounds, self.frontier, self._lldb.get_gap_counts()))
+        return self.num_stored
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""Versioned schema of combat logs DB (lastlogs.db, lastlogs5.db), written by
+LLDb and read by the site. Works the same way as galaxy_db_schema:
+current schema version is stored in sqlite "PRAGMA user_version",
+every migration function upgrades DB from version N to N+1,
+existing DB files are upgraded in place.
+"""
+import re
+import sqlite3
+
+
+# log_participants sides
+SIDE_ATTACKER = 'att'
+SIDE_DEFENDER = 'def'
+
+_COORDS_RE = re.compile(r'\[(\d+):(\d+):(\d+)\]')
+
+
+# "[1:2:3]" => (1, 2, 3); (None, None, None) if there are no coords
+def parse_coords(coords: str) -> tuple:
+    m = _COORDS_RE.search(coords or '')
+    if m is None:
+        return None, None, None
+    return int(m.group(1)), int(m.group(2)), int(m.group(3))
+
+
+def split_participants(attacker: str, defender: str, attacker_coords: str, defender_coords: str) -> list:
+    """
+    Participants of log from comma-joined logs table columns, for logs whose parser
+    does not give participants list: i-th coords belong to i-th player, if there are any
+    :return: list of tuples (side, player_name, coords)
+    """
+    ret = []
+    for side, names, coords in ((SIDE_ATTACKER, attacker, attacker_coords),
+                                (SIDE_DEFENDER, defender, defender_coords)):
+        if not names:
+            continue
+        coords_list = _COORDS_RE.findall(coords or '')
+        for i, name in enumerate(names.split(',')):
+            player_coords = ''
+            if i < len(coords_list):
+                player_coords = '[{0}:{1}:{2}]'.format(*coords_list[i])
+            ret.append((side, name, player_coords))
+    return ret
+
+
+# log_participants rows, player is listed once per side
+def participants_rows(log_id: int, participants: list) -> list:
+    ret = []
+    seen = set()
+    for side, name, coords in participants:
+        if (side, name) in seen:
+            continue
+        seen.add((side, name))
+        ret.append((log_id, side, name) + parse_coords(coords))
+    return ret
+
+
+def _migration_1_create_logs(cur: sqlite3.Cursor):
+    # original table, as created by old LLDb versions
+    cur.execute('CREATE TABLE IF NOT EXISTS logs ( '
+                ' log_id INT, '
+                ' log_time TEXT, '
+                ' attacker TEXT, '
+                ' defender TEXT, '
+                ' attacker_coords TEXT, '
+                ' defender_coords TEXT, '
+                ' total_loss INT, '
+                ' po_me INT, '
+                ' po_cry INT,'
+                ' win_me INT, '
+                ' win_cry INT, '
+                ' win_deit INT )')
+
+
+def _migration_2_log_gaps(cur: sqlite3.Cursor):
+    # log ids below the crawl frontier that had no log, to retry later, see LogsCrawler
+    cur.execute('CREATE TABLE IF NOT EXISTS log_gaps ( '
+                ' log_id INTEGER PRIMARY KEY, '
+                ' kind TEXT, '
+                ' attempts INT, '
+                ' last_try INT )')
+
+
+def _migration_3_logs_primary_key(cur: sqlite3.Cursor):
+    # log_id becomes rowid: duplicates check and MAX(log_id) without table scan;
+    # log_time was stored as text, site compares it with numbers, so it could
+    # not use index for time range. Table is rebuilt, as sqlite cannot change
+    # columns; old versions could store duplicates, the first one is kept
+    cur.execute('CREATE TABLE logs_new ( '
+                ' log_id INTEGER PRIMARY KEY, '
+                ' log_time INTEGER, '
+                ' attacker TEXT, '
+                ' defender TEXT, '
+                ' attacker_coords TEXT, '
+                ' defender_coords TEXT, '
+                ' total_loss INT, '
+                ' po_me INT, '
+                ' po_cry INT,'
+                ' win_me INT, '
+                ' win_cry INT, '
+                ' win_deit INT )')
+    cur.execute('INSERT OR IGNORE INTO logs_new '
+                ' SELECT log_id, CAST(log_time AS INTEGER), attacker, defender, attacker_coords, defender_coords, '
+                '  total_loss, po_me, po_cry, win_me, win_cry, win_deit '
+                ' FROM logs WHERE log_id IS NOT NULL ORDER BY rowid')
+    cur.execute('DROP TABLE logs')
+    cur.execute('ALTER TABLE logs_new RENAME TO logs')
+    # logs for last N hours: "WHERE log_time >= ? ORDER BY log_time DESC"
+    cur.execute('CREATE INDEX IF NOT EXISTS logs_log_time ON logs (log_time)')
+
+
+def _migration_4_log_participants(cur: sqlite3.Cursor):
+    # every attacker and defender of log, logs.attacker/defender columns are
+    # comma-joined lists, that cannot be searched with index
+    cur.execute('CREATE TABLE IF NOT EXISTS log_participants ( '
+                ' log_id INT, '
+                ' side TEXT, '
+                ' player_name TEXT, '
+                ' g INT, '
+                ' s INT, '
+                ' p INT, '
+                ' PRIMARY KEY (log_id, side, player_name) ) WITHOUT ROWID')
+    # battles of player: exact name, and prefix LIKE 'name%' (needs NOCASE collation)
+    cur.execute('CREATE INDEX IF NOT EXISTS log_participants_player ON log_participants (player_name, log_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS log_participants_player_nc ON log_participants '
+                ' (player_name COLLATE NOCASE)')
+    # battles at planet, or in solar system
+    cur.execute('CREATE INDEX IF NOT EXISTS log_participants_coords ON log_participants (g, s, p, log_id)')
+    # fill from already stored logs
+    cur.execute('SELECT log_id, attacker, defender, attacker_coords, defender_coords FROM logs')
+    rows = []
+    for log_id, attacker, defender, attacker_coords, defender_coords in cur.fetchall():
+        rows.extend(participants_rows(log_id, split_participants(attacker, defender,
+                                                                 attacker_coords, defender_coords)))
+    cur.executemany('INSERT OR IGNORE INTO log_participants VALUES (?,?,?,?,?,?)', rows)
+
+
+def _migration_5_player_names(cur: sqlite3.Cursor):
+    # distinct participant names, and full-text (trigram) index of them, for
+    # case-insensitive substring search of players; FTS rowid is name_id.
+    # Trigram tokenizer needs sqlite 3.34+, without it only player_names is there
+    cur.execute('CREATE TABLE IF NOT EXISTS player_names ( '
+                ' name_id INTEGER PRIMARY KEY, '
+                ' name TEXT UNIQUE )')
+    cur.execute('INSERT OR IGNORE INTO player_names (name) '
+                ' SELECT DISTINCT player_name FROM log_participants ORDER BY player_name')
+    try:
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS player_names_fts USING fts5(name, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        return
+    cur.execute('INSERT INTO player_names_fts (rowid, name) SELECT name_id, name FROM player_names')
+
+
+def _migration_6_combat_stats(cur: sqlite3.Cursor):
+    # results that lastlogs5 parser gives, but were not stored; NULL for older logs
+    cur.execute('ALTER TABLE logs ADD COLUMN att_loss INT')
+    cur.execute('ALTER TABLE logs ADD COLUMN def_loss INT')
+    cur.execute('ALTER TABLE logs ADD COLUMN moon_chance INT')
+    # daily combat totals, updated by LLDb with every stored log, see lastlogs_stats;
+    # day is unix time of UTC day start. Filled from stored logs by LLDb after upgrade
+    stats_columns = ' battles INT, ' \
+                    ' attacks INT, ' \
+                    ' defences INT, ' \
+                    ' losses INT, ' \
+                    ' total_loss INT, ' \
+                    ' win_me INT, ' \
+                    ' win_cry INT, ' \
+                    ' win_deit INT, ' \
+                    ' po_me INT, ' \
+                    ' po_cry INT, ' \
+                    ' moon_chance_sum INT, ' \
+                    ' moon_chances INT, '
+    cur.execute('CREATE TABLE IF NOT EXISTS player_stats_daily ( '
+                ' player_name TEXT, '
+                ' day INT, ' + stats_columns +
+                ' PRIMARY KEY (player_name, day) ) WITHOUT ROWID')
+    cur.execute('CREATE TABLE IF NOT EXISTS ally_stats_daily ( '
+                ' ally_id INT, '
+                ' day INT, '
+                ' ally_tag TEXT, ' + stats_columns +
+                ' PRIMARY KEY (ally_id, day) ) WITHOUT ROWID')
+    # leaderboards for last N days
+    cur.execute('CREATE INDEX IF NOT EXISTS player_stats_daily_day ON player_stats_daily (day)')
+    cur.execute('CREATE INDEX IF NOT EXISTS ally_stats_daily_day ON ally_stats_daily (day)')
+
+
+LASTLOGS_DB_MIGRATIONS = [
+    _migration_1_create_logs,
+    _migration_2_log_gaps,
+    _migration_3_logs_primary_key,
+    _migration_4_log_participants,
+    _migration_5_player_names,
+    _migration_6_combat_stats
+]
+
+LASTLOGS_DB_SCHEMA_VERSION = len(LASTLOGS_DB_MIGRATIONS)
+# version, that added combat stats tables; LLDb fills them when upgrading from older one
+COMBAT_STATS_SCHEMA_VERSION = LASTLOGS_DB_MIGRATIONS.index(_migration_6_combat_stats) + 1
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    cur = conn.cursor()
+    cur.execute('PRAGMA user_version')
+    version = cur.fetchone()[0]
+    cur.close()
+    return version
+
+
+def upgrade_lastlogs_db(conn: sqlite3.Connection) -> int:
+    """
+    Brings combat logs DB schema to the latest version, applying every missing
+    migration in its own transaction. Safe to call from several processes
+    at once: version is re-checked after DB write lock is taken.
+    :param conn: sqlite3 connection to combat logs DB
+    :return: schema version before upgrade
+    """
+    old_version = get_schema_version(conn)
+    if old_version >= LASTLOGS_DB_SCHEMA_VERSION:
+        return old_version
+    if conn.in_transaction:
+        conn.commit()
+    cur = conn.cursor()
+    try:
+        while True:
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute('PRAGMA user_version')
+            version = cur.fetchone()[0]
+            if version >= LASTLOGS_DB_SCHEMA_VERSION:
+                conn.commit()
+                break
+            LASTLOGS_DB_MIGRATIONS[version](cur)
+            cur.execute('PRAGMA user_version = {0}'.format(version + 1))
+            conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return old_version
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+
+from . import xn_logger
+from .lastlogs_db_schema import SIDE_ATTACKER, SIDE_DEFENDER
+
+logger = xn_logger.get(__name__, debug=False)
+
+
+# columns of player_stats_daily and ally_stats_daily with totals, in tables order
+STATS_COLUMNS = ('battles', 'attacks', 'defences', 'losses', 'total_loss',
+                 'win_me', 'win_cry', 'win_deit', 'po_me', 'po_cry',
+                 'moon_chance_sum', 'moon_chances')
+
+# logs table columns, that stats are counted from, in order of log tuples given to CombatStats
+STATS_LOG_COLUMNS = ('log_id', 'log_time', 'total_loss', 'po_me', 'po_cry',
+                     'win_me', 'win_cry', 'win_deit', 'att_loss', 'def_loss', 'moon_chance')
+
+DAY_SECS = 24 * 3600
+
+
+def day_start(log_time: int) -> int:
+    return log_time - log_time % DAY_SECS
+
+
+def side_stats(log: tuple, side: str) -> tuple:
+    """
+    Totals one battle adds for a player (or alliance) on one side of it
+    :param log: tuple in STATS_LOG_COLUMNS order
+    :param side: SIDE_ATTACKER or SIDE_DEFENDER
+    :return: tuple in STATS_COLUMNS order
+    """
+    (log_id, log_time, total_loss, po_me, po_cry, win_me, win_cry, win_deit,
+     att_loss, def_loss, moon_chance) = log
+    is_attacker = (side == SIDE_ATTACKER)
+    if is_attacker:
+        losses = att_loss
+    else:
+        losses = def_loss
+        win_me = win_cry = win_deit = 0  # loot goes to attackers
+    moon_chance = moon_chance or 0
+    return (1, int(is_attacker), int(side == SIDE_DEFENDER), losses or 0, total_loss or 0,
+            win_me or 0, win_cry or 0, win_deit or 0, po_me or 0, po_cry or 0,
+            moon_chance, int(moon_chance > 0))
+
+
+def _add_totals(totals: dict, key: tuple, stats: tuple):
+    old = totals.get(key)
+    if old is None:
+        totals[key] = list(stats)
+    else:
+        for i, val in enumerate(stats):
+            old[i] += val
+
+
+# Players' alliances, from galaxy DB (combat logs do not have them), re-read
+# when galaxy DB file changes. Battles are counted for the alliance player
+# is in when log is stored.
+class GalaxyAlliances:
+    def __init__(self, galaxy_db_fn: str):
+        self._db_fn = galaxy_db_fn
+        self._mtime = None
+        self._alliances = {}  # player name => (ally_id, ally_tag)
+
+    def refresh(self):
+        try:
+            mtime = os.path.getmtime(self._db_fn)
+        except OSError:
+            if self._mtime is None:
+                logger.warn('Galaxy DB {0} not found, alliance stats are not counted'.format(self._db_fn))
+                self._mtime = 0
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            conn = sqlite3.connect(self._db_fn)
+            cur = conn.cursor()
+            cur.execute("SELECT user_name, ally_id, MAX(ally_tag) FROM planets "
+                        " WHERE ally_id > 0 AND user_name != '' GROUP BY user_id")
+            self._alliances = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warn('Cannot read alliances from galaxy DB {0}: {1}'.format(self._db_fn, str(e)))
+            return
+        self._mtime = mtime
+        logger.info('Loaded alliances of {0} players from {1}'.format(len(self._alliances), self._db_fn))
+
+    # (ally_id, ally_tag) of player, or None
+    def get(self, player_name: str):
+        return self._alliances.get(player_name)
+
+
+# Daily combat totals of players and alliances (tables player_stats_daily and
+# ally_stats_daily of combat logs DB), so that site can show leaderboards and
+# trends from them instead of scanning logs. LLDb calls add_logs() for every
+# batch of new logs, in the same transaction, and totals are incremented with
+# upsert. Every participant gets totals of the side of battle: its losses, loot for
+# attackers, debris field and moon chance of battle; alliance gets them once
+# per battle side, even if several of its players were there.
+# If alliances (GalaxyAlliances) is None, only players' totals are counted.
+class CombatStats:
+    def __init__(self, alliances: GalaxyAlliances=None):
+        self.alliances = alliances
+
+    def add_logs(self, cur: sqlite3.Cursor, logs: list, participants: list):
+        """
+        Adds new logs to totals, each log must be added only once
+        :param cur: cursor of LLDb transaction
+        :param logs: list of tuples in STATS_LOG_COLUMNS order
+        :param participants: log_participants rows (log_id, side, player_name, ...) of logs
+        """
+        # logs without time (NULL or 0 in old DBs, where it was text) have no day, they are not counted
+        logs_by_id = {log[0]: log for log in logs if log[1]}
+        if self.alliances is not None:
+            self.alliances.refresh()
+        player_totals = {}  # (player_name, day) => list of totals
+        ally_totals = {}  # (ally_id, day) => list of totals
+        ally_tags = {}  # ally_id => ally_tag
+        ally_sides = set()  # (log_id, side, ally_id) already counted
+        for participant in participants:
+            log_id, side, player_name = participant[:3]
+            log = logs_by_id.get(log_id)
+            if log is None:
+                continue
+            day = day_start(log[1])
+            stats = side_stats(log, side)
+            _add_totals(player_totals, (player_name, day), stats)
+            ally = None
+            if self.alliances is not None:
+                ally = self.alliances.get(player_name)
+            if (ally is not None) and ((log_id, side, ally[0]) not in ally_sides):
+                ally_sides.add((log_id, side, ally[0]))
+                ally_tags[ally[0]] = ally[1]
+                _add_totals(ally_totals, (ally[0], day), stats)
+        add_totals = ', '.join(['{0} = {0} + excluded.{0}'.format(col) for col in STATS_COLUMNS])
+        placeholders = ','.join(['?'] * len(STATS_COLUMNS))
+        cur.executemany('INSERT INTO player_stats_daily (player_name, day, ' + ', '.join(STATS_COLUMNS) + ') '
+                        ' VALUES (?,?,' + placeholders + ') '
+                        ' ON CONFLICT (player_name, day) DO UPDATE SET ' + add_totals,
+                        [key + tuple(totals) for key, totals in player_totals.items()])
+        cur.executemany('INSERT INTO ally_stats_daily (ally_id, day, ally_tag, ' + ', '.join(STATS_COLUMNS) + ') '
+                        ' VALUES (?,?,?,' + placeholders + ') '
+                        ' ON CONFLICT (ally_id, day) DO UPDATE SET ally_tag = excluded.ally_tag, ' + add_totals,
+                        [key + (ally_tags[key[0]], ) + tuple(totals) for key, totals in ally_totals.items()])
+
+    def rebuild(self, conn: sqlite3.Connection, chunk_size: int=10000) -> int:
+        """
+        Counts totals again from all stored logs, in one transaction; needed after
+        upgrade from DB without stats, or to count alliances for older logs
+        :param conn: combat logs DB connection
+        :param chunk_size: number of logs read at once
+        :return: number of logs counted, logs without time are skipped
+        """
+        num_logs = 0
+        with conn:
+            cur = conn.cursor()
+            cur.execute('DELETE FROM player_stats_daily')
+            cur.execute('DELETE FROM ally_stats_daily')
+            last_id = None
+            while True:
+                if last_id is None:
+                    cur.execute('SELECT ' + ', '.join(STATS_LOG_COLUMNS) + ' FROM logs '
+                                ' WHERE log_time > 0 ORDER BY log_id LIMIT ?', (chunk_size, ))
+                else:
+                    cur.execute('SELECT ' + ', '.join(STATS_LOG_COLUMNS) + ' FROM logs '
+                                ' WHERE log_id > ? AND log_time > 0 ORDER BY log_id LIMIT ?', (last_id, chunk_size))
+                logs = cur.fetchall()
+                if len(logs) == 0:
+                    break
+                cur.execute('SELECT log_id, side, player_name FROM log_participants '
+                            ' WHERE log_id BETWEEN ? AND ?', (logs[0][0], logs[-1][0]))
+                self.add_logs(cur, logs, cur.fetchall())
+                last_id = logs[-1][0]
+                num_logs += len(logs)
+            cur.close()
+        return num_logs
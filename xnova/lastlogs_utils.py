@@ -1,9 +1,22 @@
+import operator
 import sqlite3
+import time
 from . import xn_logger
+from .lastlogs_db_schema import upgrade_lastlogs_db, LASTLOGS_DB_SCHEMA_VERSION, COMBAT_STATS_SCHEMA_VERSION, \
+    participants_rows, split_participants
+from .lastlogs_stats import CombatStats, STATS_LOG_COLUMNS
+from .galaxy_search import fts_substring_query, register_casefold
 
 
 logger = xn_logger.get(__name__, debug=False)
 
+# logs table columns, in order of values of queued logs
+LOG_COLUMNS = ('log_id', 'log_time', 'attacker', 'defender', 'attacker_coords', 'defender_coords',
+               'total_loss', 'po_me', 'po_cry', 'win_me', 'win_cry', 'win_deit',
+               'att_loss', 'def_loss', 'moon_chance')
+
+_stats_values = operator.itemgetter(*[LOG_COLUMNS.index(col) for col in STATS_LOG_COLUMNS])
+
 
 def safe_int(v: str) -> int:
     ret = 0
@@ -25,29 +38,48 @@ def safe_int(v: str) -> int:
     return ret * multiplier
 
 
+# Combat logs DB. Logs are inserted in batches: store_log() only queues log
+# values, and every batch_size logs (or on flush()/close()) queued logs are
+# written in one transaction, duplicates are skipped with one lookup of
+# batch ids by log_id primary key instead of a lookup per log, and there is
+# one commit per batch instead of one per log. Schema is upgraded on open, see
+# lastlogs_db_schema. New participant names are added to player_names and
+# its full-text index in the same transaction, for search_players(), and
+# new logs are added to daily combat totals of stats (CombatStats).
 class LLDb:
-    def __init__(self, db_fn: str):
+    # kinds of log_gaps entries
+    GAP_UNAVAILABLE = 'unavailable'  # log exists, but is not available for viewing yet
+    GAP_MISSING = 'missing'  # no such log, while there are logs with higher ids
+    GAP_FAILED = 'failed'  # download or parse error
+    GAP_PERMANENT = 'permanent'  # retried too many times, not retried anymore
+
+    def __init__(self, db_fn: str, batch_size: int=100, alliances=None):
         self._conn = sqlite3.connect(db_fn)
+        self.stats = CombatStats(alliances)
+        self.batch_size = max(int(batch_size), 1)
+        self._pending = []  # values of logs to insert
+        self._pending_participants = {}  # log_id => log_participants rows, of queued logs
+        self._have_names_index = False
+        register_casefold(self._conn)
         self.check_tables()
 
     def check_tables(self):
-        q = 'CREATE TABLE IF NOT EXISTS logs ( ' \
-            ' log_id INT, ' \
-            ' log_time TEXT, ' \
-            ' attacker TEXT, ' \
-            ' defender TEXT, ' \
-            ' attacker_coords TEXT, ' \
-            ' defender_coords TEXT, ' \
-            ' total_loss INT, ' \
-            ' po_me INT, ' \
-            ' po_cry INT,' \
-            ' win_me INT, ' \
-            ' win_cry INT, ' \
-            ' win_deit INT )'
+        old_version = upgrade_lastlogs_db(self._conn)
+        if old_version < LASTLOGS_DB_SCHEMA_VERSION:
+            logger.info('DB: upgraded schema from version {0} to {1}'.format(
+                old_version, LASTLOGS_DB_SCHEMA_VERSION))
+        if old_version < COMBAT_STATS_SCHEMA_VERSION:
+            self.rebuild_stats()
         cur = self._conn.cursor()
-        cur.execute(q)
-        self._conn.commit()
+        cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='player_names_fts'")
+        self._have_names_index = (cur.fetchone()[0] == 1)
         cur.close()
+        if not self._have_names_index:
+            logger.warn('No player_names_fts table (sqlite without FTS5?), players search will be slow')
+
+    def close(self):
+        self.flush()
+        self._conn.close()
 
     def get_lastlog_id(self) -> int:
         q = 'SELECT MAX(log_id) FROM logs'
@@ -55,37 +87,205 @@ class LLDb:
         cur.execute(q)
         rows = cur.fetchall()
         cur.close()
-        if rows is None:
-            return 0
-        for row in rows:
-            return safe_int(row[0])
-        return 0
+        pending_ids = [values[0] for values in self._pending]
+        if len(pending_ids) > 0:
+            rows.append((max(pending_ids), ))
+        return max([safe_int(row[0]) for row in rows] + [0])
 
     def log_exists(self, log_id: int):
-        q = 'SELECT COUNT(*) FROM logs WHERE log_id=?'
+        q = 'SELECT 1 FROM logs WHERE log_id=?'
         cur = self._conn.cursor()
         cur.execute(q, (log_id, ))
-        rows = cur.fetchall()
+        row = cur.fetchone()
         cur.close()
-        for row in rows:
-            cnt = safe_int(row[0])
-            if cnt > 0:
-                return True
-            return False
+        return row is not None
 
+    # queue log for writing, values are copied, so parser object can be reused;
+    # participants are taken from o.participants, if parser gives them, otherwise
+    # from comma-joined attacker/defender lists
     def store_log(self, o):
-        if self.log_exists(o.log_id):
-            logger.warn('Refusing to add duplicate log id: {0}'.format(o.log_id))
+        log_id = int(o.log_id)
+        self._pending.append((log_id, safe_int(o.log_time), o.attacker, o.defender,
+                              o.attacker_coords, o.defender_coords, o.total_loss,
+                              o.po_me, o.po_cry, o.win_me, o.win_cry, o.win_deit,
+                              getattr(o, 'att_loss', None), getattr(o, 'def_loss', None),
+                              getattr(o, 'moon_chance', None)))
+        participants = getattr(o, 'participants', None)
+        if participants is None:
+            participants = split_participants(o.attacker, o.defender, o.attacker_coords, o.defender_coords)
+        self._pending_participants.setdefault(log_id, participants_rows(log_id, participants))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    # ids of logs, that are already stored, of given ones
+    def _get_stored_ids(self, log_ids: list) -> set:
+        ret = set()
+        cur = self._conn.cursor()
+        for i in range(0, len(log_ids), 500):
+            chunk = log_ids[i:i + 500]
+            cur.execute('SELECT log_id FROM logs WHERE log_id IN ({0})'.format(','.join(['?'] * len(chunk))), chunk)
+            ret.update([row[0] for row in cur.fetchall()])
+        cur.close()
+        return ret
+
+    # write queued logs and commit, returns number of new logs written
+    def flush(self) -> int:
+        q = 'INSERT OR IGNORE INTO logs (' + ', '.join(LOG_COLUMNS) + ') ' \
+            'VALUES (' + ','.join(['?'] * len(LOG_COLUMNS)) + ')'
+        num_queued = len(self._pending)
+        with self._conn:  # commits, also gaps changes; or rolls back on exception
+            # only new logs are counted in stats, so duplicates are dropped here
+            stored_ids = self._get_stored_ids([values[0] for values in self._pending])
+            new_logs = []
+            participants = []
+            for values in self._pending:
+                if values[0] not in stored_ids:
+                    stored_ids.add(values[0])
+                    new_logs.append(values)
+                    participants.extend(self._pending_participants[values[0]])
+            self._conn.executemany(q, new_logs)
+            self._conn.executemany('INSERT OR IGNORE INTO log_participants (log_id, side, player_name, g, s, p) '
+                                   ' VALUES (?,?,?,?,?,?)', participants)
+            self._add_player_names(set([row[2] for row in participants]))
+            cur = self._conn.cursor()
+            self.stats.add_logs(cur, [_stats_values(values) for values in new_logs], participants)
+            cur.close()
+        num_saved = len(new_logs)
+        self._pending = []
+        self._pending_participants = {}
+        if num_queued > 0:
+            if num_saved < num_queued:
+                logger.warn('Skipped {0} duplicate logs'.format(num_queued - num_saved))
+            logger.info('Saved {0} logs'.format(num_saved))
+        return num_saved
+
+    def add_gap(self, log_id: int, kind: str, max_attempts: int=0):
+        """
+        Records failed attempt to get log, committed with the next flush()
+        :param log_id: log id
+        :param kind: why there is no log, one of GAP_* kinds
+        :param max_attempts: after this many attempts gap becomes permanent, 0 - never
+        :return: True if gap has become permanent
+        """
+        q = 'INSERT INTO log_gaps (log_id, kind, attempts, last_try) VALUES (?, ?, 1, ?) ' \
+            ' ON CONFLICT (log_id) DO UPDATE SET ' \
+            '  kind = excluded.kind, attempts = attempts + 1, last_try = excluded.last_try'
+        cur = self._conn.cursor()
+        cur.execute(q, (log_id, kind, int(time.time())))
+        cur.execute('SELECT attempts FROM log_gaps WHERE log_id=?', (log_id, ))
+        attempts = cur.fetchone()[0]
+        is_permanent = (max_attempts > 0) and (attempts >= max_attempts)
+        if is_permanent:
+            cur.execute('UPDATE log_gaps SET kind=? WHERE log_id=?', (self.GAP_PERMANENT, log_id))
+        cur.close()
+        return is_permanent
+
+    # committed with the next flush()
+    def remove_gap(self, log_id: int):
+        cur = self._conn.cursor()
+        cur.execute('DELETE FROM log_gaps WHERE log_id=?', (log_id, ))
+        cur.close()
+
+    def get_gaps_to_retry(self, tried_before: int) -> list:
+        """
+        :param tried_before: only gaps last tried before this time
+        :return: ids of not permanent gaps, oldest first
+        """
+        q = 'SELECT log_id FROM log_gaps WHERE kind != ? AND last_try < ? ORDER BY log_id'
+        cur = self._conn.cursor()
+        cur.execute(q, (self.GAP_PERMANENT, tried_before))
+        ret = [row[0] for row in cur.fetchall()]
+        cur.close()
+        return ret
+
+    def get_max_gap_id(self, kind: str) -> int:
+        cur = self._conn.cursor()
+        cur.execute('SELECT MAX(log_id) FROM log_gaps WHERE kind=?', (kind, ))
+        row = cur.fetchone()
+        cur.close()
+        return safe_int(row[0])
+
+    # dict gap kind => number of gaps
+    def get_gap_counts(self) -> dict:
+        cur = self._conn.cursor()
+        cur.execute('SELECT kind, COUNT(*) FROM log_gaps GROUP BY kind')
+        ret = dict(cur.fetchall())
+        cur.close()
+        return ret
+
+    # add names not seen before to player_names and its index, inside flush() transaction
+    def _add_player_names(self, names: set):
+        if len(names) == 0:
             return
-        #
-        q = 'INSERT INTO logs (log_id, log_time, attacker, defender, ' \
-            ' attacker_coords, defender_coords, total_loss, ' \
-            ' po_me, po_cry, win_me, win_cry, win_deit) ' \
-            'VALUES (?,?, ?,?, ?,?, ?, ?,?, ?,?,?)'
         cur = self._conn.cursor()
-        cur.execute(q, (o.log_id, o.log_time, o.attacker, o.defender,
-                        o.attacker_coords, o.defender_coords, o.total_loss,
-                        o.po_me, o.po_cry, o.win_me, o.win_cry, o.win_deit))
-        self._conn.commit()
+        cur.execute('SELECT MAX(name_id) FROM player_names')
+        max_name_id = cur.fetchone()[0] or 0
+        cur.executemany('INSERT OR IGNORE INTO player_names (name) VALUES (?)', [(name, ) for name in names])
+        if self._have_names_index:
+            cur.execute('INSERT INTO player_names_fts (rowid, name) '
+                        ' SELECT name_id, name FROM player_names WHERE name_id > ?', (max_name_id, ))
+        cur.close()
+
+    # count daily combat totals again from all stored logs
+    def rebuild_stats(self):
+        self.flush()
+        num_logs = self.stats.rebuild(self._conn)
+        logger.info('Combat stats counted from {0} logs'.format(num_logs))
+
+    def search_players(self, text: str, limit: int=50) -> list:
+        """
+        Names of players, that took part in battles, containing text, case-insensitive
+        :param text: part of name, any length
+        :param limit: max number of names to return
+        :return: list of names, shortest (best matching) first
+        """
+        if (len(text) >= 3) and self._have_names_index:
+            q = 'SELECT name FROM player_names_fts WHERE player_names_fts MATCH ? ' \
+                ' ORDER BY length(name), name LIMIT ?'
+            params = (fts_substring_query(text), limit)
+        else:
+            # too short for trigrams, or no index: scan of names, not of participants
+            q = 'SELECT name FROM player_names WHERE instr(xn_casefold(name), ?) > 0 ' \
+                ' ORDER BY length(name), name LIMIT ?'
+            params = (text.casefold(), limit)
+        cur = self._conn.cursor()
+        cur.execute(q, params)
+        ret = [row[0] for row in cur.fetchall()]
+        cur.close()
+        return ret
+
+    def get_player_log_ids(self, player_name: str, side: str=None) -> list:
+        """
+        Battles of player, as attacker or defender, at any place in participants list
+        :param player_name: exact player name
+        :param side: only as SIDE_ATTACKER or SIDE_DEFENDER, or both if None
+        :return: list of log ids, newest first
+        """
+        q = 'SELECT log_id FROM log_participants WHERE player_name=?'
+        params = (player_name, )
+        if side is not None:
+            q += ' AND side=?'
+            params = (player_name, side)
+        q += ' ORDER BY log_id DESC'
+        cur = self._conn.cursor()
+        cur.execute(q, params)
+        ret = [row[0] for row in cur.fetchall()]
+        cur.close()
+        return ret
+
+    def get_coords_log_ids(self, g: int, s: int, p: int=None) -> list:
+        """
+        Battles at planet, or in whole solar system if p is None
+        :return: list of log ids, newest first
+        """
+        q = 'SELECT DISTINCT log_id FROM log_participants WHERE g=? AND s=?'
+        params = (g, s)
+        if p is not None:
+            q += ' AND p=?'
+            params = (g, s, p)
+        q += ' ORDER BY log_id DESC'
+        cur = self._conn.cursor()
+        cur.execute(q, params)
+        ret = [row[0] for row in cur.fetchall()]
         cur.close()
-        logger.info('Saved log id: {0}'.format(o.log_id))
+        return ret
@@ -4,7 +4,9 @@ from . import xn_logger
 logger = xn_logger.get(__name__, debug=False)
 
 
-def xnova_authorize(xn_host, xn_login, xn_password) -> dict:
+def xnova_authorize(xn_host, xn_login, xn_password, cookies_expires: dict=None) -> dict:
+    # cookies_expires: optional dict, filled with cookie name => expiry unix time
+    # (None for session cookies)
     # This is only for debugging!
     # print('Content-Type: text/plain; charset=utf-8')
     # print()
@@ -49,6 +51,9 @@ def xnova_authorize(xn_host, xn_login, xn_password) -> dict:
     cookies_dict = {}
     for single_cookie in r.cookies.iteritems():
         cookies_dict[single_cookie[0]] = single_cookie[1]
+    if cookies_expires is not None:
+        for cookie in r.cookies:
+            cookies_expires[cookie.name] = cookie.expires
 
     # print('cookies_dict will be:')
     # print(cookies_dict)
@@ -0,0 +1,30 @@
+import threading
+
+
+# Traffic accounting of page downloaders: how many bytes were actually
+# transferred over network (compressed, as sent by server) and how many
+# bytes of content they decoded to. One object can be shared by several
+# downloaders (and threads), like clones of scan workers.
+class DownloadStats:
+    def __init__(self):
+        self.num_requests = 0
+        self.num_not_modified = 0  # HTTP 304 answers to conditional requests
+        self.wire_bytes = 0
+        self.content_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, wire_bytes: int, content_bytes: int, not_modified=False):
+        with self._lock:
+            self.num_requests += 1
+            self.wire_bytes += wire_bytes
+            self.content_bytes += content_bytes
+            if not_modified:
+                self.num_not_modified += 1
+
+    def __str__(self):
+        ratio = 0.0
+        if self.wire_bytes > 0:
+            ratio = self.content_bytes / self.wire_bytes
+        return '{0} requests ({1} not modified), {2} bytes transferred, {3} bytes of content ' \
+               '(compression {4:0.1f}x)'.format(self.num_requests, self.num_not_modified,
+                                                self.wire_bytes, self.content_bytes, ratio)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+import configparser
+import os
+import threading
+import time
+
+from . import xn_logger
+from .xn_page_dnl import XNovaPageDownload
+from .xn_retry import FAILURE_PERMANENT
+from .xn_scan_scheduler import TokenBucket
+from .xn_session import XNovaSession
+
+logger = xn_logger.get(__name__, debug=False)
+
+
+# One account that scans are done with: its own login session (cookies),
+# proxy and requests rate budget, and health state. Identity that keeps
+# failing (dead proxy, banned account) is put on cooldown, so that other
+# identities take its share of work; cooldown doubles after every failure
+# in a row, up to max_cooldown.
+class ScanIdentity:
+    def __init__(self, name: str, login: str, password: str, proxy: str=None,
+                 rate: float=0.2, user_agent: str=None):
+        self.name = name
+        self.login = login
+        self.password = password
+        self.proxy = proxy  # None - same as in net.ini, '' - no proxy
+        self.user_agent = user_agent
+        self.rate_limiter = TokenBucket(rate)
+        self.session = None  # XNovaSession
+        self.page_dnl = None  # template downloader, each worker thread uses its clone
+        self.failure_threshold = 3  # failures in a row before cooldown
+        self.cooldown = 30.0
+        self.max_cooldown = 600.0
+        self.disabled = False  # login failed, identity is not used at all
+        self.in_flight = 0
+        self.num_requests = 0
+        self.num_failures = 0
+        self._failures_in_row = 0
+        self._cur_cooldown = self.cooldown
+        self._cooldown_until = 0.0
+
+    def is_available(self, now: float) -> bool:
+        return (not self.disabled) and (now >= self._cooldown_until)
+
+    # share of work this identity should get, proportional to its rate budget
+    def get_weight(self) -> float:
+        if self.rate_limiter.rate <= 0:
+            return 1000.0  # unlimited
+        return self.rate_limiter.rate
+
+    # must be called with pool lock held
+    def record_result(self, ok: bool, now: float):
+        self.num_requests += 1
+        if ok:
+            self._failures_in_row = 0
+            self._cur_cooldown = self.cooldown
+            return
+        self.num_failures += 1
+        self._failures_in_row += 1
+        if self._failures_in_row >= self.failure_threshold:
+            self._cooldown_until = now + self._cur_cooldown
+            logger.warn('Identity {0}: {1} failures in a row, not used for {2:.0f}s'.format(
+                self.name, self._failures_in_row, self._cur_cooldown))
+            self._cur_cooldown = min(self._cur_cooldown * 2, self.max_cooldown)
+            self._failures_in_row = 0
+
+    def __str__(self):
+        state = 'ok'
+        if self.disabled:
+            state = 'disabled'
+        elif self._cooldown_until > time.monotonic():
+            state = 'cooldown'
+        return '{0}: {1} requests, {2} failed, {3}'.format(self.name, self.num_requests, self.num_failures, state)
+
+
+# Pool of scan identities, so that total scan throughput scales with the
+# number of accounts/proxies, instead of being capped by politeness delay
+# of one account. Every request goes through the identity that has the
+# least work in progress relative to its rate budget (fair sharing), among
+# healthy ones. Downloaders are per identity per thread, like scan workers
+# have their own downloaders.
+# Identities are described in net.ini-style config file, one section each:
+#   [account1]
+#   login = your@email.com
+#   password = your_secret_password
+#   proxy = socks5://127.0.0.1:9050
+#   delay = 5
+# proxy, delay (or rate, requests per second) and user_agent are optional.
+class IdentityPool:
+    def __init__(self):
+        self.identities = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __len__(self):
+        return len(self.identities)
+
+    def load_from_config(self, filename: str, default_rate: float=0.2):
+        """
+        Adds identities from config file
+        :param filename: config file name
+        :param default_rate: requests per second for identities that do not set delay or rate
+        :return: number of identities added
+        """
+        cfg = configparser.ConfigParser()
+        if len(cfg.read(filename, encoding='utf-8')) == 0:
+            raise IOError('Cannot read identities config: {0}'.format(filename))
+        num_added = 0
+        for name in cfg.sections():
+            section = cfg[name]
+            if ('login' not in section) or ('password' not in section):
+                logger.warn('Identity [{0}] has no login or password, skipped'.format(name))
+                continue
+            rate = default_rate
+            if 'rate' in section:
+                rate = section.getfloat('rate')
+            elif 'delay' in section:
+                rate = TokenBucket.from_delay(section.getfloat('delay')).rate
+            self.identities.append(ScanIdentity(name, section['login'], section['password'],
+                                                section.get('proxy'), rate, section.get('user_agent')))
+            num_added += 1
+        return num_added
+
+    def login_all(self, template_dnl: XNovaPageDownload, session_filename: str) -> int:
+        """
+        Logs in every identity (or reuses its saved session) and sets up its downloader
+        :param template_dnl: downloader with host, headers and retry settings to copy
+        :param session_filename: base session file name, each identity gets its own file
+        :return: number of identities ready to use
+        """
+        base, ext = os.path.splitext(session_filename)
+        num_ok = 0
+        for identity in self.identities:
+            identity.session = XNovaSession(template_dnl.xnova_url, identity.login, identity.password,
+                                            '{0}_{1}{2}'.format(base, identity.name, ext))
+            cookies = identity.session.get_cookies()
+            if cookies is None:
+                logger.error('Identity {0}: login failed, it will not be used'.format(identity.name))
+                identity.disabled = True
+                continue
+            dnl = template_dnl.clone()
+            if identity.proxy is not None:
+                dnl.set_proxy(identity.proxy)
+            if identity.user_agent:
+                dnl.set_useragent(identity.user_agent)
+            dnl.set_cookies_from_dict(cookies)
+            dnl.rate_limiter = identity.rate_limiter
+            identity.page_dnl = dnl
+            num_ok += 1
+        return num_ok
+
+    # picks identity for the next request and counts it as in progress;
+    # waits if all healthy identities are on cooldown, None if none are usable
+    def _acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                candidates = [identity for identity in self.identities if identity.is_available(now)]
+                if len(candidates) > 0:
+                    identity = min(candidates, key=lambda i: ((i.in_flight + 1) / i.get_weight(), i.num_requests))
+                    identity.in_flight += 1
+                    return identity
+                waiting = [identity._cooldown_until for identity in self.identities if not identity.disabled]
+                if len(waiting) == 0:
+                    return None
+                wait_secs = min(waiting) - now
+            time.sleep(max(wait_secs, 0.1))
+
+    def _release(self, identity: ScanIdentity, ok: bool):
+        with self._lock:
+            identity.in_flight -= 1
+            identity.record_result(ok, time.monotonic())
+
+    # downloader of identity for current thread
+    def _get_thread_dnl(self, identity: ScanIdentity) -> XNovaPageDownload:
+        dnls = getattr(self._local, 'dnls', None)
+        if dnls is None:
+            dnls = {}
+            self._local.dnls = dnls
+        dnl = dnls.get(identity.name)
+        if dnl is None:
+            dnl = identity.page_dnl.clone()
+            dnls[identity.name] = dnl
+        return dnl
+
+    def download(self, url_path: str, is_logged_in_page=None, **kwargs):
+        """
+        Downloads page using one of identities, see XNovaSession.download()
+        :return: tuple (content, page_dnl): page contents, or None on error, and
+                 downloader that was used (to check its not_modified, validators),
+                 or None if no identity can be used
+        """
+        identity = self._acquire()
+        if identity is None:
+            logger.error('No usable identities left')
+            return None, None
+        ok = False
+        page_dnl = None
+        try:
+            page_dnl = self._get_thread_dnl(identity)
+            content = identity.session.download(page_dnl, url_path, is_logged_in_page, **kwargs)
+            # not found page is not a fault of identity
+            ok = (content is not None) or page_dnl.not_modified or (page_dnl.failure_kind == FAILURE_PERMANENT)
+        finally:
+            self._release(identity, ok)
+        return content, page_dnl
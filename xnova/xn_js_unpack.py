@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Native (no JavaScript runtime) decoder for galaxy page scripts:
+Dean Edwards' p,a,c,k,e,d packer, used on uni4 galaxy pages,
+and the list of "row[N]={...};" assignments, which is what
+packed script unpacks to (and what uni5 sends unpacked)
+"""
+import json
+import re
+
+
+class UnpackError(ValueError):
+    pass
+
+
+# standard packer words encoding function, base <= 62
+_PACKER_ENCODE_FUNC = "e=function(c){return(c<a?'':e(parseInt(c/a)))+((c=c%a)>35?String.fromCharCode(c+29):c.toString(36))}"
+_PACKER_ARGS_RE = re.compile(r"\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*")
+_PACKER_WORD_RE = re.compile(r'\b\w+\b', re.ASCII)
+_ROW_ASSIGN_RE = re.compile(r'row\[(\d+)\]\s*=\s*')
+_BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+_JS_SIMPLE_ESCAPES = {
+    'n': '\n', 'r': '\r', 't': '\t', 'b': '\b', 'f': '\f', 'v': '\v', '0': '\0',
+    '\\': '\\', "'": "'", '"': '"', '\n': ''
+}
+
+
+def _js_string_literal(s: str, pos: int) -> tuple:
+    """
+    Reads JS quoted string literal starting at s[pos]
+    :param s: source text
+    :param pos: position of opening quote
+    :return: tuple (decoded string, position right after closing quote)
+    """
+    if pos >= len(s) or s[pos] not in ('"', "'"):
+        raise UnpackError('string literal expected at {0}'.format(pos))
+    quote = s[pos]
+    pos += 1
+    parts = []
+    chunk_start = pos
+    slen = len(s)
+    while pos < slen:
+        ch = s[pos]
+        if ch == quote:
+            parts.append(s[chunk_start:pos])
+            return ''.join(parts), pos + 1
+        if ch == '\\':
+            parts.append(s[chunk_start:pos])
+            if pos + 1 >= slen:
+                break
+            esc = s[pos + 1]
+            if esc == 'u':
+                parts.append(chr(int(s[pos + 2:pos + 6], 16)))
+                pos += 6
+            elif esc == 'x':
+                parts.append(chr(int(s[pos + 2:pos + 4], 16)))
+                pos += 4
+            else:
+                parts.append(_JS_SIMPLE_ESCAPES.get(esc, esc))
+                pos += 2
+            chunk_start = pos
+            continue
+        pos += 1
+    raise UnpackError('unterminated string literal')
+
+
+def _encode_word_index(c: int, a: int) -> str:
+    # python version of packer's e(c)
+    ret = ''
+    while True:
+        d = c % a
+        ret = (chr(d + 29) if d > 35 else _BASE36_DIGITS[d]) + ret
+        c //= a
+        if c == 0:
+            return ret
+
+
+def unpack_packed_js(packed: str) -> str:
+    """
+    Unpacks Dean Edwards packer output, without evaluating any JS
+    :param packed: text like "eval(function(p,a,c,k,e,d){...}('...',62,141,'...'.split('|'),0,{}))",
+                   leading "eval(" and trailing ")" are optional
+    :return: unpacked JS source
+    """
+    func_pos = packed.find('function(p,a,c,k,e,d)')
+    if func_pos == -1:
+        raise UnpackError('not a packed script')
+    body_end = packed.find("return p}(", func_pos)
+    if body_end == -1:
+        raise UnpackError('cannot find end of unpacker function')
+    func_body = packed[func_pos:body_end]
+    if func_body.find(_PACKER_ENCODE_FUNC) == -1:
+        # base10/base36/base95 encodings, or some custom packer
+        raise UnpackError('unsupported packer variant')
+    p, pos = _js_string_literal(packed, body_end + len("return p}("))
+    m = _PACKER_ARGS_RE.match(packed, pos)
+    if m is None:
+        raise UnpackError('cannot parse packer arguments')
+    a = int(m.group(1))
+    c = int(m.group(2))
+    if a < 2 or a > 62:
+        raise UnpackError('unsupported packer base: {0}'.format(a))
+    k, pos = _js_string_literal(packed, m.end())
+    if not packed.startswith(".split('|')", pos):
+        raise UnpackError('cannot parse packer keywords list')
+    k = k.split('|')
+    # d[e(c)] = k[c] || e(c)
+    words = {}
+    for i in range(c):
+        word = _encode_word_index(i, a)
+        if i < len(k) and k[i] != '':
+            words[word] = k[i]
+        else:
+            words[word] = word
+    return _PACKER_WORD_RE.sub(lambda wm: words.get(wm.group(0), wm.group(0)), p)
+
+
+def parse_row_assignments(src: str) -> list:
+    """
+    Parses galaxy rows script: 'row[12]={"planet":12,...};row[9]={...};'
+    into list, like JS "var row = []; ...; return row;" would return
+    :param src: rows script text
+    :return: list of dicts, indexed by planet position, None for empty positions
+    """
+    decoder = json.JSONDecoder()
+    rows_dict = {}
+    pos = 0
+    while True:
+        m = _ROW_ASSIGN_RE.search(src, pos)
+        if m is None:
+            break
+        try:
+            obj, pos = decoder.raw_decode(src, m.end())
+        except ValueError as ve:
+            raise UnpackError('cannot decode row[{0}]: {1}'.format(m.group(1), str(ve)))
+        rows_dict[int(m.group(1))] = obj
+    # check that we did not skip anything meaningful, only separators
+    if len(rows_dict) == 0 and src.strip() not in ('', ';'):
+        raise UnpackError('no row assignments found')
+    rows = []
+    if len(rows_dict) > 0:
+        rows = [None] * (max(rows_dict.keys()) + 1)
+        for idx, obj in rows_dict.items():
+            rows[idx] = obj
+    return rows
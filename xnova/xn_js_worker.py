@@ -0,0 +1,287 @@
+import atexit
+import json
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+from . import xn_logger
+
+logger = xn_logger.get(__name__, debug=False)
+
+
+# JS side of worker: reads requests from stdin, one JSON per line, and writes
+# responses to stdout, one JSON per line, in the same order. Each script runs
+# in a fresh vm context, so scripts do not see each other's globals and node
+# modules are not in scope. Node's vm is not a security boundary: script can
+# still reach worker process, so only game server pages are run here.
+_WORKER_JS = r"""
+const readline = require('readline');
+const vm = require('vm');
+const rl = readline.createInterface({input: process.stdin, terminal: false});
+rl.on('line', function (line) {
+    let req = null;
+    let resp = null;
+    try {
+        req = JSON.parse(line);
+        let result = null;
+        const opts = {timeout: req.timeout};
+        if (req.op === 'eval') {
+            result = vm.runInNewContext('(' + req.code + ')', {}, opts);
+        } else if (req.op === 'exec') {
+            result = vm.runInNewContext('(function () {' + req.code + '\n})()', {}, opts);
+        } else if (req.op === 'ping') {
+            result = 'pong';
+        } else {
+            throw new Error('unknown op: ' + req.op);
+        }
+        resp = {id: req.id, ok: true, result: (result === undefined) ? null : result};
+    } catch (e) {
+        resp = {id: (req !== null) ? req.id : null, ok: false, error: String(e)};
+    }
+    process.stdout.write(JSON.stringify(resp) + '\n');
+});
+"""
+
+
+# worker process died, hung or talks nonsense; worker is stopped, request can be retried
+class JSWorkerError(RuntimeError):
+    pass
+
+
+# script raised an exception (or is invalid); worker itself is fine
+class JSEvalError(JSWorkerError):
+    pass
+
+
+# returns command line to start worker, or None if no JS runtime is found
+def find_js_runtime():
+    for name in ('node', 'nodejs'):
+        path = shutil.which(name)
+        if path is not None:
+            return [path, '-e', _WORKER_JS]
+    return None
+
+
+# One long-lived JS runtime process, that evaluates scripts sent to it over
+# a pipe, so that there is no process spawn per script, as execjs does.
+# Not thread-safe, JSWorkerPool gives each worker to one thread at a time.
+class JSWorker:
+    def __init__(self, command: list, timeout: float=10.0):
+        self.command = command
+        self.timeout = timeout  # seconds, for one script
+        self.num_starts = 0
+        self.last_used = 0.0  # time.monotonic() of the last response
+        self._proc = None
+        self._responses = None
+        self._next_id = 1
+
+    def start(self):
+        self.stop()
+        try:
+            self._proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          stderr=subprocess.DEVNULL, encoding='UTF-8', bufsize=1)
+        except OSError as e:
+            self._proc = None
+            raise JSWorkerError('Cannot start JS worker: {0}'.format(str(e)))
+        self.num_starts += 1
+        self.last_used = time.monotonic()
+        self._responses = queue.Queue()
+        # stdout is read in a thread, so that waiting for response can time out
+        th = threading.Thread(target=self._reader_proc, args=(self._proc, self._responses),
+                              name='js-worker-reader', daemon=True)
+        th.start()
+        logger.debug('Started JS worker, pid {0}'.format(self._proc.pid))
+
+    @staticmethod
+    def _reader_proc(proc, responses: queue.Queue):
+        for line in proc.stdout:
+            responses.put(line)
+        responses.put(None)  # EOF, process has exited
+
+    def stop(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc = None
+
+    # pid of worker process, None if it is not started
+    @property
+    def pid(self):
+        if self._proc is None:
+            return None
+        return self._proc.pid
+
+    def is_alive(self) -> bool:
+        return (self._proc is not None) and (self._proc.poll() is None)
+
+    def request(self, op: str, code: str=None, timeout: float=None):
+        """
+        Sends request to worker and waits for response
+        :param op: 'eval' - evaluate JS expression, 'exec' - run JS function body,
+                   returning value with return statement, 'ping' - health check
+        :param code: JS source
+        :param timeout: seconds to wait for response, default a bit more than script timeout
+        :return: result value, converted from JSON
+        """
+        if not self.is_alive():
+            raise JSWorkerError('JS worker is not running')
+        req_id = self._next_id
+        self._next_id += 1
+        req = {'id': req_id, 'op': op, 'code': code, 'timeout': int(self.timeout * 1000)}
+        try:
+            self._proc.stdin.write(json.dumps(req) + '\n')
+            self._proc.stdin.flush()
+        except OSError as e:
+            self.stop()
+            raise JSWorkerError('Cannot send request to JS worker: {0}'.format(str(e)))
+        try:
+            # script timeout is enforced by worker itself, this is for the worker hang
+            if timeout is None:
+                timeout = self.timeout + 5
+            line = self._responses.get(timeout=timeout)
+        except queue.Empty:
+            self.stop()
+            raise JSWorkerError('JS worker does not respond')
+        if line is None:
+            self.stop()
+            raise JSWorkerError('JS worker has exited')
+        try:
+            resp = json.loads(line)
+        except ValueError:
+            self.stop()
+            raise JSWorkerError('Invalid response from JS worker: {0}'.format(line[:100]))
+        if resp.get('id') != req_id:
+            self.stop()
+            raise JSWorkerError('Unexpected response id from JS worker: {0}'.format(resp.get('id')))
+        self.last_used = time.monotonic()
+        if not resp.get('ok'):
+            raise JSEvalError(resp.get('error'))
+        return resp.get('result')
+
+    def ping(self, timeout: float=2.0) -> bool:
+        try:
+            return self.request('ping', timeout=timeout) == 'pong'
+        except JSWorkerError:
+            return False
+
+
+# Pool of JS workers, shared by all threads of the process: every call takes
+# an idle worker (waiting for one if all are busy), worker is started on first
+# use, and started again if it has crashed or hung (request is retried once).
+# Worker that was idle for more than health_check_interval is pinged before
+# it is handed out, so dead or hung one is restarted before a request is
+# sent to it, not found by a failed request.
+class JSWorkerPool:
+    def __init__(self, command: list, size: int=1, timeout: float=10.0):
+        self.size = max(int(size), 1)
+        self.health_check_interval = 30.0  # seconds, 0 - check before every request
+        self.num_restarts = 0  # by health checks
+        self._workers = [JSWorker(command, timeout) for i in range(self.size)]
+        self._idle = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    @property
+    def workers(self) -> list:
+        return list(self._workers)
+
+    # ping started worker and restart it, if it does not respond; returns True if restarted
+    def _check_worker(self, worker: JSWorker) -> bool:
+        if (worker.num_starts == 0) or worker.ping():
+            return False
+        logger.warn('JS worker does not respond to ping, restarting it')
+        worker.start()
+        self.num_restarts += 1
+        return True
+
+    def _take_worker(self) -> JSWorker:
+        worker = self._idle.get()
+        if time.monotonic() - worker.last_used >= self.health_check_interval:
+            try:
+                self._check_worker(worker)
+            except JSWorkerError as e:
+                logger.error(str(e))  # could not restart, _call() will try again
+        return worker
+
+    def _call(self, op: str, code: str=None):
+        worker = self._take_worker()
+        try:
+            for attempt in range(2):
+                if not worker.is_alive():
+                    if worker.num_starts > 0:
+                        logger.warn('JS worker has crashed, restarting it')
+                    worker.start()
+                try:
+                    return worker.request(op, code)
+                except JSEvalError:
+                    raise
+                except JSWorkerError as e:
+                    if attempt > 0:
+                        raise
+                    logger.warn('{0}, retrying'.format(str(e)))
+        finally:
+            self._idle.put(worker)
+
+    def eval(self, code: str):
+        return self._call('eval', code)
+
+    def exec_(self, code: str):
+        return self._call('exec', code)
+
+    def check_health(self) -> int:
+        """
+        Pings idle workers, restarts those that do not respond
+        :return: number of restarted workers
+        """
+        num_restarted = 0
+        for i in range(self.size):
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break  # others are busy, so they are alive
+            try:
+                if self._check_worker(worker):
+                    num_restarted += 1
+            except JSWorkerError as e:
+                logger.error(str(e))
+            finally:
+                self._idle.put(worker)
+        return num_restarted
+
+    def close(self):
+        for worker in self._workers:
+            worker.stop()
+
+
+_pool = None
+_pool_size = 1
+_pool_lock = threading.Lock()
+
+
+# number of workers in pool of get_pool(), must be set before its first call
+def set_pool_size(size: int):
+    global _pool_size
+    _pool_size = max(int(size), 1)
+
+
+# process-wide workers pool, created on first use; None if there is no JS runtime
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            command = find_js_runtime()
+            if command is None:
+                return None
+            _pool = JSWorkerPool(command, _pool_size)
+            atexit.register(_pool.close)
+        return _pool
@@ -1,9 +1,14 @@
+import collections
 import os
 import pathlib
 import locale
+import sqlite3
+import threading
 import time
+import zlib
 
 from . import xn_logger
+from .xn_page_store import PageFilesStore, PageSqliteStore
 
 logger = xn_logger.get(__name__, debug=False)
 
@@ -13,24 +18,55 @@ logger = xn_logger.get(__name__, debug=False)
 # the file first requested from this cache,
 # and only if get() returns None, it will be
 # downloaded over network
+# Only pages names and modification times are loaded at startup,
+# pages contents are read from disk on demand, and the most recently
+# used pages are kept in memory (LRU, up to max_pages_in_memory).
+# Can be used from several threads.
+# Pages are kept by storage engine, selected by storage_type:
+#  - STORAGE_FILES: one plain text file per page in ./cache/page (default)
+#  - STORAGE_SQLITE: single file ./cache/pages.db, pages are compressed
 class XNovaPageCache:
+    STORAGE_FILES = 'files'
+    STORAGE_SQLITE = 'sqlite'
+
     def __init__(self):
-        self._pages = {}
-        self._mtimes = {}
+        self._pages = collections.OrderedDict()  # LRU of loaded pages contents
+        self._mtimes = {}  # index of all cached pages: name => mtime
+        self._lock = threading.Lock()
+        self._store = None
+        self.storage_type = self.STORAGE_FILES
+        self.max_pages_in_memory = 256
+        self._cache_basedir = './cache'
         self._page_cache_dir = './cache/page'
         self._img_cache_dir = './cache/img'
         self.save_load_encoding = locale.getpreferredencoding()
         logger.debug('Locale preferred encoding: {0}'.format(self.save_load_encoding))
 
     def set_cache_basedir(self, cache_basedir: str):
+        self._cache_basedir = cache_basedir
         self._page_cache_dir = cache_basedir + '/page'
         self._img_cache_dir = cache_basedir + '/img'
 
-    # scan ./cache directory and load all files into memory
+    def set_storage_type(self, storage_type: str):
+        if storage_type not in (self.STORAGE_FILES, self.STORAGE_SQLITE):
+            raise ValueError('Unknown page cache storage type: {0}'.format(storage_type))
+        self.storage_type = storage_type
+
+    def _open_store(self):
+        if self._store is not None:
+            self._store.close()
+        if self.storage_type == self.STORAGE_SQLITE:
+            self._store = PageSqliteStore(os.path.join(self._cache_basedir, 'pages.db'))
+        else:
+            self._store = PageFilesStore(self._page_cache_dir, self.save_load_encoding)
+
+    # open pages storage in ./cache directory and index all cached pages;
+    # pages contents are not loaded here, only names and mtimes
     def load_from_disk_cache(self, clean=True):
         if clean:
-            self._pages = {}
-            self._mtimes = {}
+            with self._lock:
+                self._pages.clear()
+                self._mtimes = {}
         cache_dir = pathlib.Path(self._page_cache_dir)
         if not cache_dir.exists():
             try:
@@ -38,26 +74,13 @@ class XNovaPageCache:
                 logger.info('Created pages cache dir')
             except OSError as ose:
                 logger.error('Cannot create page cache dir: {0}'.format(str(ose)))
-        num_loaded = 0
-        for subitem in cache_dir.iterdir():
-            if subitem.is_file():
-                try:
-                    # get file last modification time
-                    stt = subitem.stat()
-                    mtime = int(stt.st_mtime)
-                    if subitem.name != 'login.dat':
-                        # skip login.dat
-                        with subitem.open(mode='rt', encoding=self.save_load_encoding) as f:
-                            fname = subitem.name
-                            contents = f.read()
-                            self._pages[fname] = contents  # save file contents
-                            self._mtimes[fname] = mtime  # save also modification time
-                            num_loaded += 1
-                except IOError as ioe:
-                    pass
-                except UnicodeDecodeError as ude:
-                    logger.error('Encoding error in [{0}], skipped: {1}'.format(subitem.name, str(ude)))
-        logger.info('Loaded {0} cached pages.'.format(num_loaded))
+        self._open_store()
+        num_indexed = 0
+        for page_name, mtime in self._store.list_pages():
+            with self._lock:
+                self._mtimes[page_name] = mtime
+            num_indexed += 1
+        logger.info('Indexed {0} cached pages.'.format(num_indexed))
         # ensure that image cache dir also exists
         cache_dir = pathlib.Path(self._img_cache_dir)
         if not cache_dir.exists():
@@ -67,18 +90,61 @@ class XNovaPageCache:
             except OSError as ose:
                 logger.error('Cannot create img cahe dir: {0}'.format(str(ose)))
 
-    # save page into cache
-    def set_page(self, page_name, contents):
+    # remember page contents in memory, forgetting least recently used pages;
+    # must be called with self._lock held
+    def _remember_page(self, page_name, contents):
         self._pages[page_name] = contents
-        self._mtimes[page_name] = int(time.time())  # also update modified time!
+        self._pages.move_to_end(page_name)
+        while len(self._pages) > self.max_pages_in_memory:
+            self._pages.popitem(last=False)
+
+    # save page into cache; meta is optional dict saved with page,
+    # HTTP validators ETag and Last-Modified, see get_page_meta()
+    def set_page(self, page_name, contents, meta: dict=None):
+        mtime = int(time.time())
+        with self._lock:
+            self._remember_page(page_name, contents)
+            self._mtimes[page_name] = mtime  # also update modified time!
+        if self._store is None:
+            self._open_store()
         try:
-            fn = os.path.join(self._page_cache_dir, page_name)
-            f = open(fn, mode='wt', encoding=self.save_load_encoding)
-            # f = open(fn, mode='wt')
-            f.write(contents)
-            f.close()
-        except IOError as ioe:
-            logger.error('set_page("{0}", ...): IOError: {1}'.format(page_name, str(ioe)))
+            self._store.write_page(page_name, contents, mtime, meta)
+        except (IOError, sqlite3.Error) as e:
+            logger.error('set_page("{0}", ...): {1}: {2}'.format(page_name, type(e).__name__, str(e)))
+
+    # page was not modified on server (HTTP 304): mark cached copy fresh
+    def touch_page(self, page_name):
+        mtime = int(time.time())
+        with self._lock:
+            if page_name not in self._mtimes:
+                return
+            self._mtimes[page_name] = mtime
+        try:
+            self._store.touch_page(page_name, mtime)
+        except (IOError, sqlite3.Error) as e:
+            logger.error('touch_page("{0}"): {1}: {2}'.format(page_name, type(e).__name__, str(e)))
+
+    # get metadata dict saved with page, or None
+    def get_page_meta(self, page_name):
+        with self._lock:
+            if page_name not in self._mtimes:
+                return None
+        try:
+            return self._store.read_meta(page_name)
+        except (ValueError, sqlite3.Error) as e:
+            logger.error('get_page_meta("{0}"): {1}: {2}'.format(page_name, type(e).__name__, str(e)))
+            return None
+
+    # give unused disk space back, clean up after interrupted writes
+    def compact(self):
+        if self._store is None:
+            self._open_store()
+        self._store.compact()
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
 
     def save_image(self, img_path: str, img_bytes: bytes):
         img_path_plain = img_path.replace('/', '_')
@@ -89,6 +155,16 @@ class XNovaPageCache:
         except IOError as ioe:
             logger.error('image [{0}] save failed: [{1}]'.format(filename, str(ioe)))
 
+    # get page modification time, or None if it is not in cache
+    def get_page_mtime(self, page_name):
+        with self._lock:
+            return self._mtimes.get(page_name)
+
+    # names of all cached pages starting with prefix, sorted
+    def list_page_names(self, prefix=''):
+        with self._lock:
+            return sorted([name for name in self._mtimes.keys() if name.startswith(prefix)])
+
     # get page from cache
     # the file first requested from this cache,
     # and only if get() returns None, it will be
@@ -96,16 +172,34 @@ class XNovaPageCache:
     def get_page(self, page_name, max_cache_secs=None):
         if len(page_name) < 1:
             return None
-        if page_name in self._pages:
+        with self._lock:
+            if page_name not in self._mtimes:
+                return None
             # should we check file cache time?
-            if max_cache_secs is None:
-                # do not check cache time, just return
-                return self._pages[page_name]
-            # get current time
-            tm_now = int(time.time())
-            tm_cache = self._mtimes[page_name]
-            tm_diff = tm_now - tm_cache
-            if tm_diff <= max_cache_secs:
+            if max_cache_secs is not None:
+                # get current time
+                tm_now = int(time.time())
+                tm_cache = self._mtimes[page_name]
+                tm_diff = tm_now - tm_cache
+                if tm_diff > max_cache_secs:
+                    logger.debug('cache considered invalid for [{0}]: {1}s > {2}s'.format(
+                        page_name, tm_diff, max_cache_secs))
+                    return None
+            if page_name in self._pages:
+                self._pages.move_to_end(page_name)
                 return self._pages[page_name]
-            logger.debug('cache considered invalid for [{0}]: {1}s > {2}s'.format(page_name, tm_diff, max_cache_secs))
-        return None
+        # not in memory, read from disk
+        try:
+            contents = self._store.read_page(page_name)
+            if contents is None:
+                with self._lock:
+                    self._mtimes.pop(page_name, None)  # page was removed
+                return None
+        except (UnicodeDecodeError, zlib.error, sqlite3.Error) as e:
+            logger.error('Cannot read cached page [{0}], skipped: {1}'.format(page_name, str(e)))
+            with self._lock:
+                self._mtimes.pop(page_name, None)
+            return None
+        with self._lock:
+            self._remember_page(page_name, contents)
+        return contents
@@ -1,5 +1,7 @@
+import codecs
 import configparser
 import json
+import time
 
 import requests
 import requests.exceptions
@@ -9,6 +11,8 @@ import requesocks
 import requesocks.exceptions
 
 from . import xn_logger
+from .xn_dnl_stats import DownloadStats
+from .xn_retry import FAILURE_PERMANENT, classify_failure, get_circuit_breaker, parse_retry_after
 
 logger = xn_logger.get(__name__, debug=False)
 
@@ -20,7 +24,18 @@ class XNovaPageDownload:
         self.xnova_url = 'uni4.xnova.su'
         self.user_agent = 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:48.0) Gecko/20100101 Firefox/48.0'
         self.error_str = None
+        self.status_code = None  # HTTP code of the last response, None if there was no response
+        self.failure_kind = None  # FAILURE_TRANSIENT or FAILURE_PERMANENT if the last request failed
+        self.retry_after = None
+        self.not_modified = False  # last conditional request got HTTP 304
+        self.response_url = None  # final url of the last response, after redirects
+        self.validators = None  # dict with ETag and Last-Modified of the last downloaded page
+        self.stats = DownloadStats()
         self.proxy = None
+        self.timeout = None  # seconds, None - wait for response as long as it takes
+        self.retry_policy = None  # RetryPolicy, None - do not retry, fail on the first error
+        self.use_circuit_breaker = False  # wait while host's circuit breaker (shared by process) is open
+        self.rate_limiter = None  # optional TokenBucket, shared with other downloaders
         # load user-agent from config/net.ini
         cfg = configparser.ConfigParser()
         cfg.read('config/net.ini', encoding='utf-8')
@@ -31,16 +46,8 @@ class XNovaPageDownload:
             if self.proxy == '':
                 self.proxy = None
         # construct requests HTTP session
-        if self.proxy is not None:
-            if self.proxy.startswith('socks5://'):
-                # for SOCKS5 proxy create requesocks session
-                self.sess = requesocks.session()
-                logger.info('Using SOCKS5 proxy session (requesocks)')
-        else:
-            self.sess = requests.Session()  # else normal session
-        if self.proxy is not None:
-            self.sess.proxies = {'http': self.proxy, 'https': self.proxy}
-            logger.info('Set HTTP/HTTPS proxy to: {0}'.format(self.proxy))
+        self.sess = None
+        self.set_proxy(self.proxy)
 
         # Some default headers for a page downloader
         self.sess.headers.update({'User-Agent': self.user_agent})
@@ -52,6 +59,42 @@ class XNovaPageDownload:
         if cookies_dict:
             self.set_cookies_from_dict(cookies_dict)
 
+    # create a copy of this downloader, with the same host, headers and cookies,
+    # but with its own HTTP session; each scan worker thread gets its own copy
+    def clone(self):
+        dnl = XNovaPageDownload()
+        dnl.xnova_url = self.xnova_url
+        dnl.user_agent = self.user_agent
+        dnl.set_proxy(self.proxy)
+        dnl.sess.headers.update(self.sess.headers)
+        dnl.sess.cookies = self.sess.cookies.copy()
+        dnl.timeout = self.timeout
+        dnl.retry_policy = self.retry_policy
+        dnl.use_circuit_breaker = self.use_circuit_breaker
+        dnl.rate_limiter = self.rate_limiter
+        dnl.stats = self.stats  # count traffic of all clones together
+        return dnl
+
+    # (re)create HTTP session to use given proxy url, None - direct connection;
+    # headers and cookies of the previous session are kept
+    def set_proxy(self, proxy: str=None):
+        if proxy == '':
+            proxy = None
+        old_sess = self.sess
+        self.proxy = proxy
+        if (self.proxy is not None) and self.proxy.startswith('socks5://'):
+            # for SOCKS5 proxy create requesocks session
+            self.sess = requesocks.session()
+            logger.info('Using SOCKS5 proxy session (requesocks)')
+        else:
+            self.sess = requests.Session()  # else normal session
+        if self.proxy is not None:
+            self.sess.proxies = {'http': self.proxy, 'https': self.proxy}
+            logger.info('Set HTTP/HTTPS proxy to: {0}'.format(self.proxy))
+        if old_sess is not None:
+            self.sess.headers.update(old_sess.headers)
+            self.sess.cookies = old_sess.cookies.copy()
+
     def set_useragent(self, ua_str: str):
         self.user_agent = ua_str
         self.sess.headers.update({'user-agent': self.user_agent})
@@ -93,18 +136,79 @@ class XNovaPageDownload:
     def _set_error(self, errstr):
         self.error_str = errstr
 
-    # real downloader function
-    # returns None on failure
-    def download_url_path(self, url_path: str, return_binary=False):
+    # reads text response body in chunks, feeding them to consumer, until consumer
+    # says it has got all it needs; the rest of body is not downloaded (connection
+    # is closed). Returns tuple (text read, number of body bytes read)
+    @staticmethod
+    def _read_stream(r, consumer):
+        try:
+            decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')(errors='replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        parts = []
+        num_bytes = 0
+        for chunk in r.iter_content(chunk_size=8192):
+            num_bytes += len(chunk)
+            text = decoder.decode(chunk)
+            parts.append(text)
+            if consumer.feed(text):
+                break
+        else:
+            parts.append(decoder.decode(b'', final=True))
+        if hasattr(r, 'close'):
+            r.close()
+        return ''.join(parts), num_bytes
+
+    # one request, without retries; returns None on failure,
+    # and then self.failure_kind says if it is worth retrying
+    def _download_once(self, url: str, return_binary=False, validators: dict=None, stream_consumer=None):
         self.error_str = None  # clear error
-        # construct url to download
-        url = 'http://{0}/{1}'.format(self.xnova_url, url_path)
+        self.status_code = None
+        self.failure_kind = None
+        self.retry_after = None
+        self.not_modified = False
+        self.validators = None
+        self.response_url = None
         logger.debug('internal: downloading [{0}]...'.format(url))
+        headers = {}
+        if validators:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
         ret = None
+        kwargs = {}
+        if (stream_consumer is not None) and isinstance(self.sess, requests.Session):
+            kwargs['stream'] = True  # requesocks does not read body in advance anyway
         try:
-            r = self.sess.get(url)
+            r = self.sess.get(url, timeout=self.timeout, headers=headers, **kwargs)
+            self.status_code = r.status_code
+            self.response_url = r.url
+            text = None
+            if (stream_consumer is not None) and (r.status_code == requests.codes.ok) and not return_binary:
+                text, content_bytes = self._read_stream(r, stream_consumer)
+            else:
+                content_bytes = len(r.content)
+            # bytes read from socket, before gzip decoding
+            wire_bytes = content_bytes
+            if hasattr(r.raw, 'tell'):
+                wire_bytes = r.raw.tell() or content_bytes
+            elif (text is None) and ('content-length' in r.headers):
+                wire_bytes = int(r.headers['content-length'])
+            self.stats.add(wire_bytes, content_bytes, r.status_code == 304)
+            if r.status_code == 304:
+                self.not_modified = True
+                logger.debug('internal: [{0}] not modified'.format(url))
+                return None
             if r.status_code == requests.codes.ok:
-                if not return_binary:
+                self.validators = {}
+                if r.headers.get('etag'):
+                    self.validators['etag'] = r.headers['etag']
+                if r.headers.get('last-modified'):
+                    self.validators['last_modified'] = r.headers['last-modified']
+                if text is not None:
+                    ret = text
+                elif not return_binary:
                     ret = r.text
                 else:
                     ret = r.content
@@ -114,10 +218,60 @@ class XNovaPageDownload:
             else:
                 logger.error('Unexpected response code: HTTP {0}'.format(r.status_code))
                 self._set_error('HTTP {0}'.format(r.status_code))
+                self.retry_after = parse_retry_after(r.headers.get('retry-after'))
         except requests.exceptions.RequestException as e:
             logger.error('Exception {0}'.format(type(e)))
             self._set_error(str(e))
         except requesocks.exceptions.RequestException as e:
             logger.error('Requesocks exception {0}'.format(type(e)))
             self._set_error(str(e))
+        if ret is None:
+            self.failure_kind = classify_failure(self.status_code)
         return ret
+
+    # real downloader function
+    # returns None on failure; if self.retry_policy is set, transient failures
+    # (connection errors, timeouts, HTTP 5xx/429) are retried according to it,
+    # and with self.use_circuit_breaker all requests to host wait while its
+    # circuit breaker is open (host is down)
+    # validators: dict with 'etag' and/or 'last_modified' of the copy we already
+    # have (as self.validators after its download), to make conditional request;
+    # if page was not modified, returns None and sets self.not_modified
+    # stream_consumer_factory: to read text page in chunks, function (or class) that makes
+    # consumer object with feed(text) method, like GalaxyScriptExtractor; one consumer per
+    # attempt. Reading stops when feed() returns True, only page part read so far is returned
+    def download_url_path(self, url_path: str, return_binary=False, validators: dict=None,
+                          stream_consumer_factory=None):
+        # construct url to download
+        url = 'http://{0}/{1}'.format(self.xnova_url, url_path)
+        breaker = None
+        if self.use_circuit_breaker:
+            # requests via different proxies fail independently
+            breaker_key = self.xnova_url
+            if self.proxy is not None:
+                breaker_key = '{0} via {1}'.format(self.xnova_url, self.proxy)
+            breaker = get_circuit_breaker(breaker_key)
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.wait()
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()  # obey requests rate limit, retries included
+            consumer = None
+            if stream_consumer_factory is not None:
+                consumer = stream_consumer_factory()
+            ret = self._download_once(url, return_binary, validators, consumer)
+            if (ret is not None) or self.not_modified or (self.failure_kind == FAILURE_PERMANENT):
+                if breaker is not None:
+                    breaker.record_success()  # server responded, it is alive
+                return ret
+            if breaker is not None:
+                breaker.record_failure()
+            attempt += 1
+            if (self.retry_policy is None) or (attempt >= self.retry_policy.max_attempts):
+                logger.error('Giving up on [{0}] after {1} attempts: {2}'.format(url, attempt, self.error_str))
+                return None
+            delay = self.retry_policy.get_delay(attempt, self.retry_after)
+            logger.warn('Retrying [{0}] in {1:.1f}s ({2}/{3})'.format(
+                url, delay, attempt + 1, self.retry_policy.max_attempts))
+            time.sleep(delay)
@@ -0,0 +1,183 @@
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+from . import xn_logger
+
+logger = xn_logger.get(__name__, debug=False)
+
+
+# Storage engines for XNovaPageCache.
+# Each store keeps page contents (str) together with page modification time
+# and optional page metadata dict (HTTP validators: ETag, Last-Modified),
+# and can list all stored pages names and mtimes in one pass.
+
+
+# Original storage: one plain text file per page, mtime is file mtime;
+# page metadata is kept in JSON file next to it, "<page>.meta"
+class PageFilesStore:
+    def __init__(self, pages_dir: str, encoding: str):
+        self._pages_dir = pages_dir
+        self._encoding = encoding
+
+    def list_pages(self):
+        ret = []
+        try:
+            with os.scandir(self._pages_dir) as it:
+                for entry in it:
+                    # skip login.dat, metadata, and temporary files of unfinished writes
+                    if (entry.name == 'login.dat') or entry.name.endswith('.tmp') \
+                            or entry.name.endswith('.meta'):
+                        continue
+                    try:
+                        if entry.is_file():
+                            ret.append((entry.name, int(entry.stat().st_mtime)))
+                    except OSError:
+                        pass
+        except OSError as ose:
+            logger.error('Cannot read page cache dir: {0}'.format(str(ose)))
+        return ret
+
+    # returns None if page does not exist;
+    # raises UnicodeDecodeError if file cannot be decoded
+    def read_page(self, page_name: str):
+        fn = os.path.join(self._pages_dir, page_name)
+        try:
+            with open(fn, mode='rt', encoding=self._encoding) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    # returns page metadata dict, or None
+    def read_meta(self, page_name: str):
+        try:
+            with open(os.path.join(self._pages_dir, page_name + '.meta'), mode='rt', encoding='UTF-8') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_file(self, fn: str, contents: str, encoding: str, mtime: int):
+        # write to temporary file first, then rename: readers never see half-written page
+        fn_tmp = fn + '.tmp'
+        with open(fn_tmp, mode='wt', encoding=encoding) as f:
+            f.write(contents)
+        os.utime(fn_tmp, (mtime, mtime))
+        os.replace(fn_tmp, fn)
+
+    def write_page(self, page_name: str, contents: str, mtime: int, meta: dict=None):
+        fn = os.path.join(self._pages_dir, page_name)
+        if meta:
+            self._write_file(fn + '.meta', json.dumps(meta), 'UTF-8', mtime)
+        else:
+            self._delete_file(fn + '.meta')
+        self._write_file(fn, contents, self._encoding, mtime)
+
+    # update page modification time only
+    def touch_page(self, page_name: str, mtime: int):
+        try:
+            os.utime(os.path.join(self._pages_dir, page_name), (mtime, mtime))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _delete_file(fn: str):
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+    def delete_page(self, page_name: str):
+        fn = os.path.join(self._pages_dir, page_name)
+        self._delete_file(fn)
+        self._delete_file(fn + '.meta')
+
+    def compact(self):
+        # nothing to compact, just remove leftovers of interrupted writes
+        try:
+            with os.scandir(self._pages_dir) as it:
+                for entry in it:
+                    if entry.name.endswith('.tmp'):
+                        os.remove(entry.path)
+        except OSError as ose:
+            logger.error('Cannot clean page cache dir: {0}'.format(str(ose)))
+
+    def close(self):
+        pass
+
+
+# All pages in one sqlite DB file, zlib-compressed. Writes are transactional
+# (WAL journal), so a crash never leaves a broken page, and listing all pages
+# is a single sequential read of a small table.
+class PageSqliteStore:
+    def __init__(self, db_filename: str, compress_level=6):
+        self.compress_level = compress_level
+        self._lock = threading.Lock()
+        # used from scan worker threads, access is serialized by self._lock
+        self._conn = sqlite3.connect(db_filename, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pages ( '
+                           ' name TEXT PRIMARY KEY, '
+                           ' mtime INT, '
+                           ' size INT, '
+                           ' data BLOB )')
+        # column added later, for pages metadata as JSON
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(pages)').fetchall()]
+        if 'meta' not in columns:
+            self._conn.execute('ALTER TABLE pages ADD COLUMN meta TEXT')
+        self._conn.commit()
+
+    def list_pages(self):
+        with self._lock:
+            return self._conn.execute('SELECT name, mtime FROM pages').fetchall()
+
+    def read_page(self, page_name: str):
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM pages WHERE name=?', (page_name, )).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0]).decode('UTF-8')
+
+    def read_meta(self, page_name: str):
+        with self._lock:
+            row = self._conn.execute('SELECT meta FROM pages WHERE name=?', (page_name, )).fetchone()
+        if (row is None) or (row[0] is None):
+            return None
+        return json.loads(row[0])
+
+    def write_page(self, page_name: str, contents: str, mtime: int, meta: dict=None):
+        raw = contents.encode('UTF-8')
+        data = zlib.compress(raw, self.compress_level)
+        meta_json = json.dumps(meta) if meta else None
+        with self._lock:
+            with self._conn:
+                self._conn.execute('INSERT OR REPLACE INTO pages (name, mtime, size, data, meta) VALUES (?,?,?,?,?)',
+                                   (page_name, mtime, len(raw), data, meta_json))
+
+    def touch_page(self, page_name: str, mtime: int):
+        with self._lock:
+            with self._conn:
+                self._conn.execute('UPDATE pages SET mtime=? WHERE name=?', (mtime, page_name))
+
+    def delete_page(self, page_name: str):
+        with self._lock:
+            with self._conn:
+                self._conn.execute('DELETE FROM pages WHERE name=?', (page_name, ))
+
+    # returns tuple (number of pages, uncompressed bytes, compressed bytes)
+    def get_stats(self) -> tuple:
+        with self._lock:
+            row = self._conn.execute('SELECT COUNT(*), SUM(size), SUM(LENGTH(data)) FROM pages').fetchone()
+        return row[0], row[1] or 0, row[2] or 0
+
+    # give free space back to filesystem
+    def compact(self):
+        with self._lock:
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._conn.execute('VACUUM')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
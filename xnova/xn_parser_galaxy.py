@@ -1,13 +1,99 @@
 # -*- coding: utf-8 -*-
-import execjs
-import execjs._exceptions as execjs_exceptions
+import re
+
+try:
+    import execjs
+    import execjs._exceptions as execjs_exceptions
+except ImportError:
+    execjs = None  # JS runtime is only needed for opt-in fallback
 
 from .xn_data import XNCoords
+from .xn_js_unpack import UnpackError, unpack_packed_js, parse_row_assignments
+from .xn_js_worker import JSWorkerError, get_pool as get_js_worker_pool
 from .xn_parser import XNParserBase, safe_int, get_attribute
 from . import xn_logger
 
 logger = xn_logger.get(__name__, debug=False)
 
+_GALAXY_DIV_RE = re.compile(r'<div[^>]*\sid\s*=\s*["\']?galaxy["\'\s>]')
+_SCRIPT_START_RE = re.compile(r'<script[^>]*>', re.IGNORECASE)
+_SCRIPT_END_RE = re.compile(r'</script\s*>', re.IGNORECASE)
+
+
+# Fast path of galaxy page parsing: finds galaxy script (the first <script>
+# after <div id='galaxy'>, same as GalaxyParser takes) by searching raw page
+# text, without feeding the whole page through HTMLParser. Page can be fed in
+# chunks while it is being downloaded: feed() returns True once the script end
+# is seen, and the rest of the page is not needed. Only the text after the last
+# incomplete tag is kept between chunks while searching.
+# If page layout is not as expected, script_body stays None, and the page
+# should be parsed by GalaxyParser.
+class GalaxyScriptExtractor:
+    _FIND_DIV = 0
+    _FIND_SCRIPT = 1
+    _FIND_SCRIPT_END = 2
+    _DONE = 3
+    _FAILED = 4  # not the expected script, the whole page is needed for GalaxyParser
+
+    def __init__(self):
+        self.script_body = None
+        self._state = self._FIND_DIV
+        self._buf = ''
+        self._pos = 0  # search in self._buf continues from here
+        self._body_start = 0
+
+    # search for tag regex in buffer; if not found, drop the buffer up to the
+    # last tag start, which may be incomplete
+    def _find_tag(self, tag_re):
+        m = tag_re.search(self._buf, self._pos)
+        if m is not None:
+            return m
+        last_lt = self._buf.rfind('<', self._pos)
+        if last_lt == -1:
+            self._buf = ''
+        else:
+            self._buf = self._buf[last_lt:]
+        self._pos = 0
+        return None
+
+    def feed(self, data: str) -> bool:
+        """
+        Feeds next part of page text
+        :param data: page text chunk
+        :return: True if galaxy script is found, and the rest of the page is not needed
+        """
+        if self._state == self._DONE:
+            return True
+        if self._state == self._FAILED:
+            return False
+        self._buf += data
+        if self._state == self._FIND_DIV:
+            m = self._find_tag(_GALAXY_DIV_RE)
+            if m is None:
+                return False
+            self._pos = m.end()
+            self._state = self._FIND_SCRIPT
+        if self._state == self._FIND_SCRIPT:
+            m = self._find_tag(_SCRIPT_START_RE)
+            if m is None:
+                return False
+            self._pos = m.end()
+            self._body_start = m.end()
+            self._state = self._FIND_SCRIPT_END
+        # script body may contain '<', keep all of it
+        m = _SCRIPT_END_RE.search(self._buf, self._pos)
+        if m is None:
+            self._pos = max(self._body_start, len(self._buf) - 16)
+            return False
+        body = self._buf[self._body_start:m.start()].strip()
+        self._buf = ''
+        if not body.startswith('var Deuterium = '):
+            self._state = self._FAILED
+            return False
+        self.script_body = body
+        self._state = self._DONE
+        return True
+
 
 class GalaxyParser(XNParserBase):
     def __init__(self):
@@ -15,6 +101,8 @@ class GalaxyParser(XNParserBase):
         self._in_galaxy = False
         self.script_body = ''
         self.galaxy_rows = []
+        # use execjs to eval scripts that native decoder cannot handle
+        self.js_fallback = False
 
     def clear(self):
         self.script_body = ''
@@ -46,13 +134,6 @@ class GalaxyParser(XNParserBase):
             logger.error('Invalid format of script body: cannot parse it!')
             return None
 
-        # create JavaScript interpreter runtime
-        try:
-            js_runtime = execjs.get('Node')
-        except execjs_exceptions.RuntimeUnavailableError:
-            js_runtime = execjs.get()  # default
-        logger.debug('Using [{0}] as JS runtime.'.format(js_runtime.name))
-
         # find galaxy script part
         eval_start = self.script_body.find('eval(function(p,a,c,k,e,d)')
         if eval_start == -1:
@@ -71,12 +152,7 @@ class GalaxyParser(XNParserBase):
             eval_start += len(rows_end_str)
             eval_text = self.script_body[eval_start:eval_end]
             eval_text = eval_text.strip()
-            eval_text = 'var row = []; ' + eval_text + '\nreturn row;'
-            #
-            logger.debug('Will eval in Uni5 mode [{0}]'.format(eval_text))
-            #
-            ctx = js_runtime.compile(eval_text)
-            self.galaxy_rows = ctx.exec_(eval_text)
+            is_packed = False
         else:
             # packed, as usual (uni4)
             eval_end = self.script_body.find("$('#galaxy').append(PrintRow());")
@@ -88,28 +164,40 @@ class GalaxyParser(XNParserBase):
             # ^^ [eval(function(p,a,c,k,e,d){e=function(c){r... ...141|7866|u0426'.split('|')))]
             eval_text = eval_text[5:-1]
             # ^^ [function(p,a,c,k,e,d){e=functi... ...0426'.split('|'))]
-            logger.debug('Will eval in Uni4 mode [{0}]'.format(eval_text))
-            eval_res = js_runtime.eval(eval_text)
-            # Now, eval_res is a string:
-            # row[12]={"planet":12,"id_planet":54448,"ally_planet":0,"metal":0,"crystal":0,
-            # "name":"\u0413\u043b\u0430\u0432\u043d\u0430\u044f \u043f\u043b\u0430\u043d\u0435\u0442\u0430",
-            # "planet_type":1,"destruyed":0,"image":"normaltempplanet02","last_active":60,"parent_planet":0,
-            # "luna_id":null,"luna_name":null,"luna_destruyed":null,"luna_diameter":null,"luna_temp":null,
-            # "user_id":71992,"username":"\u041e\u041b\u0415\u0413 \u041a\u0410\u0420\u041f\u0415\u041d\u041a\u041e",
-            # "race":4,"ally_id":0,"authlevel":0,"onlinetime":1,"urlaubs_modus_time":0,"banaday":0,"sex":1,
-            # "avatar":7,"user_image":"","ally_name":null,"ally_members":null,"ally_web":null,"ally_tag":null,
-            # "type":null,"total_rank":7865,"total_points":0};row[9]={"planet":9,"id_planet":54450,"ally_planet":0,
-            # "metal":0,"crystal":0,"name":"Arnon","planet_type":1,"destruyed":0,"image":"normaltempplanet08",
-            # "last_active":0,"parent_planet":0,"luna_id":null,"luna_name":null,"luna_destruyed":null,
-            # "luna_diameter":null,"luna_temp":null,"user_id":71995,"username":"minlexx","race":4,"ally_id":389,
-            # "authlevel":0,"onlinetime":0,"urlaubs_modus_time":0,"banaday":0,"sex":1,"avatar":5,
-            # "user_image":"71995_1440872455.jpg","ally_name":"Fury","ally_members":8,"ally_web":"",
-            # "ally_tag":"Fury","type":null,"total_rank":141,"total_points":115582};
-            # ...
-            # we ned to eval() this string again, slightly modified, to get resulting row:
-            eval_res = 'var row = []; ' + eval_res + "\nreturn row;"
-            ctx = js_runtime.compile(eval_res)
-            self.galaxy_rows = ctx.exec_(eval_res)
+            is_packed = True
+
+        try:
+            if is_packed:
+                rows_text = unpack_packed_js(eval_text)
+                # Now, rows_text is a string:
+                # row[12]={"planet":12,"id_planet":54448,"ally_planet":0,"metal":0,"crystal":0,
+                # "name":"\u0413\u043b\u0430\u0432\u043d\u0430\u044f \u043f\u043b\u0430\u043d\u0435\u0442\u0430",
+                # "planet_type":1,"destruyed":0,"image":"normaltempplanet02","last_active":60,"parent_planet":0,
+                # "luna_id":null,"luna_name":null,"luna_destruyed":null,"luna_diameter":null,"luna_temp":null,
+                # "user_id":71992,"username":"\u041e\u041b\u0415\u0413 \u041a\u0410\u0420\u041f\u0415\u041d\u041a\u041e",
+                # "race":4,"ally_id":0,"authlevel":0,"onlinetime":1,"urlaubs_modus_time":0,"banaday":0,"sex":1,
+                # "avatar":7,"user_image":"","ally_name":null,"ally_members":null,"ally_web":null,"ally_tag":null,
+                # "type":null,"total_rank":7865,"total_points":0};row[9]={"planet":9,"id_planet":54450,"ally_planet":0,
+                # "metal":0,"crystal":0,"name":"Arnon","planet_type":1,"destruyed":0,"image":"normaltempplanet08",
+                # "last_active":0,"parent_planet":0,"luna_id":null,"luna_name":null,"luna_destruyed":null,
+                # "luna_diameter":null,"luna_temp":null,"user_id":71995,"username":"minlexx","race":4,"ally_id":389,
+                # "authlevel":0,"onlinetime":0,"urlaubs_modus_time":0,"banaday":0,"sex":1,"avatar":5,
+                # "user_image":"71995_1440872455.jpg","ally_name":"Fury","ally_members":8,"ally_web":"",
+                # "ally_tag":"Fury","type":null,"total_rank":141,"total_points":115582};
+                # ...
+                # each row value is JSON, decode them all to get resulting rows list
+            else:
+                rows_text = eval_text
+            self.galaxy_rows = parse_row_assignments(rows_text)
+        except UnpackError as ue:
+            if not self.js_fallback:
+                logger.error('Cannot decode galaxy script: {0}'.format(str(ue)))
+                return None
+            logger.warn('Cannot decode galaxy script natively ({0}), using JS runtime'.format(str(ue)))
+            self.galaxy_rows = self._eval_galaxy_script_js(eval_text, is_packed)
+            if self.galaxy_rows is None:
+                self.galaxy_rows = []
+                return None
 
         logger.debug(type(self.galaxy_rows))
         logger.debug(self.galaxy_rows)
@@ -152,3 +240,81 @@ class GalaxyParser(XNParserBase):
         #   'total_rank': 7866
         # },
         # None, ... ]
+        return self.galaxy_rows
+
+    # execute galaxy script in JavaScript runtime: in persistent worker process
+    # if Node.js is found, or with execjs (slow, spawns a process per call)
+    @staticmethod
+    def _eval_galaxy_script_js(eval_text: str, is_packed: bool):
+        js_pool = get_js_worker_pool()
+        if js_pool is not None:
+            try:
+                if is_packed:
+                    # unpacked text is: row[12]={...};row[9]={...}; ...
+                    eval_text = js_pool.eval(eval_text)
+                return js_pool.exec_('var row = []; ' + eval_text + '\nreturn row;')
+            except JSWorkerError as e:
+                logger.error('JS worker failed to eval galaxy script: {0}'.format(str(e)))
+                return None
+        if execjs is None:
+            logger.error('No JS runtime (Node.js or PyExecJS), JS fallback is not available')
+            return None
+        # create JavaScript interpreter runtime
+        try:
+            js_runtime = execjs.get('Node')
+        except execjs_exceptions.RuntimeUnavailableError:
+            js_runtime = execjs.get()  # default
+        logger.debug('Using [{0}] as JS runtime.'.format(js_runtime.name))
+        if not is_packed:
+            eval_text = 'var row = []; ' + eval_text + '\nreturn row;'
+            logger.debug('Will eval in Uni5 mode [{0}]'.format(eval_text))
+            ctx = js_runtime.compile(eval_text)
+            return ctx.exec_(eval_text)
+        logger.debug('Will eval in Uni4 mode [{0}]'.format(eval_text))
+        eval_res = js_runtime.eval(eval_text)
+        # Now, eval_res is a string:
+        # row[12]={"planet":12,"id_planet":54448,...};row[9]={...};
+        # we ned to eval() this string again, slightly modified, to get resulting row:
+        eval_res = 'var row = []; ' + eval_res + "\nreturn row;"
+        ctx = js_runtime.compile(eval_res)
+        return ctx.exec_(eval_res)
+
+
+# parser of parse_galaxy_page(), one per process, created on first use
+_page_parser = None
+
+
+def parse_galaxy_page(content: str, js_fallback=False, parser: GalaxyParser=None):
+    """
+    Parses galaxy page and decodes its galaxy script. Module-level function,
+    so it can be run in process pool (ProcessPoolExecutor) workers.
+    :param content: galaxy page HTML
+    :param js_fallback: allow to use JS runtime if script cannot be decoded natively
+    :param parser: parser object to use, by default per-process parser is used
+    :return: galaxy rows list, or None if page has no galaxy script or it cannot be decoded
+    """
+    global _page_parser
+    if parser is None:
+        if _page_parser is None:
+            _page_parser = GalaxyParser()
+        parser = _page_parser
+    parser.js_fallback = js_fallback
+    parser.clear()
+    extractor = GalaxyScriptExtractor()
+    extractor.feed(content)
+    if extractor.script_body is not None:
+        parser.script_body = extractor.script_body
+    else:
+        # unexpected page layout, look for the script with full HTML parser
+        parser.parse_page_content(content)
+    if parser.script_body == '':
+        return None
+    if parser.unscramble_galaxy_script() is None:
+        return None
+    return parser.galaxy_rows
+
+
+# quick check that page is a galaxy page (has galaxy div), and not, for example,
+# login page that is shown when session has ended
+def is_galaxy_page(content: str) -> bool:
+    return _GALAXY_DIV_RE.search(content) is not None
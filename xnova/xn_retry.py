@@ -0,0 +1,167 @@
+import email.utils
+import random
+import threading
+import time
+
+from . import xn_logger
+
+logger = xn_logger.get(__name__, debug=False)
+
+
+# Kinds of download failures
+FAILURE_TRANSIENT = 'transient'  # worth retrying later: timeouts, connection errors, 5xx, 429
+FAILURE_PERMANENT = 'permanent'  # retrying will not help: 404 and other 4xx
+
+TRANSIENT_HTTP_CODES = (408, 425, 429, 500, 502, 503, 504, 520, 521, 522, 523, 524)
+
+
+def classify_failure(status_code: int=None) -> str:
+    """
+    Decides if failed request can be retried
+    :param status_code: HTTP response code, or None if there was no response
+                        (connection error, timeout)
+    :return: FAILURE_TRANSIENT or FAILURE_PERMANENT
+    """
+    if (status_code is None) or (status_code in TRANSIENT_HTTP_CODES):
+        return FAILURE_TRANSIENT
+    return FAILURE_PERMANENT
+
+
+def parse_retry_after(value: str, now: float=None):
+    """
+    Parses Retry-After header: number of seconds, or HTTP date
+    :return: number of seconds to wait (>= 0), or None if header is missing or invalid
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        dt = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if dt is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(dt.timestamp() - now, 0.0)
+
+
+# Exponential backoff with "full jitter": delay before retry N is random
+# in [0, min(max_delay, base_delay * 2^N)], so that many workers failing
+# at once do not retry all at the same moment. Server's Retry-After
+# (for 429/503) overrides the computed delay, up to max_retry_after.
+class RetryPolicy:
+    def __init__(self, max_attempts: int=4, base_delay: float=2.0, max_delay: float=60.0):
+        self.max_attempts = max(int(max_attempts), 1)  # including the first attempt
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = 600.0
+
+    def get_delay(self, attempt: int, retry_after: float=None) -> float:
+        """
+        :param attempt: number of failed attempts so far, starting from 1
+        :param retry_after: server's Retry-After value in seconds, if any
+        :return: seconds to sleep before next attempt
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+
+# Per-host circuit breaker, shared by all downloaders (and threads) that access
+# the same host. After failure_threshold transient failures in a row the circuit
+# "opens": nobody sends requests to the host for reset_timeout seconds, so the
+# whole scan pauses instead of burning requests on a server that is down. Then
+# one probe request is let through ("half-open"): on success the circuit closes,
+# on failure it opens again for twice as long (up to max_reset_timeout).
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, host: str, failure_threshold: int=5, reset_timeout: float=30.0,
+                 max_reset_timeout: float=600.0):
+        self.host = host
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._cur_timeout = reset_timeout
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_request(self) -> float:
+        """
+        Asks permission to send a request
+        :return: 0 if request may be sent now, else number of seconds to wait
+                 before asking again
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                wait_secs = self._opened_at + self._cur_timeout - now
+                if wait_secs > 0:
+                    return wait_secs
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            # half-open: only one probe request at a time
+            if self._probe_in_flight:
+                return 1.0
+            self._probe_in_flight = True
+            return 0.0
+
+    # server answered (even with 404): it is alive
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info('Host {0} is back, resuming requests'.format(self.host))
+            self.state = self.CLOSED
+            self._failures = 0
+            self._cur_timeout = self.reset_timeout
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN:
+                # probe failed, wait longer
+                self._cur_timeout = min(self._cur_timeout * 2, self.max_reset_timeout)
+                self._open()
+            elif (self.state == self.CLOSED) and (self._failures >= self.failure_threshold):
+                self._open()
+
+    # must be called with self._lock held
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+        logger.warn('Host {0} seems to be down ({1} failures in a row), pausing requests for {2:.0f}s'.format(
+            self.host, self._failures, self._cur_timeout))
+
+    # block current thread until request may be sent
+    def wait(self):
+        while True:
+            wait_secs = self.before_request()
+            if wait_secs <= 0:
+                return
+            time.sleep(wait_secs)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+# circuit breaker of the host, one per host per process
+def get_circuit_breaker(host: str) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host)
+            _breakers[host] = breaker
+        return breaker
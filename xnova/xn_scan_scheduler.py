@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+
+from . import xn_logger
+
+logger = xn_logger.get(__name__, debug=False)
+
+
+# Global requests rate limiter, shared by all scan workers.
+# Bucket is refilled with `rate` tokens per second, up to `capacity`
+# tokens; every network request takes one token, waiting for it if
+# the bucket is empty. rate <= 0 means "no limit".
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float=1.0):
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self._tokens = self.capacity
+        self._last_ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    # make rate limiter from the old-style "delay between requests" setting
+    @staticmethod
+    def from_delay(delay_secs: float):
+        if delay_secs <= 0:
+            return TokenBucket(0)
+        return TokenBucket(1.0 / delay_secs)
+
+    def _refill(self, now: float):
+        elapsed = now - self._last_ts
+        self._last_ts = now
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+
+    # try to take tokens without waiting, returns True on success
+    def try_acquire(self, tokens: float=1.0) -> bool:
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+        return False
+
+    # take tokens, sleeping until they are available
+    def acquire(self, tokens: float=1.0):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_secs = (tokens - self._tokens) / self.rate
+            time.sleep(wait_secs)
+
+
+# Runs work units on a pool of worker threads.
+# Every worker gets its own context object from worker_init() (for example,
+# its own page downloader and parser), and calls work_func(ctx, unit) for each
+# unit it takes from the queue. Results are passed back to the thread that
+# called run(), so result_func(unit, result) can safely use objects bound to
+# that thread, like sqlite3 connections. Network waits and parsing in workers
+# overlap with result processing (DB writes) in the calling thread.
+class ScanScheduler:
+    def __init__(self, work_func, num_workers: int=1, worker_init=None):
+        self._work_func = work_func
+        self._worker_init = worker_init
+        self.num_workers = max(int(num_workers), 1)
+        self._units = queue.Queue()
+        self._results = queue.Queue()
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    # ask workers to stop taking new units; units already in progress complete
+    def stop(self):
+        self._stop_event.set()
+
+    def is_stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+    def _worker_proc(self):
+        ctx = None
+        if self._worker_init is not None:
+            ctx = self._worker_init()
+        while True:
+            unit = self._units.get()
+            if unit is None:  # end marker
+                break
+            if self._stop_event.is_set():
+                continue  # drain the queue
+            try:
+                result = self._work_func(ctx, unit)
+            except Exception as e:
+                logger.exception('Worker failed to process unit {0}: {1}'.format(unit, str(e)))
+                result = None
+            self._results.put((unit, result))
+        self._results.put(None)  # this worker has finished
+
+    # process all units, blocks until done; returns number of processed units
+    def run(self, units, result_func=None) -> int:
+        self._stop_event.clear()
+        for unit in units:
+            self._units.put(unit)
+        for i in range(self.num_workers):
+            self._units.put(None)
+        self._threads = []
+        for i in range(self.num_workers):
+            th = threading.Thread(target=self._worker_proc, name='scan-worker-{0}'.format(i), daemon=True)
+            self._threads.append(th)
+            th.start()
+        num_done = 0
+        workers_left = self.num_workers
+        try:
+            while workers_left > 0:
+                item = self._results.get()
+                if item is None:
+                    workers_left -= 1
+                    continue
+                num_done += 1
+                if result_func is not None:
+                    result_func(item[0], item[1])
+        except BaseException:
+            # do not leave workers running on error or Ctrl+C
+            self.stop()
+            raise
+        for th in self._threads:
+            th.join()
+        self._threads = []
+        return num_done